@@ -8,15 +8,23 @@ if __name__ == '__main__':
     Running monobase directly does not do anything 🙀.
     You probably want one of these instead:
 
+        python -m monobase.bench
+
         python -m monobase.build
 
         python -m monobase.cuda
 
         python -m monobase.diff
 
+        python -m monobase.ldcache
+
         python -m monobase.monogen
 
+        python -m monobase.prewarm
+
         python -m monobase.update
+
+        python -m monobase.usage
     """
         )
     )
@@ -45,7 +45,31 @@ fi
 
 # Cog
 
+# Precomputed by monobase.build, see monobase.activation
+# Resolved without subprocesses, URLs and older generations fall back to below
+cog_env=""
 if [ -z "${R8_COG_VERSION:-}" ]; then
+    cog_env=default
+else
+    case $R8_COG_VERSION in
+    https://*|file://*) ;;
+    coglet) cog_env=cogletlatest ;;
+    coglet==*) cog_env="coglet${R8_COG_VERSION#coglet==}" ;;
+    coglet*) ;;
+    *) cog_env="cog$R8_COG_VERSION" ;;
+    esac
+fi
+if [ -n "$cog_env" ]; then
+    cog_env="$MONOBASE_PREFIX/cog/latest/env.d/$cog_env-python$R8_PYTHON_VERSION"
+fi
+
+if [ -n "$cog_env" ] && [ -f "$cog_env" ]; then
+    cog_default="${R8_COG_VERSION:-}"
+    . "$cog_env"
+    if [ -z "$cog_default" ]; then
+        log_warning "R8_COG_VERSION not set, using default $R8_COG_VERSION"
+    fi
+elif [ -z "${R8_COG_VERSION:-}" ]; then
     COG_PATH="$MONOBASE_PREFIX/cog/latest/default-python$R8_PYTHON_VERSION"
     if [ ! -d "$COG_PATH" ]; then
         log_error "Cog $COG_PATH does not exist"
@@ -95,34 +119,107 @@ fi
 
 ########################################
 
+mono_env="python$R8_PYTHON_VERSION"
+if [ -n "${R8_CUDA_VERSION:-}" ] && [ -n "${R8_CUDNN_VERSION:-}" ]; then
+    mono_env="$mono_env-cuda$R8_CUDA_VERSION-cudnn$R8_CUDNN_VERSION"
+fi
 if [ -z "${MONOBASE_GEN_ID:-}" ]; then
-    latest="$MONOBASE_PREFIX/monobase/latest"
-    gdir="$(readlink -f "$latest")"
-    MONOBASE_GEN_ID="$(basename "$gdir" | sed 's/^g0\{0,4\}//')"
-    log_info "MONOBASE_GEN_ID not set, using latest $MONOBASE_GEN_ID"
+    mono_env="$MONOBASE_PREFIX/monobase/latest/env.d/$mono_env"
+else
+    # printf 'g%05d' without a subshell
+    case ${#MONOBASE_GEN_ID} in
+    1) mono_env="$MONOBASE_PREFIX/monobase/g0000$MONOBASE_GEN_ID/env.d/$mono_env" ;;
+    2) mono_env="$MONOBASE_PREFIX/monobase/g000$MONOBASE_GEN_ID/env.d/$mono_env" ;;
+    3) mono_env="$MONOBASE_PREFIX/monobase/g00$MONOBASE_GEN_ID/env.d/$mono_env" ;;
+    4) mono_env="$MONOBASE_PREFIX/monobase/g0$MONOBASE_GEN_ID/env.d/$mono_env" ;;
+    *) mono_env="$MONOBASE_PREFIX/monobase/g$MONOBASE_GEN_ID/env.d/$mono_env" ;;
+    esac
 fi
 
-MONOBASE_PATH="$MONOBASE_PREFIX/monobase/$(printf 'g%05d' "$MONOBASE_GEN_ID")"
+if [ -f "$mono_env" ]; then
+    gen_id="${MONOBASE_GEN_ID:-}"
+    . "$mono_env"
+    if [ -z "$gen_id" ]; then
+        log_info "MONOBASE_GEN_ID not set, using latest $MONOBASE_GEN_ID"
+    fi
+else
+    if [ -z "${MONOBASE_GEN_ID:-}" ]; then
+        latest="$MONOBASE_PREFIX/monobase/latest"
+        gdir="$(readlink -f "$latest")"
+        MONOBASE_GEN_ID="$(basename "$gdir" | sed 's/^g0\{0,4\}//')"
+        log_info "MONOBASE_GEN_ID not set, using latest $MONOBASE_GEN_ID"
+    fi
+
+    MONOBASE_PATH="$MONOBASE_PREFIX/monobase/$(printf 'g%05d' "$MONOBASE_GEN_ID")"
+
+    if [ -n "${R8_CUDA_VERSION:-}" ] && [ -n "${R8_CUDNN_VERSION:-}" ]; then
+        CUDA_HOME="$MONOBASE_PATH/cuda$R8_CUDA_VERSION"
+        CUDA_MAJOR="$(echo "$R8_CUDA_VERSION" | sed 's/\..\+//')"
+        CUDNN_HOME="$MONOBASE_PATH/cudnn$R8_CUDNN_VERSION-cuda${CUDA_MAJOR}"
+
+        LD_CACHE_DIR="$MONOBASE_PATH/ld.so.cache.d"
+        LD_CACHE_PATH="$LD_CACHE_DIR/cuda$R8_CUDA_VERSION-cudnn$R8_CUDNN_VERSION-python$R8_PYTHON_VERSION"
+        if [ -f "$LD_CACHE_DIR/manifest.txt" ]; then
+            # <cuda> <cudnn> <python> <file> <fingerprint>
+            LD_CACHE_PATH=""
+            while read -r c d p f _; do
+                if [ "$c" = "$R8_CUDA_VERSION" ] && [ "$d" = "$R8_CUDNN_VERSION" ] && [ "$p" = "$R8_PYTHON_VERSION" ]; then
+                    LD_CACHE_PATH="$LD_CACHE_DIR/$f"
+                    break
+                fi
+            done < "$LD_CACHE_DIR/manifest.txt"
+        fi
+
+        TORCH_CUDA_SUFFIX="cu$(echo "$R8_CUDA_VERSION" | sed 's/\.//')"
+    else
+        TORCH_CUDA_SUFFIX="cpu"
+    fi
+fi
 
 if [ -n "${R8_CUDA_VERSION:-}" ] && [ -n "${R8_CUDNN_VERSION:-}" ]; then
     # flash-attn, etc. needs CUDA_HOME for compilation
-    export CUDA_HOME="$MONOBASE_PATH/cuda$R8_CUDA_VERSION"
+    export CUDA_HOME
     export LIBRARY_PATH="$CUDA_HOME/lib64/stubs"
     PATH="$CUDA_HOME/bin${PATH:+:${PATH}}"
 
-    CUDA_MAJOR="$(echo "$R8_CUDA_VERSION" | sed 's/\..\+//')"
-    CUDNN_HOME="$MONOBASE_PATH/cudnn$R8_CUDNN_VERSION-cuda${CUDA_MAJOR}"
+    # MONOBASE_LD_CACHE=copy (default), symlink or bind
+    # symlink & bind avoid copying and rely on ld.so.cache alone for CUDA & CuDNN
+    # instead of searching LD_LIBRARY_PATH, only for caches verified at build time
+    # Anything else falls back to copy and LD_LIBRARY_PATH
+    LD_CACHE_ONLY=""
+    if [ -n "$LD_CACHE_PATH" ] && [ -f "$LD_CACHE_PATH" ]; then
+        case "${MONOBASE_LD_CACHE:-copy}" in
+        symlink|bind)
+            if [ ! -f "$LD_CACHE_PATH.verified" ]; then
+                log_debug "ld.so.cache $LD_CACHE_PATH not verified, copying"
+                cp -f "$LD_CACHE_PATH" /etc/ld.so.cache
+            elif [ /etc/ld.so.cache -ef "$LD_CACHE_PATH" ]; then
+                log_debug "ld.so.cache $LD_CACHE_PATH already active"
+                LD_CACHE_ONLY=1
+            elif [ "$MONOBASE_LD_CACHE" = bind ] && mount --bind "$LD_CACHE_PATH" /etc/ld.so.cache 2>/dev/null; then
+                log_debug "Bind mounted ld.so.cache $LD_CACHE_PATH"
+                LD_CACHE_ONLY=1
+            elif ln -sf "$LD_CACHE_PATH" /etc/ld.so.cache 2>/dev/null; then
+                LD_CACHE_ONLY=1
+            else
+                cp -f "$LD_CACHE_PATH" /etc/ld.so.cache
+            fi
+            ;;
+        *)
+            cp -f "$LD_CACHE_PATH" /etc/ld.so.cache
+            ;;
+        esac
+    else
+        log_warning "ld.so.cache for CUDA $R8_CUDA_VERSION CuDNN $R8_CUDNN_VERSION Python $R8_PYTHON_VERSION not found"
+    fi
 
     # NVIDIA Container Toolkit mounts drivers here
     NCT_PATH=/usr/lib/x86_64-linux-gnu
-    LD_LIBRARY_PATH="$NCT_PATH:$CUDA_HOME/lib64:$CUDNN_HOME/lib${LD_LIBRARY_PATH:+:${LD_LIBRARY_PATH}}"
-
-    LD_CACHE_PATH="$MONOBASE_PATH/ld.so.cache.d/cuda$R8_CUDA_VERSION-cudnn$R8_CUDNN_VERSION-python$R8_PYTHON_VERSION"
-    cp -f "$LD_CACHE_PATH" /etc/ld.so.cache
-
-    TORCH_CUDA_SUFFIX="cu$(echo "$R8_CUDA_VERSION" | sed 's/\.//')"
-else
-    TORCH_CUDA_SUFFIX="cpu"
+    if [ -n "$LD_CACHE_ONLY" ]; then
+        LD_LIBRARY_PATH="$NCT_PATH${LD_LIBRARY_PATH:+:${LD_LIBRARY_PATH}}"
+    else
+        LD_LIBRARY_PATH="$NCT_PATH:$CUDA_HOME/lib64:$CUDNN_HOME/lib${LD_LIBRARY_PATH:+:${LD_LIBRARY_PATH}}"
+    fi
 fi
 
 
@@ -154,6 +251,24 @@ if [ -d "$USER_PYTHONPATH" ]; then
     PYTHONPATH="$PYTHONPATH:$USER_PYTHONPATH"
 fi
 
+# Resolve top level imports from per-venv indexes instead of probing every layer
+if [ "${MONOBASE_IMPORT_INDEX:-}" = 1 ] && [ -f "$MONOBASE_PATH/site/sitecustomize.py" ]; then
+    PYTHONPATH="$MONOBASE_PATH/site:$PYTHONPATH"
+fi
+
+########################################
+
+# Access log for monobase.usage, best effort
+# Prefix is read-only in model containers, mount a writable host directory at
+# MONOBASE_USAGE_DIR and pass the same to builds
+# Requires bash 5+ for EPOCHSECONDS, other shells skip it instead of forking date
+MONOBASE_USAGE_DIR="${MONOBASE_USAGE_DIR:-$MONOBASE_PREFIX/usage}"
+if [ -n "${EPOCHSECONDS:-}" ] && [ -w "$MONOBASE_USAGE_DIR" ]; then
+    # <epoch> <cog venv> <monobase venv or -> <ld.so.cache or ->
+    printf '%s %s %s %s\n' "$EPOCHSECONDS" "$COG_VENV" "${MONO_VENV:--}" "${LD_CACHE_PATH:--}" \
+        >>"$MONOBASE_USAGE_DIR/access.log" 2>/dev/null || true
+fi
+
 export PATH
 export PYTHONPATH
 export LD_LIBRARY_PATH
@@ -0,0 +1,108 @@
+import itertools
+import logging
+import os
+import os.path
+import re
+
+from monobase.ldcache import LD_CACHE_MANIFEST, read_ld_cache_files
+from monobase.monogen import MonoGen
+from monobase.uv import cuda_suffix
+
+log = logging.getLogger(__name__)
+
+# Precomputed variables of activate.sh, one file per combination so that
+# activation is a single source without subprocesses
+# Cog: {prefix}/cog/{gid}/env.d/{cog_name}-python{python}
+# Monobase: {prefix}/monobase/g{id}/env.d/python{python}[-cuda{cuda}-cudnn{cudnn}]
+ENV_DIR = 'env.d'
+
+# Same as sed in activate.sh, e.g. cog0.14.0-python3.12 -> cog==0.14.0
+COG_VERSION_REGEX = re.compile(r'^(cog(let)?)(.*)-python.*$')
+COG_VENV_REGEX = re.compile(r'^(?P<cog>.+)-python(?P<python>\d+\.\d+)$')
+
+
+def env_line(k: str, v: str) -> str:
+    # Paths are relative to $MONOBASE_PREFIX, which may be mounted elsewhere
+    # Expanded by the shell, so nothing else may need quoting
+    assert re.fullmatch(r'(\$[A-Z_]+)?[\w.=/+-]*', v), f'Unsafe value {k}={v}'
+    return f'{k}="{v}"'
+
+
+def write_env_dir(edir: str, envs: dict[str, dict[str, str]]) -> None:
+    os.makedirs(edir, exist_ok=True)
+    changed = 0
+    for name, env in envs.items():
+        lines = ['# Generated by monobase.build, sourced by activate.sh']
+        lines += [env_line(k, v) for k, v in env.items()]
+        content = '\n'.join(lines) + '\n'
+        p = os.path.join(edir, name)
+        if os.path.exists(p):
+            with open(p, 'r') as f:
+                if f.read() == content:
+                    continue
+        with open(f'{p}.tmp', 'w') as f:
+            f.write(content)
+        os.replace(f'{p}.tmp', p)
+        changed += 1
+
+    # Combinations no longer valid, activate.sh falls back to resolving them
+    for name in os.listdir(edir):
+        if name not in envs:
+            os.remove(os.path.join(edir, name))
+    log.info(f'Activation index {edir}: {len(envs)} entries, {changed} updated')
+
+
+def write_cog_env(gdir: str) -> None:
+    gid = os.path.basename(gdir)
+    envs = {}
+    for venv in sorted(os.listdir(gdir)):
+        vdir = os.path.join(gdir, venv)
+        m = COG_VENV_REGEX.match(venv)
+        if m is None or not os.path.isdir(vdir):
+            continue
+        # Resolve default-python{python} like readlink -f
+        target = os.path.basename(os.path.realpath(vdir))
+        env = {'COG_VENV': f'$MONOBASE_PREFIX/cog/{gid}/{target}'}
+        if m.group('cog') == 'default':
+            env['R8_COG_VERSION'] = COG_VERSION_REGEX.sub(r'\1==\3', target)
+        envs[venv] = env
+    write_env_dir(os.path.join(gdir, ENV_DIR), envs)
+
+
+def write_generation_env(gdir: str, mg: MonoGen) -> None:
+    gid = os.path.basename(gdir)
+    cache_dir = os.path.join(gdir, 'ld.so.cache.d')
+    ld_caches = read_ld_cache_files(cache_dir)
+
+    envs = {}
+    for python in mg.python.keys():
+        envs[f'python{python}'] = {
+            'MONOBASE_GEN_ID': str(mg.id),
+            'MONOBASE_PATH': f'$MONOBASE_PREFIX/monobase/{gid}',
+            'TORCH_CUDA_SUFFIX': 'cpu',
+        }
+    for cuda, cudnn, python in itertools.product(
+        mg.cuda.keys(), mg.cudnn.keys(), mg.python.keys()
+    ):
+        cuda_major = cuda.split('.')[0]
+        if os.path.exists(os.path.join(cache_dir, LD_CACHE_MANIFEST)):
+            # Same as activate.sh, no entry means no ld.so.cache
+            f = ld_caches.get((cuda, cudnn, python), '')
+        else:
+            # Generations before the manifest, conventional file name
+            f = f'cuda{cuda}-cudnn{cudnn}-python{python}'
+            if not os.path.exists(os.path.join(cache_dir, f)):
+                # No entry, leave it to activate.sh to resolve and warn
+                continue
+        if f != '' and not os.path.exists(os.path.join(cache_dir, f)):
+            # activate.sh warns about missing ld.so.cache
+            f = ''
+        envs[f'python{python}-cuda{cuda}-cudnn{cudnn}'] = {
+            'MONOBASE_GEN_ID': str(mg.id),
+            'MONOBASE_PATH': f'$MONOBASE_PREFIX/monobase/{gid}',
+            'CUDA_HOME': f'$MONOBASE_PATH/cuda{cuda}',
+            'CUDNN_HOME': f'$MONOBASE_PATH/cudnn{cudnn}-cuda{cuda_major}',
+            'LD_CACHE_PATH': '' if f == '' else f'$MONOBASE_PATH/ld.so.cache.d/{f}',
+            'TORCH_CUDA_SUFFIX': cuda_suffix(cuda),
+        }
+    write_env_dir(os.path.join(gdir, ENV_DIR), envs)
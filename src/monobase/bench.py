@@ -0,0 +1,491 @@
+import argparse
+import base64
+import contextlib
+import glob
+import hashlib
+import json
+import logging
+import os
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Any, Callable, Iterator, Optional
+
+from monobase.activation import write_cog_env, write_generation_env
+from monobase.cuda import link_cuda, link_cudnn
+from monobase.dedup import object_store
+from monobase.monogen import MonoGen
+from monobase.optimize import optimize_dedup, optimize_ld_cache
+from monobase.torch import torch_deps_dict
+from monobase.user import build_user_venv
+from monobase.util import HERE, mark_done, setup_logging
+from monobase.uv import install_venv, venv_name
+
+log = logging.getLogger(__name__)
+
+# Fake CUDA & CuDNN versions, never downloaded since tarballs are in cache
+CUDA_VERSION = '12.4.1_000.00.00'
+CUDA_KEY = '12.4'
+CUDNN_VERSION = '9.1.0.70'
+CUDNN_KEY = '9'
+CUDA_MAJOR = '12'
+# Real ELF libraries from the host, so that ldconfig does real work
+HOST_LIB_DIRS = ['/usr/lib/x86_64-linux-gnu', '/lib/x86_64-linux-gnu', '/usr/lib64']
+
+parser = argparse.ArgumentParser(description='Benchmark monobase hot paths offline')
+parser.add_argument(
+    '--workdir',
+    metavar='PATH',
+    help='work directory for fake prefix, cache & index, default=temporary',
+)
+parser.add_argument(
+    '--repeat',
+    metavar='N',
+    type=int,
+    default=3,
+    help='runs per benchmark, default=3',
+)
+parser.add_argument(
+    '--packages',
+    metavar='N',
+    type=int,
+    default=20,
+    help='fake packages in the fake index, default=20',
+)
+parser.add_argument(
+    '--payload-mib',
+    metavar='N',
+    type=int,
+    default=4,
+    help='payload of each fake package & library, default=4',
+)
+parser.add_argument(
+    '--benchmarks',
+    metavar='NAME',
+    nargs='+',
+    help='benchmarks to run, default=all',
+)
+parser.add_argument(
+    '--output',
+    metavar='FILE',
+    help='write results as JSON, default=stdout',
+)
+parser.add_argument(
+    '--baseline',
+    metavar='FILE',
+    help='compare against results of a previous run',
+)
+parser.add_argument(
+    '--threshold',
+    metavar='RATIO',
+    type=float,
+    default=1.2,
+    help='fail if any median is slower than baseline by this ratio, default=1.2',
+)
+
+
+def payload(size: int, seed: int) -> bytes:
+    # Half random, half zeros, roughly as compressible as real libraries
+    half = size // 2
+    return random.Random(seed).randbytes(half) + bytes(size - half)
+
+
+def record_hash(data: bytes) -> str:
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b'=')
+    return f'sha256={digest.decode("ascii")}'
+
+
+def fake_wheel(wdir: str, name: str, version: str, size: int, seed: int) -> None:
+    dist = f'{name}-{version}'
+    files = {
+        f'{name}/__init__.py': f'__version__ = {version!r}\n'.encode('utf-8'),
+        f'{name}/data.bin': payload(size, seed),
+        f'{dist}.dist-info/METADATA': (
+            f'Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n'
+        ).encode('utf-8'),
+        f'{dist}.dist-info/WHEEL': (
+            b'Wheel-Version: 1.0\nGenerator: monobase.bench\n'
+            b'Root-Is-Purelib: true\nTag: py3-none-any\n'
+        ),
+    }
+    record = [f'{p},{record_hash(d)},{len(d)}' for p, d in files.items()]
+    record.append(f'{dist}.dist-info/RECORD,,')
+    files[f'{dist}.dist-info/RECORD'] = '\n'.join(record).encode('utf-8') + b'\n'
+    with zipfile.ZipFile(os.path.join(wdir, f'{dist}-py3-none-any.whl'), 'w') as z:
+        for p, d in files.items():
+            z.writestr(p, d)
+
+
+def fake_uv(path: str, uv: str, wheels: str) -> None:
+    # Wrapper that swaps PyPI & Torch indexes for the local fake index
+    script = f"""#!{sys.executable}
+import os
+import sys
+
+argv = sys.argv[1:]
+if argv[:1] == ['pip'] and argv[1:2] in (['install'], ['compile']):
+    args = []
+    skip = False
+    for a in argv:
+        if skip:
+            skip = False
+        elif a in ('--index-url', '--extra-index-url', '--index-strategy'):
+            skip = True
+        else:
+            args.append(a)
+    argv = args + ['--no-index', '--find-links', {wheels!r}]
+os.execv({uv!r}, [{uv!r}] + argv)
+"""
+    with open(path, 'w') as f:
+        f.write(script)
+    os.chmod(path, 0o755)
+
+
+def fake_tarball(tf: str, libdir: str, libs: list[str], size: int, seed: int) -> None:
+    # Host libraries plus incompressible-ish padding, packed like tar_and_delete
+    with tempfile.TemporaryDirectory() as tmp:
+        lib = os.path.join(tmp, libdir)
+        os.makedirs(lib)
+        for src in libs:
+            shutil.copy(src, lib)
+        for i in range(4):
+            with open(os.path.join(lib, f'libmonobase_bench{i}.a'), 'wb') as f:
+                f.write(payload(size, seed + i))
+        os.makedirs(os.path.dirname(tf), exist_ok=True)
+        cmd = ['tar', '--zstd', '-cf', tf, '-C', tmp, '.']
+        subprocess.run(cmd, check=True)
+
+
+def host_libs(n: int) -> list[str]:
+    libs: list[str] = []
+    for d in HOST_LIB_DIRS:
+        for p in sorted(glob.glob(os.path.join(d, 'lib*.so.*'))):
+            if os.path.isfile(p) and not os.path.islink(p):
+                libs.append(p)
+    return libs[:n]
+
+
+class Fixture:
+    def __init__(self, args: argparse.Namespace, workdir: str) -> None:
+        self.workdir = workdir
+        self.prefix = os.path.join(workdir, 'prefix')
+        self.cache = os.path.join(workdir, 'cache')
+        self.wheels = os.path.join(workdir, 'wheels')
+        self.rdir = os.path.join(workdir, 'requirements')
+        self.uv = shutil.which('uv')
+        self.python_version = f'{sys.version_info.major}.{sys.version_info.minor}'
+        self.python_full_version = platform.python_version()
+        self.torch_version = None
+        for t in torch_deps_dict.keys():
+            if venv_name(self.python_version, t, 'cpu') is not None:
+                self.torch_version = t
+                break
+        self.gdir = os.path.join(self.prefix, 'monobase', 'g00000')
+        self.mg = MonoGen(
+            id=0,
+            cuda={CUDA_KEY: CUDA_VERSION},
+            cudnn={CUDNN_KEY: CUDNN_VERSION},
+            python={self.python_version: self.python_full_version},
+            torch=[] if self.torch_version is None else [self.torch_version],
+            pip_pkgs=[],
+        )
+        self.build_args = argparse.Namespace(
+            prefix=self.prefix,
+            cache=self.cache,
+            stream_tarballs=False,
+            keep_tarballs=False,
+        )
+        self.packages = args.packages
+        self.size = args.payload_mib * 1024 * 1024
+
+    def setup(self) -> None:
+        log.info(f'Creating fixture in {self.workdir}...')
+        os.makedirs(os.path.join(self.prefix, 'bin'), exist_ok=True)
+        os.makedirs(self.gdir, exist_ok=True)
+        os.makedirs(self.rdir, exist_ok=True)
+
+        os.makedirs(self.wheels, exist_ok=True)
+        for i in range(self.packages):
+            fake_wheel(self.wheels, f'monobase_bench{i}', '1.0.0', self.size, i)
+        if self.uv is not None:
+            fake_uv(os.path.join(self.prefix, 'bin', 'uv'), self.uv, self.wheels)
+        if self.torch_version is not None:
+            venv = venv_name(self.python_version, self.torch_version, 'cpu')
+            with open(os.path.join(self.rdir, f'{venv}.txt'), 'w') as f:
+                for i in range(self.packages // 2):
+                    print(f'monobase-bench{i}==1.0.0', file=f)
+
+        libs = host_libs(64)
+        cuda_tf = os.path.join(
+            self.cache, 'cuda', f'monobase-cuda-{CUDA_VERSION}.tar.zst'
+        )
+        fake_tarball(cuda_tf, 'lib64', libs[::2], self.size, 1000)
+        key = f'{CUDNN_VERSION}-cuda{CUDA_MAJOR}'
+        cudnn_tf = os.path.join(self.cache, 'cudnn', f'monobase-cudnn-{key}.tar.zst')
+        fake_tarball(cudnn_tf, 'lib', libs[1::2], self.size, 2000)
+        link_cudnn(self.build_args, self.gdir, CUDNN_KEY, CUDNN_VERSION, CUDA_MAJOR)
+
+        # Python lib dir for ld.so.cache
+        pdir = os.path.join(
+            self.prefix,
+            'uv',
+            'python',
+            f'cpython-{self.python_full_version}-linux-x86_64-gnu',
+            'lib',
+        )
+        os.makedirs(pdir, exist_ok=True)
+
+        # Cog generation with a default venv for activate.sh & monobase.user
+        cdir = os.path.join(self.prefix, 'cog', 'g00000000')
+        vdir = os.path.join(cdir, f'cog0.0.0-python{self.python_version}')
+        if self.uv is not None:
+            uv = os.path.join(self.prefix, 'bin', 'uv')
+            cmd = [uv, 'venv', '--python', self.python_full_version, vdir]
+            subprocess.run(cmd, check=True)
+            env = os.environ.copy()
+            env['VIRTUAL_ENV'] = vdir
+            cmd = [uv, 'pip', 'install', 'monobase-bench0==1.0.0']
+            subprocess.run(cmd, check=True, env=env)
+        else:
+            os.makedirs(
+                os.path.join(
+                    vdir, 'lib', f'python{self.python_version}', 'site-packages'
+                )
+            )
+        os.symlink(
+            os.path.basename(vdir),
+            os.path.join(cdir, f'default-python{self.python_version}'),
+        )
+        write_cog_env(cdir)
+        write_generation_env(self.gdir, self.mg)
+        mark_done(cdir, kind='cog', id='g00000000')
+        os.symlink('g00000000', os.path.join(self.prefix, 'cog', 'latest'))
+        os.symlink('g00000', os.path.join(self.prefix, 'monobase', 'latest'))
+
+        with open(os.path.join(self.workdir, 'requirements-user.txt'), 'w') as f:
+            for i in range(self.packages // 2, self.packages):
+                print(f'monobase-bench{i}', file=f)
+
+    @contextlib.contextmanager
+    def environ(self, **env: str) -> Iterator[None]:
+        old = os.environ.copy()
+        os.environ['PATH'] = f'{self.prefix}/bin:{old.get("PATH", "")}'
+        os.environ['UV_CACHE_DIR'] = os.path.join(self.prefix, 'uv', 'cache')
+        os.environ.update(env)
+        try:
+            yield
+        finally:
+            os.environ.clear()
+            os.environ.update(old)
+
+    def venv(self) -> str:
+        assert self.torch_version is not None
+        venv = venv_name(self.python_version, self.torch_version, 'cpu')
+        assert venv is not None
+        return os.path.join(self.gdir, venv)
+
+    def reset_cuda(self) -> None:
+        cdir = os.path.join(self.prefix, 'cuda', f'cuda-{CUDA_VERSION}')
+        shutil.rmtree(cdir, ignore_errors=True)
+
+    def bench_install_cuda(self) -> None:
+        link_cuda(self.build_args, self.gdir, CUDA_KEY, CUDA_VERSION)
+
+    def reset_ld_cache(self) -> None:
+        shutil.rmtree(os.path.join(self.gdir, 'ld.so.cache.d'), ignore_errors=True)
+
+    def bench_optimize_ld_cache(self) -> None:
+        optimize_ld_cache(self.build_args, self.gdir, self.mg)
+
+    def bench_optimize_ld_cache_unchanged(self) -> None:
+        optimize_ld_cache(self.build_args, self.gdir, self.mg)
+
+    def reset_dedup(self) -> None:
+        # Forget known digests too so that every file is hashed again
+        object_store(self.prefix).index.clear()
+        shutil.rmtree(os.path.join(self.prefix, 'objects'), ignore_errors=True)
+
+    def bench_optimize_dedup(self) -> None:
+        optimize_dedup(self.build_args, self.gdir, self.mg)
+
+    def reset_venv(self) -> None:
+        shutil.rmtree(self.venv(), ignore_errors=True)
+
+    def bench_install_venv(self) -> None:
+        assert self.torch_version is not None
+        with self.environ():
+            install_venv(
+                self.build_args,
+                self.rdir,
+                self.gdir,
+                self.python_version,
+                self.python_full_version,
+                self.torch_version,
+                'cpu',
+            )
+
+    def reset_user_venv(self) -> None:
+        shutil.rmtree(os.path.join(self.workdir, 'user', '.venv'), ignore_errors=True)
+
+    def bench_build_user_venv(self) -> None:
+        assert self.torch_version is not None
+        if not os.path.exists(self.venv()):
+            self.bench_install_venv()
+        args = argparse.Namespace(
+            prefix=self.prefix,
+            venv=os.path.join(self.workdir, 'user', '.venv'),
+            requirements=os.path.join(self.workdir, 'requirements-user.txt'),
+            override=None,
+        )
+        env = {
+            'R8_PYTHON_VERSION': self.python_version,
+            'R8_TORCH_VERSION': self.torch_version,
+        }
+        with self.environ(**env):
+            build_user_venv(args)
+
+    def bench_activate(self) -> None:
+        # CPU only, with CUDA activate.sh would replace /etc/ld.so.cache of the host
+        env = os.environ.copy()
+        env['MONOBASE_PREFIX'] = self.prefix
+        env['R8_PYTHON_VERSION'] = self.python_version
+        if self.torch_version is not None:
+            env['R8_TORCH_VERSION'] = self.torch_version
+        for k in ['R8_COG_VERSION', 'R8_CUDA_VERSION', 'R8_CUDNN_VERSION']:
+            env.pop(k, None)
+        env['VERBOSE'] = '0'
+        activate = os.path.join(HERE, 'activate.sh')
+        cmd = ['sh', '-c', '. "$1"', 'sh', activate]
+        subprocess.run(cmd, check=True, env=env, stdout=subprocess.DEVNULL)
+
+
+def benchmarks(f: Fixture) -> dict[str, tuple[Callable[[], None], Callable[[], None]]]:
+    # Name -> (reset, run), reset is not timed
+    def noop() -> None:
+        pass
+
+    return {
+        'install_cuda': (f.reset_cuda, f.bench_install_cuda),
+        'optimize_ld_cache': (f.reset_ld_cache, f.bench_optimize_ld_cache),
+        'optimize_ld_cache_unchanged': (noop, f.bench_optimize_ld_cache_unchanged),
+        'optimize_dedup': (f.reset_dedup, f.bench_optimize_dedup),
+        'install_venv': (f.reset_venv, f.bench_install_venv),
+        'build_user_venv': (f.reset_user_venv, f.bench_build_user_venv),
+        'activate': (noop, f.bench_activate),
+    }
+
+
+def skip_reason(f: Fixture, name: str) -> Optional[str]:
+    if name in {'install_venv', 'build_user_venv'}:
+        if f.uv is None:
+            return 'uv not found'
+        if f.torch_version is None:
+            return f'no Torch for Python {f.python_version}'
+    if name.startswith('optimize_ld_cache') and shutil.which('ldconfig') is None:
+        return 'ldconfig not found'
+    return None
+
+
+def run(args: argparse.Namespace, workdir: str) -> dict[str, Any]:
+    f = Fixture(args, workdir)
+    f.setup()
+    all_benchmarks = benchmarks(f)
+    names = args.benchmarks or list(all_benchmarks.keys())
+    for name in names:
+        assert name in all_benchmarks, f'Unknown benchmark {name}'
+
+    results: dict[str, Any] = {}
+    skipped: dict[str, str] = {}
+    for name in names:
+        reason = skip_reason(f, name)
+        if reason is not None:
+            log.warning(f'Skipping {name}: {reason}')
+            skipped[name] = reason
+            continue
+        reset, fn = all_benchmarks[name]
+        runs = []
+        # One untimed warm up, e.g. for OS page cache and uv cache
+        for i in range(args.repeat + 1):
+            reset()
+            start = time.perf_counter()
+            fn()
+            if i > 0:
+                runs.append(time.perf_counter() - start)
+        results[name] = {
+            'runs': runs,
+            'min': min(runs),
+            'median': statistics.median(runs),
+            'mean': statistics.mean(runs),
+        }
+        log.info(f'{name}: median {results[name]["median"]:.3f}s')
+
+    uv_version = None
+    if f.uv is not None:
+        cmd = [f.uv, '--version']
+        uv_version = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    return {
+        'python_version': f.python_full_version,
+        'uv_version': None if uv_version is None else uv_version.stdout.strip(),
+        'packages': args.packages,
+        'payload_mib': args.payload_mib,
+        'repeat': args.repeat,
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def compare(
+    results: dict[str, Any], baseline: dict[str, Any], threshold: float
+) -> list[str]:
+    regressions = []
+    print('\t'.join(['BENCHMARK', 'BASELINE', 'CURRENT', 'RATIO']))
+    for name, r in sorted(results['results'].items()):
+        b = baseline['results'].get(name)
+        if b is None:
+            print('\t'.join([name, '-', f'{r["median"]:.3f}s', '-']))
+            continue
+        ratio = r['median'] / b['median'] if b['median'] > 0 else float('inf')
+        print(
+            '\t'.join(
+                [name, f'{b["median"]:.3f}s', f'{r["median"]:.3f}s', f'{ratio:.2f}']
+            )
+        )
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def bench(args: argparse.Namespace) -> None:
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory(prefix='monobase-bench-') as workdir:
+            results = run(args, workdir)
+    else:
+        assert not os.path.exists(args.workdir), f'{args.workdir} already exists'
+        results = run(args, args.workdir)
+
+    if args.output is None:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            log.error(f'Slower than baseline by over {args.threshold}x: {regressions}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    bench(parser.parse_args())
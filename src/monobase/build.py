@@ -6,11 +6,35 @@ import os
 import os.path
 import re
 
+from monobase.activation import write_generation_env
 from monobase.cog import install_cogs
-from monobase.cuda import install_cuda, install_cudnn
+from monobase.cuda import fetch_cuda, fetch_cudnn, link_cuda, link_cudnn, tarball_path
+from monobase.dedup import object_store
+from monobase.disk import log_disk_usage, parse_size
+from monobase.imports import install_sitecustomize
+from monobase.jobs import Job, add_job_arguments, run_jobs
 from monobase.monogen import MONOGENS, MonoGen
-from monobase.optimize import optimize_ld_cache, optimize_rdfind
-from monobase.prune import clean_uv_cache, prune_cuda, prune_old_gen, prune_uv_cache
+from monobase.optimize import (
+    optimize_dedup,
+    optimize_import_index,
+    optimize_ld_cache,
+)
+from monobase.plan import Planner, print_plan
+from monobase.prune import (
+    clean_uv_cache,
+    prune_cuda,
+    prune_objects,
+    prune_old_gen,
+    prune_to_budget,
+    prune_uv_cache,
+)
+from monobase.telemetry import add_trace_arguments, export_spans, setup_tracing, span
+from monobase.usage import (
+    add_usage_arguments,
+    compact_access_log,
+    setup_usage_dir,
+    usage_dir,
+)
 from monobase.util import (
     HERE,
     IN_KUBERNETES,
@@ -19,17 +43,19 @@ from monobase.util import (
     add_arguments,
     desc_version,
     desc_version_key,
-    du,
+    is_done,
     mark_done,
-    require_done_or_rm,
     setup_logging,
 )
-from monobase.uv import install_venv
+from monobase.uv import install_venv, venv_name
 
 log = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(description='Build monobase environment')
 add_arguments(parser)
+add_job_arguments(parser)
+add_trace_arguments(parser)
+add_usage_arguments(parser)
 parser.add_argument(
     '--prefix',
     metavar='PATH',
@@ -66,6 +92,31 @@ parser.add_argument(
     action='store_true',
     help='Skip CUDA and CUDA Torch venvs, e.g. on CPU nodes',
 )
+parser.add_argument(
+    '--plan',
+    default=False,
+    action='store_true',
+    help='Print build steps with estimated download and disk usage, then exit, '
+    'reads but never refreshes cached matrix.json',
+)
+parser.add_argument(
+    '--offline',
+    default=False,
+    action='store_true',
+    help='Use cached matrix.json in cache without network access',
+)
+parser.add_argument(
+    '--stream-tarballs',
+    default=False,
+    action='store_true',
+    help='Stream CUDA & CuDNN tarballs into prefix instead of downloading to cache',
+)
+parser.add_argument(
+    '--keep-tarballs',
+    default=False,
+    action='store_true',
+    help='Also save streamed tarballs in cache',
+)
 
 parser.add_argument(
     '--prune-old-gen',
@@ -85,6 +136,20 @@ parser.add_argument(
     action='store_true',
     help='prune uv cache',
 )
+parser.add_argument(
+    '--disk-budget',
+    metavar='SIZE',
+    type=parse_size,
+    help='evict generations, venvs and uv cache until prefix fits, e.g. 500G',
+)
+parser.add_argument(
+    '--gc-policy',
+    choices=['priority', 'lru'],
+    default='priority',
+    help='eviction order for --disk-budget, '
+    'priority: inactive generations, uv cache, then venvs least recently used first, '
+    'lru: least recently used first, default=priority',
+)
 parser.add_argument(
     '--clean-uv-cache',
     default=False,
@@ -104,16 +169,9 @@ parser.add_argument(
 )
 
 
-def build_generation(args: argparse.Namespace, mg: MonoGen) -> None:
-    gdir = os.path.join(args.prefix, 'monobase', f'g{mg.id:05d}')
-
-    if require_done_or_rm(gdir):
-        log.info(f'Monobase generation {mg.id} is complete')
-        return
-
-    log.info(f'Building monobase generation {mg.id}...')
-    os.makedirs(gdir, exist_ok=True)
-
+def generation_jobs(
+    args: argparse.Namespace, mg: MonoGen, gdir: str, rdir: str
+) -> list[Job]:
     cudas, cudnns = mg.cuda, mg.cudnn
     if args.no_cuda:
         cudas = {}
@@ -121,31 +179,40 @@ def build_generation(args: argparse.Namespace, mg: MonoGen) -> None:
     # CUDA & CuDNN must both be set or empty i.e. no CUDA/CuDNN
     assert (len(cudas) == 0) == (len(cudnns) == 0)
 
-    for k, v in desc_version_key(cudas):
-        src = install_cuda(args, v)
-        dst = f'{gdir}/cuda{k}'
-        reldst = os.path.relpath(src, gdir)
-        if os.path.exists(dst):
-            os.remove(dst)
-        os.symlink(reldst, dst)
-        log.info(f'CUDA symlinked in {dst}')
-
+    jobs = []
     cuda_major_p = re.compile(r'\.\d+$')
     cuda_majors = set(cuda_major_p.sub('', k) for k in cudas.keys())
-    for (k, v), m in itertools.product(
-        desc_version_key(cudnns), desc_version(cuda_majors)
-    ):
+    cudnn_cudas = list(
+        itertools.product(desc_version_key(cudnns), desc_version(cuda_majors))
+    )
+    # Downloads first, so that they start as early as possible
+    # Chained one after another since pget runs one instance at a time anyway
+    fetches: list[Job] = []
+    for k, v in desc_version_key(cudas):
+        deps = tuple(j.name for j in fetches[-1:])
+        tf = tarball_path(args, 'cuda', v)
+        fetches.append(
+            Job(f'fetch-cuda{k}', fetch_cuda, (args, v), deps=deps, target=tf)
+        )
+    for (k, v), m in cudnn_cudas:
         assert m is not None
-        src = install_cudnn(args, v, m)
-        dst = f'{gdir}/cudnn{k}-cuda{m}'
-        reldst = os.path.relpath(src, gdir)
-        if os.path.exists(dst):
-            os.remove(dst)
-        os.symlink(reldst, dst)
-        log.info(f'CuDNN symlinked in {dst}')
-
-    suffix = '' if args.environment == 'prod' else f'-{args.environment}'
-    rdir = os.path.join(HERE, f'requirements{suffix}', f'g{mg.id:05d}')
+        deps = tuple(j.name for j in fetches[-1:])
+        tf = tarball_path(args, 'cudnn', f'{v}-cuda{m}')
+        name = f'fetch-cudnn{k}-cuda{m}'
+        fetches.append(Job(name, fetch_cudnn, (args, v, m), deps=deps, target=tf))
+    jobs += fetches
+    # Extract as soon as the corresponding download is done
+    for k, v in desc_version_key(cudas):
+        name = f'cuda{k}'
+        cdir = os.path.join(args.prefix, 'cuda', f'cuda-{v}')
+        a: tuple = (args, gdir, k, v)
+        jobs.append(Job(name, link_cuda, a, deps=(f'fetch-{name}',), target=cdir))
+    for (k, v), m in cudnn_cudas:
+        assert m is not None
+        name = f'cudnn{k}-cuda{m}'
+        cdir = os.path.join(args.prefix, 'cuda', f'cudnn-{v}-cuda{m}')
+        a = (args, gdir, k, v, m)
+        jobs.append(Job(name, link_cudnn, a, deps=(f'fetch-{name}',), target=cdir))
 
     cuda_versions = desc_version(cudas.keys())
     if args.mini:
@@ -159,24 +226,145 @@ def build_generation(args: argparse.Namespace, mg: MonoGen) -> None:
         # GPU node, install both GPU & CPU Torch
         cuda_versions = ['cpu'] + cuda_versions
 
+    # Venvs do not depend on CUDA or CuDNN and run alongside them
     for (p, pf), t, c in itertools.product(
         desc_version_key(mg.python),
         desc_version(mg.torch),
         cuda_versions,
     ):
         assert c is not None
-        install_venv(args, rdir, gdir, p, pf, t, c)
+        venv = venv_name(p, t, c)
+        if venv is None:
+            continue
+        vdir = os.path.join(gdir, venv)
+        a = (args, rdir, gdir, p, pf, t, c)
+        jobs.append(Job(venv, install_venv, a, target=vdir))
+    return jobs
+
 
+def requirements_dir(args: argparse.Namespace, mg: MonoGen) -> str:
+    suffix = '' if args.environment == 'prod' else f'-{args.environment}'
+    return os.path.join(HERE, f'requirements{suffix}', f'g{mg.id:05d}')
+
+
+def build_generation(args: argparse.Namespace, mg: MonoGen) -> None:
+    gdir = os.path.join(args.prefix, 'monobase', f'g{mg.id:05d}')
+
+    # Do not wipe an incomplete generation
+    # Venvs are marked done individually and only missing ones are rebuilt
+    if is_done(gdir):
+        log.info(f'Monobase generation {mg.id} is complete')
+        return
+
+    log.info(f'Building monobase generation {mg.id}...')
+    os.makedirs(gdir, exist_ok=True)
+    # Venvs, CUDA and CuDNN are deduplicated as they are installed
+    store = object_store(args.prefix)
+    reclaimed_start = store.reclaimed
+
+    jobs = generation_jobs(args, mg, gdir, requirements_dir(args, mg))
+    run_jobs(jobs, args.jobs, args.keep_going)
+
+    # Barriers, these need all CUDA, CuDNN and venvs in place
     optimize_ld_cache(args, gdir, mg)
-    optimize_rdfind(args, gdir, mg)
+    optimize_dedup(args, gdir, mg)
+    optimize_import_index(args, gdir, mg)
+    reclaimed = store.reclaimed - reclaimed_start
+    log.info(
+        f'Generation {mg.id} deduplicated, reclaimed {reclaimed / 1024 / 1024:.1f} MiB'
+    )
 
-    mark_done(gdir, kind='monogen', **mg.otel_attributes)
+    mark_done(
+        gdir, kind='monogen', dedup_reclaimed_bytes=reclaimed, **mg.otel_attributes
+    )
     log.info(f'Generation {mg.id} installed in {gdir}')
 
 
-def build(args: argparse.Namespace) -> None:
+def install(
+    args: argparse.Namespace, monogens: list[MonoGen], python_versions: list[str]
+) -> None:
     start_time = datetime.datetime.now(datetime.UTC)
 
+    if args.clean_uv_cache:
+        clean_uv_cache()
+
+    with span('cog.generation'):
+        install_cogs(args, python_versions)
+
+    gens = []
+    for i, mg in enumerate(monogens):
+        if mg.id < args.min_gen_id or mg.id > args.max_gen_id:
+            continue
+        with span('generation', id=mg.id):
+            build_generation(args, mg)
+            # Also for complete generations built before the index existed
+            gdir = os.path.join(args.prefix, 'monobase', f'g{mg.id:05d}')
+            write_generation_env(gdir, mg)
+            install_sitecustomize(gdir)
+        gens.append(mg.id)
+
+        if i == 0:
+            latest = os.path.join(args.prefix, 'monobase', 'latest')
+
+            if os.path.exists(latest):
+                os.remove(latest)
+
+            os.symlink(f'g{mg.id:05d}', latest)
+
+            if args.write_node_feature_discovery_labels:
+                done = datetime.datetime.now(datetime.UTC).strftime('%Y%m%dT%H%M%SZ')
+
+                with open(NODE_FEATURE_LABEL_FILE, 'w') as fp:
+                    fp.write(f'done={done}\n')
+
+                os.chmod(NODE_FEATURE_LABEL_FILE, 0o644)
+
+                log.info(f'Wrote done={done} to {NODE_FEATURE_LABEL_FILE}')
+
+    if args.prune_old_gen:
+        with span('prune.old_gen'):
+            prune_old_gen(args)
+
+    if args.prune_cuda:
+        with span('prune.cuda'):
+            prune_cuda(args)
+
+    if args.prune_uv_cache:
+        with span('prune.uv_cache'):
+            prune_uv_cache()
+
+    # Access log from activate.sh, for --disk-budget and monobase.usage
+    setup_usage_dir(usage_dir(args))
+    compact_access_log(args.prefix, usage_dir(args))
+
+    # Objects no longer linked by anything, e.g. after pruning above
+    with span('prune.objects'):
+        prune_objects(args)
+
+    if args.disk_budget is not None:
+        with span('prune.budget'):
+            prune_to_budget(args)
+
+    log.info(f'Calculating disk usage in {args.prefix}...')
+    with span('du'):
+        usage = log_disk_usage(args.prefix)
+
+    duration = datetime.datetime.now(datetime.UTC) - start_time
+    log.info(
+        f'Monobase build completed: generations={sorted(gens)} duration={duration}'
+    )
+
+    mark_done(
+        args.all_done_dir,
+        kind='build',
+        duration=str(duration),
+        gens=gens,
+        disk_bytes=usage.total,
+    )
+
+
+def build(args: argparse.Namespace) -> None:
+
     monogens = sorted(MONOGENS[args.environment], reverse=True)
     if args.mini:
         mg = monogens[0]
@@ -230,11 +418,6 @@ def build(args: argparse.Namespace) -> None:
         f'Default Cog {args.default_cog_version} not in {args.cog_versions}'
     )
 
-    os.makedirs(args.cache, exist_ok=True)
-
-    if args.clean_uv_cache:
-        clean_uv_cache()
-
     # Find latest full version of each Python major.minor
     pvs: dict[str, Version] = {}
     for mg in monogens:
@@ -242,51 +425,27 @@ def build(args: argparse.Namespace) -> None:
             v = Version.parse(vs)
             if k not in pvs or pvs[k] < v:
                 pvs[k] = v
-    install_cogs(args, list(map(str, pvs.values())))
 
-    gens = []
-    for i, mg in enumerate(monogens):
-        if mg.id < args.min_gen_id or mg.id > args.max_gen_id:
-            continue
-        build_generation(args, mg)
-        gens.append(mg.id)
-
-        if i == 0:
-            latest = os.path.join(args.prefix, 'monobase', 'latest')
-
-            if os.path.exists(latest):
-                os.remove(latest)
-
-            os.symlink(f'g{mg.id:05d}', latest)
-
-            if args.write_node_feature_discovery_labels:
-                done = datetime.datetime.now(datetime.UTC).strftime('%Y%m%dT%H%M%SZ')
-
-                with open(NODE_FEATURE_LABEL_FILE, 'w') as fp:
-                    fp.write(f'done={done}\n')
-
-                os.chmod(NODE_FEATURE_LABEL_FILE, 0o644)
-
-                log.info(f'Wrote done={done} to {NODE_FEATURE_LABEL_FILE}')
-
-    if args.prune_old_gen:
-        prune_old_gen(args)
-
-    if args.prune_cuda:
-        prune_cuda(args)
-
-    if args.prune_uv_cache:
-        prune_uv_cache()
-
-    log.info(f'Calculating disk usage in {args.prefix}...')
-    du(args.prefix)
-
-    duration = datetime.datetime.now(datetime.UTC) - start_time
-    log.info(
-        f'Monobase build completed: generations={sorted(gens)} duration={duration}'
-    )
+    if args.plan:
+        planner = Planner(args)
+        steps = planner.cogs(list(map(str, pvs.values())))
+        for mg in monogens:
+            if mg.id < args.min_gen_id or mg.id > args.max_gen_id:
+                continue
+            gdir = os.path.join(args.prefix, 'monobase', f'g{mg.id:05d}')
+            rdir = requirements_dir(args, mg)
+            jobs = generation_jobs(args, mg, gdir, rdir)
+            steps += planner.generation(mg, gdir, rdir, jobs)
+        print_plan(steps)
+        return
 
-    mark_done(args.all_done_dir, kind='build', duration=str(duration), gens=gens)
+    os.makedirs(args.cache, exist_ok=True)
+    setup_tracing(args)
+    try:
+        with span('build'):
+            install(args, monogens, list(map(str, pvs.values())))
+    finally:
+        export_spans()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import os.path
+from typing import Optional
+
+from monobase.dedup import OBJECTS_DIR, hash_file
+from monobase.telemetry import run, span
+from monobase.util import cpu_pool
+
+log = logging.getLogger(__name__)
+
+# Compiled .pyc by cache tag, source path relative to site-packages and digest
+# i.e. {prefix}/objects/pyc/cpython-312/<xx>/<key>.pyc, hard linked into venvs
+# Pruned with other objects once no venv links them
+PYC_DIR = 'pyc'
+# Files per worker process, .pyc must be compiled by the venv's own Python
+CHUNK_SIZE = 512
+
+# Runs under the venv's Python, which may be as old as 3.8
+COMPILE_SCRIPT = """
+import json, py_compile, sys
+mode = py_compile.PycInvalidationMode[sys.argv[1]]
+failed = []
+for src, dfile, cfile in json.load(sys.stdin):
+    try:
+        py_compile.compile(src, cfile=cfile, dfile=dfile, doraise=True, invalidation_mode=mode)
+    except Exception:
+        # e.g. Python 2 test data or templates shipped as .py
+        failed.append(src)
+json.dump(failed, sys.stdout)
+"""
+
+
+def pyc_path(src: str, tag: str) -> str:
+    # Same as importlib.util.cache_from_source
+    d, name = os.path.split(src)
+    return os.path.join(d, '__pycache__', f'{name.removesuffix(".py")}.{tag}.pyc')
+
+
+def link_atomic(src: str, dst: str) -> None:
+    tmp = f'{dst}.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+
+def run_compile(python: str, mode: str, tasks: list[tuple[str, str, str]]) -> list[str]:
+    cmd = [python, '-c', COMPILE_SCRIPT, mode]
+    env = os.environ.copy()
+    # Do not pick up Cog or monobase layers, e.g. when building the user venv
+    env.pop('PYTHONPATH', None)
+    proc = run(cmd, env=env, input=json.dumps(tasks), capture_output=True)
+    return json.loads(proc.stdout)
+
+
+def compile_bytecode(
+    vdir: str,
+    python_version: str,
+    prefix: Optional[str] = None,
+) -> None:
+    # Without prefix, compile in place as timestamp .pyc, e.g. user venv
+    # With prefix, share unchecked hash .pyc of identical sources across venvs
+    # Venvs in prefix are immutable and possibly read-only at runtime
+    sp = os.path.join(vdir, 'lib', f'python{python_version}', 'site-packages')
+    tag = f'cpython-{python_version.replace(".", "")}'
+    sources = []
+    for root, dirs, names in os.walk(sp):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        sources += [os.path.join(root, n) for n in names if n.endswith('.py')]
+
+    python = os.path.join(vdir, 'bin', 'python')
+    with span('venv.bytecode', venv=os.path.basename(vdir)) as s:
+        if prefix is None:
+            tasks = [(src, src, pyc_path(src, tag)) for src in sources]
+            mode = 'TIMESTAMP'
+        else:
+            store = os.path.join(prefix, OBJECTS_DIR, PYC_DIR, tag)
+            # Key on path too since co_filename is relative to site-packages
+            # Imports fix co_filename up to the actual path
+            digests = list(cpu_pool().map(hash_file, sources))
+            objects = {}
+            for src, digest in zip(sources, digests):
+                rel = os.path.relpath(src, sp)
+                key = hashlib.sha256(f'{rel}\0{digest}'.encode('utf-8')).hexdigest()
+                objects[src] = (rel, os.path.join(store, key[:2], f'{key}.pyc'))
+            tasks = [
+                (src, rel, obj)
+                for src, (rel, obj) in objects.items()
+                if not os.path.exists(obj)
+            ]
+            mode = 'UNCHECKED_HASH'
+
+        chunks = [tasks[i : i + CHUNK_SIZE] for i in range(0, len(tasks), CHUNK_SIZE)]
+        # Run in copies of the current context so that compilers count towards the span
+        ctxs = [contextvars.copy_context() for _ in chunks]
+        log.info(f'Compiling {len(tasks)} of {len(sources)} sources in {vdir}...')
+        # Shared by concurrent jobs, at most one compiler per CPU in total
+        failed = set(
+            f
+            for fs in cpu_pool().map(
+                lambda ctx, c: ctx.run(run_compile, python, mode, c), ctxs, chunks
+            )
+            for f in fs
+        )
+        if len(failed) > 0:
+            log.warning(f'Failed to compile {len(failed)} sources in {vdir}')
+
+        if prefix is not None:
+            for src, (_, obj) in objects.items():
+                if src not in failed and os.path.exists(obj):
+                    pyc = pyc_path(src, tag)
+                    os.makedirs(os.path.dirname(pyc), exist_ok=True)
+                    link_atomic(obj, pyc)
+        s.attributes['sources'] = len(sources)
+        s.attributes['compiled'] = len(tasks) - len(failed)
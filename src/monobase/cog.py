@@ -1,17 +1,32 @@
 import argparse
 import hashlib
-import itertools
+import http.client
 import json
 import logging
 import os.path
 import re
 import shutil
 import subprocess
+import time
+import urllib.error
 import urllib.request
+from http import HTTPStatus
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
-from monobase.util import Version, mark_done, require_done_or_rm
+from monobase.activation import write_cog_env
+from monobase.imports import write_import_index
+from monobase.jobs import Job, run_jobs
+from monobase.telemetry import run, span
+from monobase.util import (
+    Version,
+    done_attributes,
+    is_done,
+    mark_done,
+    require_done_or_rm,
+    run_prefixed,
+    symlink_atomic,
+)
 
 LINK_REGEX = re.compile(r'<(?P<url>https://[^>]+)>; rel="next"')
 
@@ -20,14 +35,64 @@ log = logging.getLogger(__name__)
 # CDN for matrix.json with version & URL for custom packages, e.g. coglet, hf_transfer
 # To work around GitHub rate limit
 matrx_json_url = 'https://monobase-packages.replicate.delivery/matrix.json'
-matrix = json.loads(urllib.request.urlopen(matrx_json_url).read())
+# Reuse cached matrix.json without revalidating for this long
+MATRIX_TTL = 60 * 60
 
 
 def hash_str(s: str) -> str:
     return hashlib.sha256(s.encode('utf-8')).hexdigest()
 
 
-def get_coglet_release(part: str) -> dict[str, Any]:
+def load_matrix(cache: str, offline: bool, readonly: bool = False) -> dict[str, Any]:
+    # readonly: use cached matrix.json regardless of TTL and never write the cache
+    path = os.path.join(cache, 'matrix.json')
+    etag_path = f'{path}.etag'
+    cached = os.path.exists(path)
+    fresh = cached and time.time() - os.stat(path).st_mtime < MATRIX_TTL
+    if cached and (offline or readonly or fresh):
+        with open(path, 'r') as f:
+            return json.load(f)
+    assert not offline, f'Offline mode without cached {path}'
+
+    req = urllib.request.Request(matrx_json_url)
+    if cached and os.path.exists(etag_path):
+        with open(etag_path, 'r') as f:
+            req.add_header('If-None-Match', f.read().strip())
+    try:
+        resp = urllib.request.urlopen(req, timeout=10)
+        content = resp.read()
+        etag = resp.getheader('ETag')
+    except (OSError, http.client.HTTPException) as e:
+        # URLError and HTTPError are subclasses of OSError
+        # Also timeouts and truncated responses while reading the body
+        if isinstance(e, urllib.error.HTTPError) and e.code == HTTPStatus.NOT_MODIFIED:
+            log.info(f'{matrx_json_url} not modified')
+            os.utime(path)
+            with open(path, 'r') as f:
+                return json.load(f)
+        if not cached:
+            raise e
+        log.warning(f'Failed to fetch {matrx_json_url}, using cached {path}: {e}')
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    matrix = json.loads(content)
+    if readonly:
+        return matrix
+    os.makedirs(cache, exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(f'{path}.tmp', path)
+    if etag is not None:
+        with open(f'{etag_path}.tmp', 'w') as f:
+            f.write(etag)
+        os.replace(f'{etag_path}.tmp', etag_path)
+    elif os.path.exists(etag_path):
+        os.remove(etag_path)
+    return matrix
+
+
+def get_coglet_release(part: str, matrix: dict[str, Any]) -> dict[str, Any]:
     if part == 'latest':
         return matrix['latest_coglet']
     url = f'https://api.github.com/repos/replicate/cog-runtime/releases/{part}'
@@ -40,13 +105,15 @@ def cog_gen_hash(
     cog_versions: list[str],
     default_cog_version: str,
     python_versions: list[str],
+    matrix: Optional[dict[str, Any]],
 ) -> str:
     cvs = []
     for cv in cog_versions:
         # Hash actual coglet version instead of 'coglet'
         # So that new releases trigger hash change and re-install
         if cv == 'coglet':
-            v = get_coglet_release('latest')['version']
+            assert matrix is not None, 'matrix.json required for latest coglet'
+            v = get_coglet_release('latest', matrix)['version']
             cv = f'coglet=={v}'
         cvs.append(cv)
     j = {
@@ -57,24 +124,14 @@ def cog_gen_hash(
     return hash_str(json.dumps(j))
 
 
-def install_cog(
-    uv: str,
-    gdir: str,
-    cog_version: str,
-    is_default: bool,
-    python_version: str,
-    python_full_version: str,
-    extra_packages: list[str],
-) -> None:
+def cog_spec(cog_version: str, matrix: dict[str, Any]) -> Optional[tuple[str, str]]:
+    # Resolve venv name and package spec once per Cog version
+    # Instead of once per Cog * Python venv
     if cog_version.startswith('https://') or cog_version.startswith('file://'):
         h = hash_str(cog_version)[:8]
         pkg = 'coglet' if 'coglet' in cog_version else 'cog'
-        cog_name = f'{pkg}{h}'
-        spec = f'{pkg}@{cog_version}'
+        return f'{pkg}{h}', f'{pkg}@{cog_version}'
     elif cog_version.startswith('coglet'):
-        if python_version == '3.8':
-            log.warning('cog-runtime does not support Python 3.8')
-            return
         try:
             if cog_version == 'coglet':
                 v = 'latest'
@@ -84,34 +141,147 @@ def install_cog(
                 part = f'tags/v{v}'
             else:
                 log.error(f'Unsupported cog version {cog_version}')
-                return
-            cog_name = f'coglet{v}'
-            release = get_coglet_release(part)
-            spec = f'coglet@{release["url"]}'
+                return None
+            release = get_coglet_release(part, matrix)
+            return f'coglet{v}', f'coglet@{release["url"]}'
         except Exception as e:
             log.error('Failed to fetch cog-runtime assets: %s', e)
-            return
+            return None
     else:
-        cog_name = f'cog{cog_version}'
-        spec = f'cog=={cog_version}'
+        return f'cog{cog_version}', f'cog=={cog_version}'
+
+
+def is_mutable_spec(spec: str) -> bool:
+    # Content behind the URL may change, e.g. GitHub branch archives or local files
+    # Wheel URLs are versioned by file name, e.g. coglet & hf_transfer releases
+    if '@' not in spec:
+        return False
+    url = spec.split('@', 1)[1].strip()
+    return url.startswith('file://') or not url.split('?', 1)[0].endswith('.whl')
+
+
+def cog_venv_key(
+    spec: str, python_full_version: str, extra_packages: list[str]
+) -> Optional[str]:
+    # Content key of a single Cog venv, venvs with the same key are interchangeable
+    # Venvs are relocatable so that they can be hard linked across generations
+    # None if content of the spec is unknown, i.e. never reused
+    if any(is_mutable_spec(s) for s in [spec] + extra_packages):
+        return None
+    j = {
+        'spec': spec,
+        'python_full_version': python_full_version,
+        'extra_packages': extra_packages,
+        'relocatable': True,
+    }
+    return hash_str(json.dumps(j))
+
+
+def find_cog_venv(cdir: str, gdir: str, venv: str, key: Optional[str]) -> Optional[str]:
+    # An identical venv from a previous generation if there is one
+    vdir = os.path.join(gdir, venv)
+    if key is None or not os.path.isdir(cdir):
+        return None
+    for g in sorted(os.listdir(cdir)):
+        src = os.path.join(cdir, g, venv)
+        if g == 'latest' or src == vdir or not is_done(src):
+            continue
+        if done_attributes(src).get('monobase_cog_venv.key') == key:
+            return src
+    return None
 
+
+def reuse_cog(cdir: str, gdir: str, venv: str, key: Optional[str]) -> bool:
+    # Hard link an identical venv from a previous generation if there is one
+    # Previous generations are deleted later but hard links survive
+    src = find_cog_venv(cdir, gdir, venv, key)
+    if src is None:
+        return False
+    log.info(f'Reusing Cog venv {venv} from {os.path.dirname(src)}...')
+    run(['cp', '-al', src, os.path.join(gdir, venv)])
+    return True
+
+
+def resolve_cog(
+    uv: str,
+    cdir: str,
+    gdir: str,
+    spec: str,
+    extra_packages: list[str],
+    python_version: str,
+    keys: list[tuple[str, Optional[str]]],
+    requirements: str,
+) -> None:
+    # Resolve Cog and extra packages once for all Python versions of the generation
+    # Venvs install the pinned requirements instead of each resolving and
+    # refetching Cog from URLs again
+    if os.path.exists(requirements):
+        os.remove(requirements)
+    if all(find_cog_venv(cdir, gdir, venv, key) is not None for venv, key in keys):
+        # Every venv is reused, nothing to install
+        return
+    os.makedirs(os.path.dirname(requirements), exist_ok=True)
+    cmd = [uv, 'pip', 'compile', '--universal', '--python-version', python_version]
+    if '@' in spec:
+        # Always refetch Cog from URLs, e.g. GitHub branch archives
+        cmd += ['--refresh-package', spec.split('@')[0]]
+    cmd += ['-o', f'{requirements}.tmp', '-']
+    try:
+        with span('cog.resolve', spec=spec):
+            run(
+                cmd,
+                input='\n'.join([spec] + extra_packages),
+                capture_output=True,
+            )
+    except subprocess.CalledProcessError as e:
+        # e.g. no single resolution for all Python versions, venvs resolve on their own
+        log.warning(
+            f'Failed to resolve {spec} for Python>={python_version}: {e.stderr}'
+        )
+        return
+    os.replace(f'{requirements}.tmp', requirements)
+
+
+def install_cog(
+    uv: str,
+    cdir: str,
+    gdir: str,
+    cog_name: str,
+    spec: str,
+    python_version: str,
+    python_full_version: str,
+    extra_packages: list[str],
+    requirements: Optional[str] = None,
+) -> None:
     venv = f'{cog_name}-python{python_version}'
     vdir = os.path.join(gdir, venv)
-    cmd = [uv, 'venv', '--python', python_full_version, vdir]
-    subprocess.run(cmd, check=True)
+    key = cog_venv_key(spec, python_full_version, extra_packages)
+    with span('cog.reuse', venv=venv) as s:
+        s.attributes['reused'] = reuse_cog(cdir, gdir, venv, key)
+    if s.attributes['reused']:
+        # cp -al does not preserve directory mtimes
+        write_import_index(vdir, python_version)
+        return
+
+    cmd = [uv, 'venv', '--relocatable', '--python', python_full_version, vdir]
+    with span('cog.create', venv=venv):
+        run_prefixed(cmd, venv)
 
     env = os.environ.copy()
     env['VIRTUAL_ENV'] = vdir
 
-    cmd = [
-        uv,
-        'pip',
-        'install',
-        '--no-cache',
-        '--compile-bytecode',
-        spec,
-    ] + extra_packages
-    subprocess.run(cmd, check=True, env=env)
+    # Share uv cache with other venvs, uv locks it for concurrent installs
+    cmd = [uv, 'pip', 'install', '--compile-bytecode']
+    if requirements is not None and os.path.exists(requirements):
+        # Pinned by resolve_cog, which also refetched Cog from URLs
+        cmd += ['-r', requirements]
+    else:
+        # Always refetch Cog from URLs, e.g. GitHub branch archives
+        if '@' in spec:
+            cmd += ['--refresh-package', spec.split('@')[0]]
+        cmd += [spec] + extra_packages
+    with span('cog.install', venv=venv):
+        run_prefixed(cmd, venv, env=env)
 
     # Some predictor code checks for Cog version via importlib.metadata.version("cog")
     # Create cog-*.dist-info/METADATA to support this
@@ -126,31 +296,43 @@ def install_cog(
             md = md.replace('\nName: coglet\n', '\nName: cog\n')
             (dst / 'METADATA').write_text(md, encoding='utf-8')
 
-    if is_default:
-        default = os.path.join(gdir, f'default-python{python_version}')
-        if os.path.exists(default):
-            os.remove(default)
-        os.symlink(venv, default)
+    write_import_index(vdir, python_version)
+    mark_done(
+        vdir,
+        kind='cog_venv',
+        key=key,
+        spec=spec,
+        python_full_version=python_full_version,
+    )
 
 
-def install_cogs(args: argparse.Namespace, python_versions: list[str]) -> None:
-    cdir = os.path.join(args.prefix, 'cog')
-    os.makedirs(cdir, exist_ok=True)
+def needs_matrix(args: argparse.Namespace) -> bool:
+    # Latest coglet version is part of the generation ID
+    return 'coglet' in args.cog_versions
 
+
+def cog_generation_id(
+    args: argparse.Namespace,
+    python_versions: list[str],
+    matrix: Optional[dict[str, Any]],
+) -> str:
     # Consistent hash of Cog versions as generation ID
-    pvs = list(map(Version.parse, python_versions))
     cog_versions = sorted(set(args.cog_versions))
     sha256 = cog_gen_hash(
-        cog_versions, args.default_cog_version, sorted(python_versions)
+        cog_versions, args.default_cog_version, sorted(python_versions), matrix
     )[:8]
-    gid = f'g{sha256}'
-    gdir = os.path.join(cdir, gid)
+    return f'g{sha256}'
 
-    if require_done_or_rm(gdir):
-        log.info(f'Cog generation {gid} is complete')
-        return
 
-    log.info(f'Installing cog generation {gid} in {gdir}...')
+def cog_generation(
+    args: argparse.Namespace, python_versions: list[str], matrix: dict[str, Any]
+) -> tuple[str, dict[str, tuple[str, str]], list[Job]]:
+    cdir = os.path.join(args.prefix, 'cog')
+
+    pvs = list(map(Version.parse, python_versions))
+    cog_versions = sorted(set(args.cog_versions))
+    gid = cog_generation_id(args, python_versions, matrix)
+    gdir = os.path.join(cdir, gid)
 
     # Cog * Python because Python version is required for venvs
     # And Cog transitives may be Python version dependent
@@ -160,15 +342,96 @@ def install_cogs(args: argparse.Namespace, python_versions: list[str]) -> None:
 
     hf_transfer = f'hf_transfer@{matrix["latest_hf_transfer"]["url"]}'
 
-    for c, pv in itertools.product(cog_versions, pvs):
-        is_default = c == args.default_cog_version
-        v = f'{pv.major}.{pv.minor}'
-        install_cog(uv, gdir, c, is_default, v, str(pv), [hf_transfer])
+    specs: dict[str, tuple[str, str]] = {}
+    for c in cog_versions:
+        resolved = cog_spec(c, matrix)
+        if resolved is not None:
+            specs[c] = resolved
+
+    jobs = []
+    for c in cog_versions:
+        if c not in specs:
+            continue
+        cog_name, spec = specs[c]
+        venvs = []
+        for pv in pvs:
+            v = f'{pv.major}.{pv.minor}'
+            if cog_name.startswith('coglet') and v == '3.8':
+                log.warning('cog-runtime does not support Python 3.8')
+                continue
+            venvs.append((f'{cog_name}-python{v}', v, pv))
+        if len(venvs) == 0:
+            continue
+
+        # Shared by venvs of the same Cog, see resolve_cog
+        resolve = f'resolve-{cog_name}'
+        requirements = os.path.join(args.cache, 'cog', gid, f'{cog_name}.txt')
+        keys = [
+            (venv, cog_venv_key(spec, str(pv), [hf_transfer])) for venv, _, pv in venvs
+        ]
+        min_version = min(venvs, key=lambda x: x[2])[1]
+        a: tuple = (
+            uv,
+            cdir,
+            gdir,
+            spec,
+            [hf_transfer],
+            min_version,
+            keys,
+            requirements,
+        )
+        jobs.append(Job(resolve, resolve_cog, a))
+        for venv, v, pv in venvs:
+            a = (
+                uv,
+                cdir,
+                gdir,
+                cog_name,
+                spec,
+                v,
+                str(pv),
+                [hf_transfer],
+                requirements,
+            )
+            target = os.path.join(gdir, venv)
+            jobs.append(Job(venv, install_cog, a, deps=(resolve,), target=target))
+    return gid, specs, jobs
 
-    latest = os.path.join(cdir, 'latest')
-    if os.path.exists(latest):
-        os.remove(latest)
-    os.symlink(gid, latest)
+
+def install_cogs(args: argparse.Namespace, python_versions: list[str]) -> None:
+    cdir = os.path.join(args.prefix, 'cog')
+    os.makedirs(cdir, exist_ok=True)
+
+    pvs = list(map(Version.parse, python_versions))
+    cog_versions = sorted(set(args.cog_versions))
+    # Check for a complete generation before coglet release lookups
+    # And without matrix.json unless the generation ID depends on it
+    matrix = load_matrix(args.cache, args.offline) if needs_matrix(args) else None
+    gid = cog_generation_id(args, python_versions, matrix)
+    gdir = os.path.join(cdir, gid)
+
+    if require_done_or_rm(gdir):
+        log.info(f'Cog generation {gid} is complete')
+        write_cog_env(gdir)
+        return
+
+    if matrix is None:
+        matrix = load_matrix(args.cache, args.offline)
+    _, specs, jobs = cog_generation(args, python_versions, matrix)
+
+    log.info(f'Installing cog generation {gid} in {gdir}...')
+    run_jobs(jobs, args.jobs, args.keep_going)
+
+    # Publish default venvs and latest only after all venvs are installed
+    if args.default_cog_version in specs:
+        cog_name = specs[args.default_cog_version][0]
+        for pv in pvs:
+            v = f'{pv.major}.{pv.minor}'
+            venv = f'{cog_name}-python{v}'
+            if os.path.exists(os.path.join(gdir, venv)):
+                symlink_atomic(venv, os.path.join(gdir, f'default-python{v}'))
+
+    write_cog_env(gdir)
 
     mark_done(
         gdir,
@@ -179,6 +442,8 @@ def install_cogs(args: argparse.Namespace, python_versions: list[str]) -> None:
         python_versions=python_versions,
     )
 
+    symlink_atomic(gid, os.path.join(cdir, 'latest'))
+
     for g in os.listdir(cdir):
         if g in {'latest', gid}:
             continue
@@ -1,22 +1,29 @@
 import argparse
+import contextlib
 import logging
 import os
 import re
 import shutil
 import subprocess
 import urllib.parse
+import urllib.request
 from dataclasses import dataclass
 from multiprocessing import Pool
+from typing import Optional
 
+from monobase.dedup import dedup
+from monobase.telemetry import run, span, wait
 from monobase.urls import cuda_urls, cudnn_urls
 from monobase.util import (
     Version,
+    is_done,
     mark_done,
     require_done_or_rm,
     setup_logging,
 )
 
 R8_PACKAGE_PREFIX = 'https://monobase-packages.replicate.delivery'
+STREAM_CHUNK_SIZE = 1024 * 1024
 
 log = logging.getLogger(__name__)
 
@@ -96,7 +103,7 @@ def tar_and_delete(path: str, file: str) -> None:
         + ['--zstd', '-cf', file]
         + sorted(os.listdir(path))
     )
-    subprocess.run(cmd, check=True, env=tar_env)
+    run(cmd, env=tar_env)
     shutil.rmtree(path, ignore_errors=True)
 
 
@@ -108,7 +115,7 @@ def pget(args: argparse.Namespace, url: str, file: str) -> None:
         url,
         file,
     ]
-    subprocess.run(cmd, check=True)
+    run(cmd)
 
 
 def build_cuda_tarball(args: argparse.Namespace, version: str) -> None:
@@ -135,7 +142,7 @@ def build_cuda_tarball(args: argparse.Namespace, version: str) -> None:
         '--no-man-page',
         '--no-drm',
     ]
-    subprocess.run(cmd, check=True)
+    run(cmd)
 
     # Remove unused files
     log.info(f'Deleting unused files for CUDA {version}...')
@@ -149,10 +156,10 @@ def build_cuda_tarball(args: argparse.Namespace, version: str) -> None:
     shutil.rmtree(os.path.join(cdir, 'tools'), ignore_errors=True)
 
     cmd = ['/bin/sh', '-c', f'rm -rf {cdir}/gds-* {cdir}/nsight-*']
-    subprocess.run(cmd, check=True)
+    run(cmd)
 
     cmd = ['find', cdir, '-name', 'lib*.a', '-delete']
-    subprocess.run(cmd, check=True)
+    run(cmd)
 
     log.info(f'Creating CUDA tarball {tf}...')
     tar_and_delete(cdir, tf)
@@ -176,12 +183,101 @@ def build_cudnn_tarball(
     cdir = os.path.join(args.prefix, 'cuda', f'cudnn-{key}')
     os.makedirs(cdir, exist_ok=True)
     cmd = ['tar', '-xf', file, '--strip-components=1', '--exclude=lib*.a', '-C', cdir]
-    subprocess.run(cmd, check=True)
+    run(cmd)
 
     log.info(f'Creating CuDNN tarball {tf}...')
     tar_and_delete(cdir, tf)
 
 
+def tarball_path(args: argparse.Namespace, kind: str, key: str) -> str:
+    return os.path.join(args.cache, kind, f'monobase-{kind}-{key}.tar.zst')
+
+
+def stream_tarball(url: str, cdir: str, path: Optional[str]) -> int:
+    # Decompress and unpack while downloading, optionally tee into cache
+    # Tarballs are single zstd frames from tar_and_delete so decoding is sequential
+    # But it overlaps with network I/O and avoids writing the tarball to disk
+    cmd = ['tar', '--zstd', '-xf', '-', '-C', cdir]
+    tmp = None if path is None else f'{path}.tmp'
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    assert proc.stdin is not None
+    size = 0
+    try:
+        with urllib.request.urlopen(url) as resp:
+            if tmp is not None:
+                os.makedirs(os.path.dirname(tmp), exist_ok=True)
+            with contextlib.ExitStack() as stack:
+                f = None if tmp is None else stack.enter_context(open(tmp, 'wb'))
+                while chunk := resp.read(STREAM_CHUNK_SIZE):
+                    proc.stdin.write(chunk)
+                    if f is not None:
+                        f.write(chunk)
+                    size += len(chunk)
+        proc.stdin.close()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    returncode = wait(proc)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    if path is not None and tmp is not None:
+        os.rename(tmp, path)
+    return size
+
+
+def install_tarball(args: argparse.Namespace, cdir: str, kind: str, key: str) -> str:
+    path = tarball_path(args, kind, key)
+    if os.path.exists(path):
+        url = f'file://{path}'
+    else:
+        url = f'{R8_PACKAGE_PREFIX}/{kind}/{os.path.basename(path)}'
+        if args.stream_tarballs:
+            log.info(f'Streaming {kind} {key}...')
+            with span(f'{kind}.stream', key=key) as s:
+                keep = path if args.keep_tarballs else None
+                s.bytes_downloaded = stream_tarball(url, cdir, keep)
+            return url
+        log.info(f'Downloading {kind} {key}...')
+        with span(f'{kind}.download', key=key) as s:
+            pget(args, url, path)
+            s.bytes_downloaded = os.path.getsize(path)
+    with span(f'{kind}.extract', key=key):
+        cmd = ['tar', '-xf', path, '-C', cdir]
+        run(cmd)
+    return url
+
+
+def fetch_tarball(args: argparse.Namespace, cdir: str, kind: str, key: str) -> None:
+    # Download tarball into cache ahead of install_cuda or install_cudnn
+    # So that downloads can overlap with other build steps
+    if is_done(cdir) or os.environ.get('CI_SKIP_CUDA') is not None:
+        return
+    # Streamed in install_tarball instead
+    if args.stream_tarballs:
+        return
+    path = tarball_path(args, kind, key)
+    if os.path.exists(path):
+        return
+    log.info(f'Fetching {kind} {key}...')
+    with span(f'{kind}.download', key=key) as s:
+        pget(args, f'{R8_PACKAGE_PREFIX}/{kind}/{os.path.basename(path)}', path)
+        s.bytes_downloaded = os.path.getsize(path)
+
+
+def fetch_cuda(args: argparse.Namespace, version: str) -> None:
+    cdir = os.path.join(args.prefix, 'cuda', f'cuda-{version}')
+    fetch_tarball(args, cdir, 'cuda', version)
+
+
+def fetch_cudnn(args: argparse.Namespace, version: str, cuda_major: str) -> None:
+    key = f'{version}-cuda{cuda_major}'
+    cdir = os.path.join(args.prefix, 'cuda', f'cudnn-{key}')
+    fetch_tarball(args, cdir, 'cudnn', key)
+
+
 def install_cuda(args: argparse.Namespace, version: str) -> str:
     cdir = os.path.join(args.prefix, 'cuda', f'cuda-{version}')
     if require_done_or_rm(cdir):
@@ -194,18 +290,10 @@ def install_cuda(args: argparse.Namespace, version: str) -> str:
         log.info(f'CUDA {version} skipped in {cdir}')
         return cdir
 
-    filename = f'monobase-cuda-{version}.tar.zst'
-    path = os.path.join(args.cache, 'cuda', filename)
-    url = f'file://{path}'
-    if not os.path.exists(path):
-        log.info(f'Downloading CUDA {version}...')
-        url = f'{R8_PACKAGE_PREFIX}/cuda/{filename}'
-        pget(args, url, path)
-
     log.info(f'Installing CUDA {version}...')
     os.makedirs(cdir, exist_ok=True)
-    cmd = ['tar', '-xf', path, '-C', cdir]
-    subprocess.run(cmd, check=True)
+    url = install_tarball(args, cdir, 'cuda', version)
+    dedup(args.prefix, cdir)
 
     mark_done(cdir, kind='cuda', version=version, url=url)
     log.info(f'CUDA {version} installed in {cdir}')
@@ -225,24 +313,36 @@ def install_cudnn(args: argparse.Namespace, version: str, cuda_major: str) -> st
         log.info(f'CuDNN {key} skipped in {cdir}')
         return cdir
 
-    filename = f'monobase-cudnn-{key}.tar.zst'
-    path = os.path.join(args.cache, 'cudnn', filename)
-    url = f'file://{path}'
-    if not os.path.exists(path):
-        log.info(f'Downloading CuDNN {key}...')
-        url = f'{R8_PACKAGE_PREFIX}/cudnn/{filename}'
-        pget(args, url, path)
-
     log.info(f'Installing CuDNN {key}...')
     os.makedirs(cdir, exist_ok=True)
-    cmd = ['tar', '-xf', path, '-C', cdir]
-    subprocess.run(cmd, check=True)
+    url = install_tarball(args, cdir, 'cudnn', key)
+    dedup(args.prefix, cdir)
 
     mark_done(cdir, kind='cudnn', version=version, url=url)
     log.info(f'CuDNN {key} installed in {cdir}')
     return cdir
 
 
+def link_cuda(args: argparse.Namespace, gdir: str, k: str, v: str) -> None:
+    src = install_cuda(args, v)
+    dst = f'{gdir}/cuda{k}'
+    reldst = os.path.relpath(src, gdir)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.symlink(reldst, dst)
+    log.info(f'CUDA symlinked in {dst}')
+
+
+def link_cudnn(args: argparse.Namespace, gdir: str, k: str, v: str, m: str) -> None:
+    src = install_cudnn(args, v, m)
+    dst = f'{gdir}/cudnn{k}-cuda{m}'
+    reldst = os.path.relpath(src, gdir)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.symlink(reldst, dst)
+    log.info(f'CuDNN symlinked in {dst}')
+
+
 parser = argparse.ArgumentParser(description='Build monobase environment')
 parser.add_argument(
     '--prefix',
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import os
+import os.path
+import stat
+import threading
+from typing import Optional
+
+from monobase.telemetry import span
+from monobase.util import cpu_pool
+
+log = logging.getLogger(__name__)
+
+# Content addressed store of hard links under prefix, i.e. {prefix}/objects
+# Every large file in venvs, CUDA, CuDNN and uv cache is hard linked to
+# objects/sha256/<xx>/<digest> so that identical files share one inode
+OBJECTS_DIR = 'objects'
+INDEX_FILE = 'index.json'
+# Same as the previous rdfind -minsize, smaller files are not worth the inodes
+MIN_SIZE = 1024 * 1024
+LINK_SUFFIX = '.monobase-dedup'
+
+
+def hash_file(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def index_key(st: os.stat_result) -> str:
+    # Any change to a file in place, e.g. pip reinstall, changes size or mtime
+    return f'{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}'
+
+
+class ObjectStore:
+    def __init__(self, prefix: str) -> None:
+        self.root = os.path.abspath(os.path.join(prefix, OBJECTS_DIR))
+        self.index_path = os.path.join(self.root, INDEX_FILE)
+        self.lock = threading.Lock()
+        # Bytes reclaimed by this process, for per generation reporting
+        self.reclaimed = 0
+        # (device, inode, size, mtime) -> digest of every file hashed so far
+        # Only new or changed files are hashed again
+        self.index: dict[str, str] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'sha256', digest[:2], digest)
+
+    def scan(self, d: str) -> list[tuple[str, os.stat_result]]:
+        files = []
+        for root, _, names in os.walk(os.path.abspath(d)):
+            if os.path.commonpath([root, self.root]) == self.root:
+                continue
+            for f in names:
+                p = os.path.join(root, f)
+                if f.endswith(LINK_SUFFIX):
+                    # Left over from an interrupted link
+                    os.remove(p)
+                    continue
+                st = os.lstat(p)
+                if not stat.S_ISREG(st.st_mode) or st.st_size < MIN_SIZE:
+                    continue
+                files.append((p, st))
+        return files
+
+    def link(self, path: str, st: os.stat_result, digest: str) -> int:
+        obj = self.object_path(digest)
+        try:
+            ost = os.stat(obj)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                # First copy of this content, it becomes the object
+                os.link(path, obj)
+                return 0
+            except FileExistsError:
+                ost = os.stat(obj)
+            except OSError as e:
+                # e.g. EXDEV, path is on another file system than the store
+                log.warning(f'Failed to link {path} to {obj}: {e}')
+                return 0
+        if ost.st_ino == st.st_ino:
+            return 0
+
+        # Replace path with a hard link to the object atomically
+        tmp = f'{path}{LINK_SUFFIX}'
+        try:
+            os.link(obj, tmp)
+        except OSError as e:
+            # e.g. EMLINK, too many links to the object
+            log.warning(f'Failed to link {path} to {obj}: {e}')
+            return 0
+        os.replace(tmp, path)
+        with self.lock:
+            self.index[index_key(ost)] = digest
+            if st.st_nlink == 1:
+                # Old inode is gone
+                self.index.pop(index_key(st), None)
+        # Space is only reclaimed once the last link to the old inode is gone
+        return st.st_size if st.st_nlink == 1 else 0
+
+    def add_tree(self, d: str) -> int:
+        files = self.scan(d)
+
+        # Hash new or changed files in parallel, hashlib releases the GIL
+        todo = [(p, st) for p, st in files if index_key(st) not in self.index]
+        if len(todo) > 0:
+            log.info(f'Hashing {len(todo)} new files of {len(files)} in {d}...')
+            digests = cpu_pool().map(hash_file, [p for p, _ in todo])
+            for (_, st), digest in zip(todo, digests):
+                with self.lock:
+                    self.index[index_key(st)] = digest
+
+        reclaimed = 0
+        for p, st in files:
+            reclaimed += self.link(p, st, self.index[index_key(st)])
+        with self.lock:
+            self.reclaimed += reclaimed
+        self.save()
+        return reclaimed
+
+    def prune(self) -> int:
+        # Objects with no other links are no longer used by any venv or CUDA
+        # Also shared .pyc, see monobase.bytecode
+        pruned = 0
+        for d in ['sha256', 'pyc']:
+            for root, _, files in os.walk(os.path.join(self.root, d)):
+                for f in files:
+                    p = os.path.join(root, f)
+                    st = os.lstat(p)
+                    if st.st_nlink > 1:
+                        continue
+                    os.remove(p)
+                    pruned += st.st_size
+        with self.lock:
+            # Keep only keys of live objects, the object link pins the inode
+            # Keys of deleted or replaced files may match a reused inode later
+            # Files not linked yet are hashed again on the next add_tree
+            self.index = {
+                k: v for k, v in self.index.items() if self.object_key(v) == k
+            }
+        self.save()
+        return pruned
+
+    def object_key(self, digest: str) -> Optional[str]:
+        try:
+            return index_key(os.stat(self.object_path(digest)))
+        except FileNotFoundError:
+            return None
+
+    def save(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        with self.lock:
+            tmp = f'{self.index_path}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self.index_path)
+
+
+_stores_lock = threading.Lock()
+_stores: dict[str, ObjectStore] = {}
+
+
+def object_store(prefix: str) -> ObjectStore:
+    # One store per prefix, shared by concurrent build jobs
+    with _stores_lock:
+        if prefix not in _stores:
+            _stores[prefix] = ObjectStore(prefix)
+        return _stores[prefix]
+
+
+def dedup(prefix: str, d: str) -> int:
+    with span('dedup', dir=d):
+        reclaimed = object_store(prefix).add_tree(d)
+    log.info(f'Deduplicated {d}, reclaimed {reclaimed / 1024 / 1024:.1f} MiB')
+    return reclaimed
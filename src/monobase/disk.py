@@ -0,0 +1,207 @@
+import logging
+import os
+import os.path
+import stat
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+log = logging.getLogger(__name__)
+
+# Directory depth under prefix at which trees are accounted separately, e.g.
+# monobase/g00009/python3.12-torch2.6.0-cu124, cog/g1234abcd/cog0.14.0-python3.12
+# cuda/cuda-12.4.1_550.54.15, uv/cache
+UNIT_DEPTHS = {
+    'monobase': 2,
+    'cog': 2,
+    'cuda': 1,
+    'uv': 1,
+}
+# Hard links only, deleting anything else prunes these, see prune_objects
+NON_OWNERS = {'objects'}
+EXTERNAL = '<external>'
+
+
+@dataclass(frozen=True)
+class Usage:
+    name: str
+    # Bytes on disk of distinct inodes
+    total: int
+    # Bytes freed if this alone were deleted
+    unique: int
+
+    @property
+    def shared(self) -> int:
+        return self.total - self.unique
+
+
+@dataclass
+class Scan:
+    # Bytes of inodes with a single link, which are unique by definition
+    single: int
+    # (dev, inode) -> [bytes, links, links seen] for inodes with multiple links
+    linked: dict[tuple[int, int], list[int]]
+    dirs: list[str]
+
+
+def disk_bytes(st: os.stat_result) -> int:
+    # Same as du, allocated blocks rather than apparent size
+    return st.st_blocks * 512
+
+
+def scan(path: str, recursive: bool) -> Scan:
+    # Directory itself and its entries, sub-directories only if recursive
+    st = os.lstat(path)
+    s = Scan(disk_bytes(st), {}, [])
+    stack = [path]
+    while len(stack) > 0:
+        try:
+            it = os.scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        with it:
+            for e in it:
+                try:
+                    st = e.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if recursive:
+                        s.single += disk_bytes(st)
+                        stack.append(e.path)
+                    else:
+                        s.dirs.append(e.path)
+                elif st.st_nlink > 1:
+                    k = (st.st_dev, st.st_ino)
+                    if k in s.linked:
+                        s.linked[k][2] += 1
+                    else:
+                        s.linked[k] = [disk_bytes(st), st.st_nlink, 1]
+                else:
+                    s.single += disk_bytes(st)
+    return s
+
+
+def find_units(root: str, rel: str, depth: int, units: list[tuple[str, bool]]) -> None:
+    # (unit, recursive) where non-recursive units own only their direct files
+    if depth == 0:
+        units.append((rel, True))
+        return
+    units.append((rel, False))
+    path = os.path.join(root, rel)
+    for e in sorted(os.scandir(path), key=lambda e: e.name):
+        if e.is_dir(follow_symlinks=False):
+            child = e.name if rel == '' else f'{rel}/{e.name}'
+            d = UNIT_DEPTHS.get(e.name, 0) if rel == '' else depth - 1
+            find_units(root, child, d, units)
+
+
+class DiskUsage:
+    def __init__(self, root: str, max_workers: Optional[int] = None) -> None:
+        self.root = os.path.abspath(root)
+        units: list[tuple[str, bool]] = []
+        find_units(self.root, '', 1, units)
+        self.units = [u for u, _ in units]
+        # Unit index -> bytes of single link inodes
+        self.single = [0] * len(units)
+        # (dev, inode) -> [bytes, links, links seen], units linking it
+        self.linked: dict[tuple[int, int], list[int]] = {}
+        self.linked_units: dict[tuple[int, int], set[int]] = {}
+
+        # scandir & stat release the GIL, threads are sufficient
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            running: dict[Future, tuple[int, bool]] = {}
+            for i, (u, recursive) in enumerate(units):
+                path = os.path.join(self.root, u)
+                # Scan top level first so that large trees are split by child
+                running[pool.submit(scan, path, False)] = (i, recursive)
+            while len(running) > 0:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    i, recursive = running.pop(f)
+                    s = f.result()
+                    self.add(i, s)
+                    if recursive:
+                        for d in s.dirs:
+                            running[pool.submit(scan, d, True)] = (i, False)
+
+    def add(self, i: int, s: Scan) -> None:
+        self.single[i] += s.single
+        for k, (size, nlink, seen) in s.linked.items():
+            if k in self.linked:
+                self.linked[k][2] += seen
+                self.linked_units[k].add(i)
+            else:
+                self.linked[k] = [size, nlink, seen]
+                self.linked_units[k] = {i}
+
+    @property
+    def total(self) -> int:
+        return sum(self.single) + sum(v[0] for v in self.linked.values())
+
+    def usage(self, key: Callable[[str], str]) -> dict[str, Usage]:
+        # Group units by key, bytes shared by units of the same group are unique
+        groups = [key(u) for u in self.units]
+        total: dict[str, int] = {g: 0 for g in groups}
+        unique: dict[str, int] = {g: 0 for g in groups}
+        for i, size in enumerate(self.single):
+            total[groups[i]] += size
+            unique[groups[i]] += size
+
+        for k, (size, nlink, seen) in self.linked.items():
+            us = self.linked_units[k]
+            gs = set(groups[i] for i in us)
+            owners = set(groups[i] for i in us if self.units[i] not in NON_OWNERS)
+            if nlink > seen:
+                # Also linked from outside of root, never freed
+                owners.add(EXTERNAL)
+            for g in gs:
+                total[g] += size
+                if len(owners) == 0 or owners == {g}:
+                    unique[g] += size
+
+        return {g: Usage(g, total[g], unique[g]) for g in total.keys()}
+
+    def by_unit(self) -> dict[str, Usage]:
+        return self.usage(lambda u: u or '.')
+
+    def by_top_level(self) -> dict[str, Usage]:
+        return self.usage(lambda u: u.split('/')[0] or '.')
+
+    def by_generation(self) -> dict[str, Usage]:
+        # monobase/gNNNNN and cog/gXXXXXXXX, other top level dirs as is
+        def key(u: str) -> str:
+            parts = u.split('/')
+            if parts[0] in {'monobase', 'cog'} and len(parts) > 1:
+                return '/'.join(parts[:2])
+            return parts[0] or '.'
+
+        return self.usage(key)
+
+
+def disk_usage(root: str) -> DiskUsage:
+    return DiskUsage(root)
+
+
+def parse_size(s: str) -> int:
+    # Bytes with optional binary suffix, e.g. 500G, 1.5T
+    units = {'K': 1, 'M': 2, 'G': 3, 'T': 4}
+    s = s.strip().upper().removesuffix('IB').removesuffix('B')
+    if len(s) > 0 and s[-1] in units:
+        return int(float(s[:-1]) * 1024 ** units[s[-1]])
+    return int(s)
+
+
+def fmt_bytes(size: int) -> str:
+    return f'{size / 1024 / 1024 / 1024:.2f} GiB'
+
+
+def log_disk_usage(prefix: str) -> DiskUsage:
+    du = disk_usage(prefix)
+    for name, u in sorted(du.by_generation().items()):
+        log.info(
+            f'{name}: total={fmt_bytes(u.total)} unique={fmt_bytes(u.unique)} '
+            f'shared={fmt_bytes(u.shared)}'
+        )
+    log.info(f'{prefix}: total={fmt_bytes(du.total)}')
+    return du
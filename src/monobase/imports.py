@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import os.path
+import shutil
+from typing import Optional
+
+from monobase.util import HERE
+
+log = logging.getLogger(__name__)
+
+# Top level module name -> kind of each venv, read by sitecustomize.py
+# {vdir}/import-index.json, outside of site-packages so that writing it does
+# not change the mtime of site-packages, which invalidates the index
+INDEX_FILE = 'import-index.json'
+SITE_DIR = 'site'
+# Same precedence as FileFinder, package over module over namespace portion
+KINDS = {'pkg': 0, 'mod': 1, 'ns': 2}
+
+
+def top_level_module(e: os.DirEntry) -> Optional[tuple[str, str]]:
+    if e.is_dir():
+        # *.dist-info, *.data, __pycache__, etc.
+        if not e.name.isidentifier() or e.name == '__pycache__':
+            return None
+        if os.path.exists(os.path.join(e.path, '__init__.py')):
+            return e.name, 'pkg'
+        return e.name, 'ns'
+    if e.name.endswith('.py'):
+        name = e.name.removesuffix('.py')
+    elif e.name.endswith('.so'):
+        # Extension modules, e.g. _cffi_backend.cpython-312-x86_64-linux-gnu.so
+        name = e.name.split('.', 1)[0]
+    else:
+        return None
+    if not name.isidentifier():
+        return None
+    return name, 'mod'
+
+
+def write_import_index(vdir: str, python_version: str) -> None:
+    sp = os.path.join(vdir, 'lib', f'python{python_version}', 'site-packages')
+    modules: dict[str, str] = {}
+    for e in os.scandir(sp):
+        m = top_level_module(e)
+        if m is None:
+            continue
+        name, kind = m
+        if name not in modules or KINDS[kind] < KINDS[modules[name]]:
+            modules[name] = kind
+
+    p = os.path.join(vdir, INDEX_FILE)
+    with open(f'{p}.tmp', 'w') as f:
+        index = {'mtime_ns': os.stat(sp).st_mtime_ns, 'modules': modules}
+        json.dump(index, f, sort_keys=True)
+    os.replace(f'{p}.tmp', p)
+    log.info(f'Indexed {len(modules)} top level modules in {vdir}')
+
+
+def install_sitecustomize(gdir: str) -> None:
+    # Shared by venvs of the generation, see activate.sh
+    src = os.path.join(HERE, 'sitecustomize.py')
+    dst = os.path.join(gdir, SITE_DIR, 'sitecustomize.py')
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copyfile(src, f'{dst}.tmp')
+    os.replace(f'{dst}.tmp', dst)
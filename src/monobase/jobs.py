@@ -0,0 +1,97 @@
+import argparse
+import contextvars
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Job:
+    name: str
+    fn: Callable[..., Any]
+    args: tuple = ()
+    # Names of jobs that must succeed before this one starts
+    deps: tuple[str, ...] = ()
+    # File or directory with .done that exists once the job is satisfied
+    target: Optional[str] = None
+
+
+def add_job_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='number of concurrent jobs, default=1',
+    )
+    parser.add_argument(
+        '--keep-going',
+        default=False,
+        action='store_true',
+        help='keep running other jobs after one fails, default=fail fast',
+    )
+
+
+def run_jobs(jobs: list[Job], max_workers: int, keep_going: bool) -> None:
+    names = {j.name for j in jobs}
+    assert len(names) == len(jobs), 'Duplicate job names'
+    for j in jobs:
+        for d in j.deps:
+            assert d in names, f'Job {j.name} depends on unknown job {d}'
+
+    max_workers = max(1, max_workers)
+    pending = list(jobs)
+    running: dict[Future, Job] = {}
+    succeeded: set[str] = set()
+    failed: list[str] = []
+
+    # Jobs mostly wait on uv, tar, etc. subprocesses, threads are sufficient
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            # Only submit as many jobs as there are workers
+            # So that jobs unblocked later still start in list order
+            # Instead of queueing behind everything that was ready earlier
+            for j in list(pending):
+                if len(running) >= max_workers:
+                    break
+                blocked = [d for d in j.deps if d in failed]
+                if len(blocked) > 0:
+                    log.error(f'Job {j.name} skipped due to failed {blocked}')
+                    pending.remove(j)
+                    failed.append(j.name)
+                elif all(d in succeeded for d in j.deps):
+                    pending.remove(j)
+                    # Run in a copy of the current context, e.g. for spans
+                    ctx = contextvars.copy_context()
+                    running[pool.submit(ctx.run, j.fn, *j.args)] = j
+
+            if len(running) == 0:
+                # Nothing running and nothing can start, i.e. a dependency cycle
+                # Or every remaining job depends on a failed one
+                if len(pending) > 0 and len(failed) == 0:
+                    raise RuntimeError(
+                        f'Unsatisfiable job dependencies: {[j.name for j in pending]}'
+                    )
+                failed += [j.name for j in pending]
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in finished:
+                job = running.pop(f)
+                e = f.exception()
+                if e is None:
+                    succeeded.add(job.name)
+                    continue
+                log.error(f'Job {job.name} failed: {e}')
+                failed.append(job.name)
+
+            if len(failed) > 0 and not keep_going:
+                # Running jobs cannot be interrupted, wait for them on exit
+                failed += [j.name for j in pending]
+                break
+
+    if len(failed) > 0:
+        raise RuntimeError(f'{len(failed)} job(s) failed: {", ".join(failed)}')
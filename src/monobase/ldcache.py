@@ -0,0 +1,203 @@
+import argparse
+import logging
+import os
+import os.path
+import re
+import struct
+import subprocess
+import sys
+from typing import Iterable
+
+from monobase.util import setup_logging
+from monobase.uv import cuda_suffix
+
+log = logging.getLogger(__name__)
+
+# <cuda> <cudnn> <python> <file> <fingerprint>
+# One line per cache, plain text so that activate.sh can read it without tools
+LD_CACHE_MANIFEST = 'manifest.txt'
+# <file>.verified next to each cache that resolves CUDA & CuDNN on its own
+# activate.sh only drops them from LD_LIBRARY_PATH for verified caches
+LD_CACHE_VERIFIED_SUFFIX = '.verified'
+
+# ELF64 only, CUDA is not available for 32-bit targets
+PT_LOAD = 1
+PT_DYNAMIC = 2
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+
+parser = argparse.ArgumentParser(
+    description='Verify that ld.so.caches resolve every library activate.sh '
+    'would otherwise find via LD_LIBRARY_PATH'
+)
+parser.add_argument(
+    '--prefix',
+    metavar='PATH',
+    default='/srv/r8/monobase',
+    help='prefix for monobase',
+)
+parser.add_argument(
+    '--gen-id',
+    metavar='N',
+    type=int,
+    help='monobase generation, default=latest',
+)
+parser.add_argument(
+    '--venvs',
+    default=False,
+    action='store_true',
+    help='also check libraries needed by shared objects in venvs, e.g. torch',
+)
+
+
+def read_ld_cache_files(cache_dir: str) -> dict[tuple[str, str, str], str]:
+    # (cuda, cudnn, python) -> file
+    files: dict[tuple[str, str, str], str] = {}
+    p = os.path.join(cache_dir, LD_CACHE_MANIFEST)
+    if not os.path.exists(p):
+        return files
+    with open(p, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 5:
+                files[(parts[0], parts[1], parts[2])] = parts[3]
+    return files
+
+
+def elf_needed(path: str) -> list[str]:
+    # DT_NEEDED of a shared object without readelf, which is not always installed
+    # Empty for anything that is not a dynamic ELF64, e.g. linker scripts
+    with open(path, 'rb') as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != b'\x7fELF' or ident[4] != 2:
+            return []
+        e = '<' if ident[5] == 1 else '>'
+        f.seek(0x20)
+        (phoff,) = struct.unpack(f'{e}Q', f.read(8))
+        f.seek(0x36)
+        phentsize, phnum = struct.unpack(f'{e}HH', f.read(4))
+
+        loads = []
+        dynamic = None
+        f.seek(phoff)
+        phdrs = f.read(phentsize * phnum)
+        for i in range(phnum):
+            p_type, _, p_offset, p_vaddr, _, p_filesz = struct.unpack_from(
+                f'{e}IIQQQQ', phdrs, i * phentsize
+            )
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+        if dynamic is None:
+            return []
+
+        f.seek(dynamic[0])
+        data = f.read(dynamic[1])
+        strtab = None
+        offsets = []
+        for tag, val in struct.iter_unpack(f'{e}qQ', data[: len(data) // 16 * 16]):
+            if tag == DT_NULL:
+                break
+            elif tag == DT_NEEDED:
+                offsets.append(val)
+            elif tag == DT_STRTAB:
+                strtab = val
+        if strtab is None:
+            return []
+
+        # DT_STRTAB is a virtual address, map it back to a file offset
+        base = None
+        for vaddr, offset, size in loads:
+            if vaddr <= strtab < vaddr + size:
+                base = strtab - vaddr + offset
+        if base is None:
+            return []
+        needed = []
+        for o in offsets:
+            f.seek(base + o)
+            needed.append(f.read(256).split(b'\0', 1)[0].decode('utf-8'))
+        return needed
+
+
+def cache_sonames(cache: str) -> set[str]:
+    # ldconfig -p prints "\tlibfoo.so.1 (libc6,x86-64) => /path/libfoo.so.1"
+    cmd = ['ldconfig', '-p', '-C', cache]
+    proc = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    sonames = set()
+    for line in proc.stdout.splitlines()[1:]:
+        if ' => ' in line:
+            sonames.add(line.strip().split(' ', 1)[0])
+    return sonames
+
+
+def is_library(name: str) -> bool:
+    return name.startswith('lib') and '.so' in name
+
+
+def verify_ld_cache(
+    cache: str, dirs: list[str], files: Iterable[str] = ()
+) -> list[str]:
+    # Libraries in dirs needed by libraries in dirs or files but not in cache
+    # i.e. those that would only resolve via LD_LIBRARY_PATH
+    provided = set()
+    elfs = set(os.path.realpath(f) for f in files)
+    for d in dirs:
+        if not os.path.isdir(d):
+            continue
+        for e in os.scandir(d):
+            if is_library(e.name) and e.is_file(follow_symlinks=True):
+                provided.add(e.name)
+                elfs.add(os.path.realpath(e.path))
+
+    cached = cache_sonames(cache)
+    missing = set()
+    for f in sorted(elfs):
+        for n in elf_needed(f):
+            if n in provided and n not in cached:
+                missing.add(n)
+    return sorted(missing)
+
+
+def venv_libraries(vdir: str) -> list[str]:
+    files = []
+    for root, _, names in os.walk(os.path.join(vdir, 'lib')):
+        files += [os.path.join(root, n) for n in names if n.endswith('.so')]
+    return files
+
+
+def verify(args: argparse.Namespace) -> None:
+    if args.gen_id is None:
+        gdir = os.path.realpath(os.path.join(args.prefix, 'monobase', 'latest'))
+    else:
+        gdir = os.path.join(args.prefix, 'monobase', f'g{args.gen_id:05d}')
+    cache_dir = os.path.join(gdir, 'ld.so.cache.d')
+
+    failed = 0
+    for (cuda, cudnn, python), f in sorted(read_ld_cache_files(cache_dir).items()):
+        cuda_major = cuda.split('.')[0]
+        dirs = [
+            os.path.join(gdir, f'cuda{cuda}', 'lib64'),
+            os.path.join(gdir, f'cudnn{cudnn}-cuda{cuda_major}', 'lib'),
+        ]
+        files = []
+        if args.venvs:
+            cu = cuda_suffix(cuda)
+            p = re.compile(rf'^python{re.escape(python)}-torch.+-{cu}$')
+            for v in sorted(os.listdir(gdir)):
+                if p.match(v):
+                    files += venv_libraries(os.path.join(gdir, v))
+        missing = verify_ld_cache(os.path.join(cache_dir, f), dirs, files)
+        if len(missing) > 0:
+            log.error(f'ld.so.cache {f} is missing {" ".join(missing)}')
+            failed += 1
+        else:
+            log.info(f'ld.so.cache {f} is complete')
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    verify(parser.parse_args())
@@ -1,18 +1,80 @@
 import argparse
+import hashlib
 import itertools
 import logging
 import os
 import re
-import subprocess
 
+from monobase.dedup import dedup
+from monobase.imports import write_import_index
+from monobase.jobs import Job, run_jobs
+from monobase.ldcache import (
+    LD_CACHE_MANIFEST,
+    LD_CACHE_VERIFIED_SUFFIX,
+    verify_ld_cache,
+)
 from monobase.monogen import MonoGen
+from monobase.telemetry import run, span
+from monobase.util import is_done
+from monobase.uv import venv_name
 
 log = logging.getLogger(__name__)
 
 
+def ld_cache_fingerprint(dirs: list[str]) -> str:
+    # ldconfig only scans top level of each directory
+    # Hash paths, sizes and mtimes rather than contents, which is cheap
+    m = hashlib.sha256()
+    for d in dirs:
+        m.update(f'{d}\n'.encode('utf-8'))
+        try:
+            entries = sorted(os.scandir(os.path.realpath(d)), key=lambda e: e.name)
+        except FileNotFoundError:
+            m.update(b'missing\n')
+            continue
+        for e in entries:
+            if e.is_symlink():
+                m.update(f'{e.name} -> {os.readlink(e.path)}\n'.encode('utf-8'))
+            else:
+                st = e.stat(follow_symlinks=False)
+                ident = f'{e.name} {st.st_size} {st.st_mtime_ns}\n'
+                m.update(ident.encode('utf-8'))
+    return m.hexdigest()
+
+
+def read_ld_cache_manifest(cache_dir: str) -> dict[str, str]:
+    # File -> fingerprint
+    fingerprints: dict[str, str] = {}
+    p = os.path.join(cache_dir, LD_CACHE_MANIFEST)
+    if not os.path.exists(p):
+        return fingerprints
+    with open(p, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 5:
+                fingerprints[parts[3]] = parts[4]
+    return fingerprints
+
+
+def generate_ld_cache(cache: str, dirs: list[str]) -> None:
+    # Not verified until checked again below
+    if os.path.exists(f'{cache}{LD_CACHE_VERIFIED_SUFFIX}'):
+        os.remove(f'{cache}{LD_CACHE_VERIFIED_SUFFIX}')
+    cmd = ['ldconfig', '-C', cache] + dirs
+    with span('ldconfig', cache=os.path.basename(cache)):
+        run(cmd)
+
+
 def optimize_ld_cache(args: argparse.Namespace, gdir: str, mg: MonoGen) -> None:
     log.info(f'Generating ld.so.cache for generation {mg.id}...')
+    cache_dir = os.path.join(gdir, 'ld.so.cache.d')
+    os.makedirs(cache_dir, exist_ok=True)
+    old_fingerprints = read_ld_cache_manifest(cache_dir)
+
     cuda_major_p = re.compile(r'\.\d+$')
+    jobs = []
+    manifest: list[tuple[str, list[str]]] = []
+    caches: list[tuple[str, str, list[str]]] = []
     for cuda, cudnn, (python, python_full) in itertools.product(
         mg.cuda.keys(),
         mg.cudnn.keys(),
@@ -26,31 +88,62 @@ def optimize_ld_cache(args: argparse.Namespace, gdir: str, mg: MonoGen) -> None:
             f'{args.prefix}/uv/python/cpython-{python_full}-linux-x86_64-gnu/lib',
         ]
 
-        cache_dir = os.path.join(gdir, 'ld.so.cache.d')
-        os.makedirs(cache_dir, exist_ok=True)
-        cmd = ['ldconfig', '-C', f'{cache_dir}/{k}'] + dirs
-        subprocess.run(cmd, check=True)
+        cache = os.path.join(cache_dir, k)
+        manifest.append((f'{cuda} {cudnn} {python} {k}', dirs))
+        caches.append((k, cache, dirs))
+        fingerprint = ld_cache_fingerprint(dirs)
+        if os.path.exists(cache) and old_fingerprints.get(k) == fingerprint:
+            log.info(f'ld.so.cache {k} is up to date')
+            continue
+        jobs.append(Job(k, generate_ld_cache, (cache, dirs)))
+
+    # ldconfig is single threaded
+    run_jobs(jobs, os.cpu_count() or 1, keep_going=False)
 
+    # activate.sh may rely on verified ones alone without CUDA & CuDNN in
+    # LD_LIBRARY_PATH, also verify up to date caches from before markers
+    for k, cache, dirs in caches:
+        verified = f'{cache}{LD_CACHE_VERIFIED_SUFFIX}'
+        if os.path.exists(verified):
+            continue
+        missing = verify_ld_cache(cache, dirs[:2])
+        if len(missing) > 0:
+            log.warning(f'ld.so.cache {k} is missing {" ".join(missing)}')
+            continue
+        with open(verified, 'w'):
+            pass
 
-def optimize_rdfind(args: argparse.Namespace, gdir: str, mg: MonoGen) -> None:
+    p = os.path.join(cache_dir, LD_CACHE_MANIFEST)
+    with open(f'{p}.tmp', 'w') as f:
+        # Fingerprint after ldconfig, which may create soname symlinks in dirs
+        for line, dirs in manifest:
+            print(f'{line} {ld_cache_fingerprint(dirs)}', file=f)
+    os.replace(f'{p}.tmp', p)
+
+
+def optimize_dedup(args: argparse.Namespace, gdir: str, mg: MonoGen) -> int:
+    # Venvs, CUDA and CuDNN are added to the object store as they are installed
+    # Files already linked into the store are skipped without hashing
+    # So this pass only costs new files, mostly in uv cache
     all_dirs = [
         f'{args.prefix}/uv/cache',
         f'{args.prefix}/cuda',
         gdir,
     ]
-    minsize = str(1024 * 1024)
-
-    log.info(f'Running rdfind for generation {mg.id}...')
-    cmd = [
-        'rdfind',
-        '-minsize',
-        minsize,
-        '-deterministic',
-        'true',
-        '-makehardlinks',
-        'true',
-        '-outputname',
-        '/dev/null',
-        *all_dirs,
-    ]
-    subprocess.run(cmd, check=True)
+
+    log.info(f'Deduplicating files for generation {mg.id}...')
+    return sum(dedup(args.prefix, d) for d in all_dirs)
+
+
+def optimize_import_index(args: argparse.Namespace, gdir: str, mg: MonoGen) -> None:
+    # After dedup, which replaces files in site-packages and changes its mtime
+    log.info(f'Indexing imports for generation {mg.id}...')
+    for python, torch, cuda in itertools.product(
+        mg.python.keys(), mg.torch, ['cpu'] + list(mg.cuda.keys())
+    ):
+        venv = venv_name(python, torch, cuda)
+        if venv is None:
+            continue
+        vdir = os.path.join(gdir, venv)
+        if is_done(vdir):
+            write_import_index(vdir, python)
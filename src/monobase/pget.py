@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import hashlib
+import http.client
 import json
+import mmap
 import os
 import shutil
+import ssl
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
 from pathlib import Path
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 MONOBASE_PREFIX = os.environ.get('MONOBASE_PREFIX', '/srv/r8/monobase')
 PGET_BIN = os.environ.get('PGET_BIN', os.path.join(MONOBASE_PREFIX, 'bin/pget-bin'))
@@ -19,6 +29,35 @@ FUSE_MOUNT = os.environ.get('FUSE_MOUNT', '/srv/r8/fuse-rpc')
 PROC_FILE = os.path.join(FUSE_MOUNT, 'proc', 'pget')
 PGET_CACHED_PREFIXES = os.environ.get('PGET_CACHE_URI_PREFIX', '')
 PGET_KNOWN_WEIGHTS_DIR = os.environ.get('PGET_KNOWN_WEIGHTS_DIR')
+# Sorted "<key> <name>\n" records in PGET_KNOWN_WEIGHTS_DIR, see refresh_files.py
+KNOWN_WEIGHTS_INDEX = 'index.txt'
+INDEX_RECORD_SIZE = 64 + 1 + 64 + 1
+# Precomputed symlink tree of a pre-extracted known weights directory
+TREE_MANIFEST = '.pget-tree.json'
+# Files per symlink task in link_tree
+TREE_CHUNK_SIZE = 256
+# Concurrent files in multifile
+PGET_WORKERS = int(os.environ.get('PGET_WORKERS', '16'))
+# HEAD results by normalized URL, shared by pget invocations in the container
+# Prefix is mounted read-only in model containers, point this to a writable host
+# mount to share across containers on the node
+# Set PGET_FINGERPRINT_CACHE to empty string to disable
+PGET_FINGERPRINT_CACHE = os.environ.get(
+    'PGET_FINGERPRINT_CACHE',
+    os.path.join(tempfile.gettempdir(), 'pget', 'fingerprints'),
+)
+# Seconds to trust entries without asking the server
+# Short enough for a model setup, HEADs repeated across its pget calls are skipped
+# HuggingFace CDN URLs are content addressed and trusted regardless
+PGET_FINGERPRINT_TTL = int(os.environ.get('PGET_FINGERPRINT_TTL', '300'))
+# Send a conditional HEAD for expired entries instead of a regular one
+PGET_FINGERPRINT_REVALIDATE = os.environ.get('PGET_FINGERPRINT_REVALIDATE') != '0'
+
+HTTP_TIMEOUT = 30
+METRICS_TIMEOUT = 1
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+USER_AGENT = 'monobase-pget'
 
 HF_HOSTS = {
     'cdn-lfs-us-1.hf.co',
@@ -103,6 +142,314 @@ def size(p: str) -> int:
         return sum(f.stat().st_size for f in Path(p).glob('**/*') if f.is_file())
 
 
+def url_key(url: str) -> str:
+    # Presigned URLs of the same object share a key
+    return hashlib.sha256(f'url|{normalize_url(url)}'.encode('utf-8')).hexdigest()
+
+
+def content_key(length: int, etag: str) -> str:
+    # Same object behind different URLs, e.g. HuggingFace resolve and CDN URLs
+    return hashlib.sha256(f'content|{length}|{etag}'.encode('utf-8')).hexdigest()
+
+
+class KnownWeightsIndex:
+    # Binary search over fixed size records, without reading the whole index
+    def __init__(self, path: str) -> None:
+        self.mm = None
+        try:
+            with open(path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Missing or empty index
+            pass
+
+    def lookup(self, key: str) -> Optional[str]:
+        if self.mm is None:
+            return None
+        k = key.encode('utf-8')
+        lo, hi = 0, len(self.mm) // INDEX_RECORD_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * INDEX_RECORD_SIZE
+            record = self.mm[offset : offset + INDEX_RECORD_SIZE]
+            if record[:64] < k:
+                lo = mid + 1
+            elif record[:64] > k:
+                hi = mid
+            else:
+                return record[65:129].decode('utf-8')
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def known_weights_index(weights_dir: str) -> KnownWeightsIndex:
+    # Loaded once per process, shared by multifile threads
+    return KnownWeightsIndex(os.path.join(weights_dir, KNOWN_WEIGHTS_INDEX))
+
+
+def find_known_weights(
+    weights_dir: str, url: str
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    # Path of url in weights_dir if any, and its fingerprint if probed for lookup
+    # So that lazy loading does not HEAD the same URL again on a miss
+    def exists(name: Optional[str]) -> Optional[str]:
+        if name is None:
+            return None
+        # Index may be ahead of or behind the directory during refresh
+        fpath = os.path.join(weights_dir, name)
+        return fpath if os.path.exists(fpath) else None
+
+    # Exact URL, the file name itself
+    fpath = exists(hashlib.sha256(url.encode('utf-8')).hexdigest())
+    if fpath is not None:
+        return fpath, None
+    index = known_weights_index(weights_dir)
+    if index.mm is None:
+        return None, None
+    fpath = exists(index.lookup(url_key(url)))
+    if fpath is not None or not url.startswith(('http://', 'https://')):
+        return fpath, None
+    try:
+        entry = probe_fingerprint(url)
+    except Exception:
+        return None, None
+    if entry['etag'] is None:
+        return None, entry
+    return exists(index.lookup(content_key(entry['length'], entry['etag']))), entry
+
+
+def scan_tree(src: str) -> Dict[str, List[str]]:
+    # Relative paths of directories to create, files to symlink and files to copy
+    # Same as cp -rs, which symlinks everything but directories, including symlinks
+    # HF code might mutate potential Git ref files, i.e. **/refs/*, copy instead
+    tree: Dict[str, List[str]] = {'dirs': [], 'links': [], 'copies': []}
+    stack = ['']
+    while len(stack) > 0:
+        rel = stack.pop()
+        is_refs = os.path.basename(rel) == 'refs'
+        with os.scandir(os.path.join(src, rel)) as it:
+            for e in it:
+                r = os.path.join(rel, e.name)
+                if r in (TREE_MANIFEST, f'{TREE_MANIFEST}.tmp'):
+                    continue
+                if e.is_dir(follow_symlinks=False):
+                    tree['dirs'].append(r)
+                    stack.append(r)
+                elif is_refs and e.is_file():
+                    tree['copies'].append(r)
+                else:
+                    tree['links'].append(r)
+    return tree
+
+
+def write_tree_manifest(src: str) -> None:
+    # Known weights directories are immutable once moved into place
+    tree = scan_tree(src)
+    p = os.path.join(src, TREE_MANIFEST)
+    with open(f'{p}.tmp', 'w') as f:
+        json.dump(tree, f)
+    os.replace(f'{p}.tmp', p)
+
+
+def read_tree(src: str) -> Dict[str, List[str]]:
+    try:
+        with open(os.path.join(src, TREE_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return scan_tree(src)
+
+
+def link_tree(src: str, dst: str) -> None:
+    # Symlink all files, not directories in case user code writes into them
+    src = os.path.abspath(src)
+    tree = read_tree(src)
+    os.makedirs(dst, exist_ok=True)
+    # Parents before children in scan order
+    for d in tree['dirs']:
+        os.makedirs(os.path.join(dst, d), exist_ok=True)
+
+    def link(chunk: List[str]) -> None:
+        for r in chunk:
+            os.symlink(os.path.join(src, r), os.path.join(dst, r))
+
+    def copy(chunk: List[str]) -> None:
+        for r in chunk:
+            shutil.copy(os.path.join(src, r), os.path.join(dst, r))
+
+    tasks = []
+    for fn, paths in ((link, tree['links']), (copy, tree['copies'])):
+        for i in range(0, len(paths), TREE_CHUNK_SIZE):
+            tasks.append((fn, paths[i : i + TREE_CHUNK_SIZE]))
+    with ThreadPoolExecutor(max_workers=PGET_WORKERS) as pool:
+        # Propagate errors, e.g. existing files
+        list(pool.map(lambda t: t[0](t[1]), tasks))
+
+
+class ConnectionPool:
+    # Keep-alive connections per scheme, host and port, shared by multifile threads
+    # Manifests usually hit the same few hosts, e.g. HuggingFace CDN or S3
+    def __init__(self, timeout: float) -> None:
+        self.lock = threading.Lock()
+        self.idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self.context = ssl.create_default_context()
+        self.timeout = timeout
+
+    def get(self, key: Tuple[str, str, int]) -> Tuple[http.client.HTTPConnection, bool]:
+        # Connection and whether it is reused
+        with self.lock:
+            conns = self.idle.get(key, [])
+            if len(conns) > 0:
+                return conns.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            conn: http.client.HTTPConnection = http.client.HTTPSConnection(
+                host, port, timeout=self.timeout, context=self.context
+            )
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def put(self, key: Tuple[str, str, int], conn: http.client.HTTPConnection) -> None:
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        body: Optional[bytes] = None,
+    ) -> http.client.HTTPResponse:
+        u = urllib.parse.urlsplit(url)
+        assert u.scheme in ('http', 'https') and u.hostname is not None
+        port = u.port or (443 if u.scheme == 'https' else 80)
+        key = (u.scheme, u.hostname, port)
+        path = urllib.parse.urlunsplit(('', '', u.path or '/', u.query, ''))
+        headers = dict(headers, **{'User-Agent': USER_AGENT})
+        # Idle connections may have been closed by the server, retry on a new one
+        while True:
+            conn, reused = self.get(key)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self.put(key, conn)
+        return resp
+
+    def head(self, url: str, headers: Dict[str, str]) -> Tuple[int, Message]:
+        # Follows redirects like urlopen, e.g. HuggingFace resolve URLs to CDN
+        for _ in range(MAX_REDIRECTS):
+            resp = self.request('HEAD', url, headers)
+            location = resp.getheader('Location')
+            if resp.status in REDIRECT_STATUSES and location is not None:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            return resp.status, resp.headers
+        raise RuntimeError(f'Too many redirects: {url}')
+
+
+POOL = ConnectionPool(HTTP_TIMEOUT)
+# Separate pool with a short timeout, metrics must not hold up pget
+METRICS_POOL = ConnectionPool(METRICS_TIMEOUT)
+# Sent at exit, see flush_pget_metrics
+METRICS: List[Dict[str, Any]] = []
+METRICS_LOCK = threading.Lock()
+
+
+def use_proxy() -> bool:
+    # Proxies are only supported by urllib
+    return any(k in urllib.request.getproxies() for k in ('http', 'https'))
+
+
+def head(url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, Message]:
+    headers = headers or {}
+    if use_proxy():
+        req = urllib.request.Request(url, headers=headers, method='HEAD')
+        try:
+            with urllib.request.urlopen(req) as resp:
+                return resp.status, resp.headers
+        except urllib.error.HTTPError as e:
+            # e.g. 304 Not Modified
+            return e.code, e.headers
+    return POOL.head(url, headers)
+
+
+def fingerprint_path(url: str) -> str:
+    sha = hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+    return os.path.join(PGET_FINGERPRINT_CACHE, sha[:2], f'{sha}.json')
+
+
+def read_fingerprint(url: str) -> Optional[Dict[str, Any]]:
+    if PGET_FINGERPRINT_CACHE == '':
+        return None
+    try:
+        with open(fingerprint_path(url), 'r') as f:
+            entry = json.load(f)
+        # Hash collision or a different query string of a non-presigned URL
+        if entry['url'] != normalize_url(url):
+            return None
+        return entry
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_fingerprint(url: str, entry: Dict[str, Any]) -> None:
+    if PGET_FINGERPRINT_CACHE == '':
+        return
+    p = fingerprint_path(url)
+    # Unique per writer, multifile threads and other pget processes
+    tmp = f'{p}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, p)
+    except OSError:
+        # Cache is best effort, e.g. read-only file system
+        pass
+
+
+def probe_fingerprint(url: str) -> Dict[str, Any]:
+    # length, etag and modified of url, from cache if fresh enough
+    now = time.time()
+    cached = read_fingerprint(url)
+    if cached is not None:
+        if is_hf_presigned(urllib.parse.urlparse(url)):
+            # Path is the content hash, e.g. LFS object ID
+            return cached
+        if now - cached['time'] < PGET_FINGERPRINT_TTL:
+            return cached
+
+    headers = {}
+    if cached is not None and PGET_FINGERPRINT_REVALIDATE:
+        if cached['etag'] is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached['modified'] is not None:
+            headers['If-Modified-Since'] = cached['modified']
+    status, resp_headers = head(url, headers)
+    if status == 304 and cached is not None:
+        entry = dict(cached, time=now)
+    else:
+        assert status == 200
+        entry = {
+            'url': normalize_url(url),
+            'length': int(resp_headers['Content-Length']),
+            'etag': resp_headers.get('Etag'),
+            'modified': resp_headers.get('Last-Modified'),
+            'time': now,
+        }
+    write_fingerprint(url, entry)
+    return entry
+
+
 def send_pget_metrics(src: str, url: str, size: int) -> None:
     if PGET_METRICS_ENDPOINT is None:
         return
@@ -114,35 +461,71 @@ def send_pget_metrics(src: str, url: str, size: int) -> None:
             'size': size,
         },
     }
-    data = json.dumps(payload).encode('utf-8')
+    with METRICS_LOCK:
+        METRICS.append(payload)
+
+
+def flush_pget_metrics() -> None:
+    if PGET_METRICS_ENDPOINT is None:
+        return
+    with METRICS_LOCK:
+        payloads = list(METRICS)
+        METRICS.clear()
+    # One payload per request as before, over one keep-alive connection
+    # Same Content-Type as urlopen with data
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    failed = 0
+    for payload in payloads:
+        data = json.dumps(payload).encode('utf-8')
+        try:
+            if use_proxy():
+                urllib.request.urlopen(
+                    PGET_METRICS_ENDPOINT, data=data, timeout=METRICS_TIMEOUT
+                ).read()
+                continue
+            resp = METRICS_POOL.request('POST', PGET_METRICS_ENDPOINT, headers, data)
+            if resp.status >= 400:
+                failed += 1
+        except Exception:
+            failed += 1
+    if failed > 0:
+        print(f'Failed to send {failed} of {len(payloads)} metrics', file=sys.stderr)
+
+
+def try_pget(url: str, dest: str, force: bool) -> bool:
     try:
-        urllib.request.urlopen(PGET_METRICS_ENDPOINT, data=data, timeout=1).read()
+        single_pget(url, dest, extract=False, force=force)
+        return True
     except Exception:
-        # Ignore errors
-        pass
+        return False
 
 
 def multi_pget(manifest: str, force: bool) -> None:
     urls = parse_manifest(manifest)
-    for dest, url in urls.items():
-        try:
-            single_pget(url, dest, extract=False, force=force)
-        except Exception:
-            # Fall back to regular pget, just for this file
-            p = find_pget_exe()
-            subprocess.run([p, url, dest])
+    # HEAD requests and FUSE registrations are independent of each other
+    with ThreadPoolExecutor(max_workers=PGET_WORKERS) as pool:
+        futures = {
+            dest: pool.submit(try_pget, url, dest, force) for dest, url in urls.items()
+        }
+        failed = [dest for dest, f in futures.items() if not f.result()]
+    if len(failed) == 0:
+        return
+
+    # Fall back to regular pget, just for these files, in one invocation
+    p = find_pget_exe()
+    lines = ''.join(f'{urls[dest]} {dest}\n' for dest in failed)
+    subprocess.run([p, 'multifile', '-'], input=lines, text=True)
 
 
 def single_pget(url: str, dest: str, extract: bool, force: bool) -> None:
     if not force:
         assert not os.path.exists(dest)
 
+    entry = None
     if PGET_KNOWN_WEIGHTS_DIR is not None:
         # File might be in the local known weights volume mount
-        m = hashlib.sha256()
-        m.update(url.encode('utf-8'))
-        fpath = os.path.join(PGET_KNOWN_WEIGHTS_DIR, m.hexdigest())
-        if os.path.exists(fpath):
+        fpath, entry = find_known_weights(PGET_KNOWN_WEIGHTS_DIR, url)
+        if fpath is not None:
             print(f'pget via local cache: {url} {dest}', file=sys.stderr)
             # Send metrics since we're not falling back to regular pget-bin which also sends metrics
             send_pget_metrics('pget-topk', url, size(fpath))
@@ -155,21 +538,7 @@ def single_pget(url: str, dest: str, extract: bool, force: bool) -> None:
                 os.unlink(dest)
 
             if os.path.isdir(fpath):
-                os.makedirs(dest, exist_ok=True)
-                # Symlink all files, not directories in case user code writes into them
-                # cp -rs <src>/. <dst> copies everything inside <src>, not itself
-                subprocess.run(
-                    ['cp', '-rs', os.path.join(fpath, '.'), dest], check=True
-                )
-                w_src = Path(fpath)
-                w_dst = Path(dest)
-                # HF code might mutate potential Git ref files, hard copy instead
-                for p in w_src.glob('**/refs/*'):
-                    if not p.is_file():
-                        continue
-                    tgt = w_dst / p.relative_to(w_src)
-                    os.unlink(tgt)
-                    shutil.copy(p, tgt)
+                link_tree(fpath, dest)
             else:
                 d = os.path.dirname(dest)
                 if d != '':
@@ -185,13 +554,11 @@ def single_pget(url: str, dest: str, extract: bool, force: bool) -> None:
     # Fall back if no FUSE
     assert os.path.exists(PROC_FILE)
 
-    req = urllib.request.Request(url, method='HEAD')
-    resp = urllib.request.urlopen(req)
-
-    assert resp.status == 200
-    length = int(resp.getheader('Content-Length'))
-    etag = resp.getheader('Etag')
-    modified = resp.getheader('Last-Modified')
+    if entry is None:
+        entry = probe_fingerprint(url)
+    length = entry['length']
+    etag = entry['etag']
+    modified = entry['modified']
     # Normalize URL to avoid thrashing cache
     fingerprint = f'{normalize_url(url)}|{length}|{etag}|{modified}'
     sha = hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
@@ -200,7 +567,8 @@ def single_pget(url: str, dest: str, extract: bool, force: bool) -> None:
 
     print(f'pget via lazy loading: {url} {dest}', file=sys.stderr)
     with open(PROC_FILE, 'w') as f:
-        json.dump(payload, f)
+        # One write per registration, multi_pget registers concurrently
+        f.write(json.dumps(payload))
 
     # Send metrics if endpoint is set
     # Send after writing proc file, i.e. no FUSE error
@@ -230,13 +598,16 @@ def smart_pget() -> None:
     # pget [flags] <URL> <dest>
     # pget [flags] multifile <file>
     assert len(vargs) == 2
-    if vargs[0] == 'multifile':
-        # multifile does not support extract
-        assert not args.extract
-        multi_pget(vargs[1], args.force)
-    else:
-        url, dst = vargs
-        single_pget(url, dst, args.extract, args.force)
+    try:
+        if vargs[0] == 'multifile':
+            # multifile does not support extract
+            assert not args.extract
+            multi_pget(vargs[1], args.force)
+        else:
+            url, dst = vargs
+            single_pget(url, dst, args.extract, args.force)
+    finally:
+        flush_pget_metrics()
 
 
 if __name__ == '__main__':
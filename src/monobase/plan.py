@@ -0,0 +1,415 @@
+import argparse
+import glob
+import html
+import json
+import logging
+import os
+import os.path
+import re
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from monobase.cog import (
+    cog_generation,
+    cog_venv_key,
+    find_cog_venv,
+    install_cog,
+    load_matrix,
+)
+from monobase.cuda import R8_PACKAGE_PREFIX, fetch_cuda, fetch_cudnn
+from monobase.disk import disk_usage
+from monobase.jobs import Job
+from monobase.monogen import MonoGen
+from monobase.util import is_done, parse_requirements
+
+log = logging.getLogger(__name__)
+
+# Rough zstd compression ratio of CUDA & CuDNN tarballs
+TARBALL_RATIO = 2.0
+# Rough zip compression ratio of wheels
+WHEEL_RATIO = 2.0
+# Concurrent index requests
+INDEX_WORKERS = 16
+
+FETCHES = {fetch_cuda, fetch_cudnn}
+NAME_REGEX = re.compile(r'[-_.]+')
+VENV_REGEX = re.compile(r'^python(?P<python>\d+\.\d+)-')
+# {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+WHEEL_REGEX = re.compile(
+    r'^(?P<name>[^-]+)-(?P<version>[^-]+)(-\d[^-]*)?'
+    r'-(?P<python>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$'
+)
+# PEP 503 simple index, e.g. PyTorch index without PEP 691 JSON
+ANCHOR_REGEX = re.compile(r'<a\s[^>]*href="([^"]+)"[^>]*>([^<]+)</a>')
+SIMPLE_JSON = 'application/vnd.pypi.simple.v1+json'
+PYPI_INDEX = 'https://pypi.org/simple'
+
+
+@dataclass(frozen=True)
+class Step:
+    name: str
+    done: bool
+    # Estimated bytes, None if unknown
+    download: Optional[int]
+    disk: Optional[int]
+    deps: tuple[str, ...] = ()
+    # False if some parts are unknown, i.e. estimates are lower bounds
+    complete: bool = True
+
+
+def normalize(name: str) -> str:
+    return NAME_REGEX.sub('-', name).lower()
+
+
+def requirement_indexes(req: str) -> dict[str, str]:
+    # Package name -> index URL from uv pip compile --emit-index-annotation
+    # '' -> --index-url for packages without annotation
+    indexes: dict[str, str] = {}
+    name = None
+    for line in req.splitlines():
+        line = line.strip()
+        if line.startswith('--index-url '):
+            indexes[''] = line.removeprefix('--index-url ').strip()
+        elif line.startswith('# from '):
+            if name is not None:
+                indexes[name] = line.removeprefix('# from ').strip()
+        elif line != '' and not line.startswith('#') and not line.startswith('--'):
+            name = normalize(re.split(r'==|@', line, maxsplit=1)[0].strip())
+    return indexes
+
+
+def target_done(target: Optional[str]) -> bool:
+    if target is None:
+        return False
+    if os.path.isdir(target):
+        return is_done(target)
+    return os.path.exists(target)
+
+
+def installed_packages(prefix: str) -> dict[tuple[str, str], int]:
+    # (name, version) -> installed bytes from RECORD of existing venvs
+    pkgs: dict[tuple[str, str], int] = {}
+    pattern = os.path.join(
+        prefix, 'monobase', 'g*', '*', 'lib', 'python*', 'site-packages', '*.dist-info'
+    )
+    for d in glob.glob(pattern):
+        name, _, version = (
+            os.path.basename(d).removesuffix('.dist-info').rpartition('-')
+        )
+        key = (normalize(name), version)
+        record = os.path.join(d, 'RECORD')
+        if key in pkgs or not os.path.exists(record):
+            continue
+        size = 0
+        with open(record, 'r') as f:
+            for line in f:
+                # path,hash,size
+                parts = line.strip().rsplit(',', 2)
+                if len(parts) == 3 and parts[2].isdigit():
+                    size += int(parts[2])
+        pkgs[key] = size
+    return pkgs
+
+
+class Planner:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.packages = installed_packages(args.prefix)
+        # Latest known size of each package regardless of version
+        self.package_names: dict[str, int] = {}
+        for (name, _), size in sorted(self.packages.items()):
+            self.package_names[name] = size
+        # Tarball path or URL -> download size
+        self.tarballs: dict[str, Optional[int]] = {}
+        # (index, name) -> [(filename, url, size)]
+        self.index_pages: dict[
+            tuple[str, str], list[tuple[str, str, Optional[int]]]
+        ] = {}
+        # Fetch and extract targets shared by generations, counted once
+        self.counted: set[str] = set()
+
+    def tarball_size(self, path: str) -> Optional[int]:
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        if path in self.tarballs:
+            return self.tarballs[path]
+        size = None
+        if not self.args.offline:
+            kind = os.path.basename(os.path.dirname(path))
+            size = content_length(
+                f'{R8_PACKAGE_PREFIX}/{kind}/{os.path.basename(path)}'
+            )
+        self.tarballs[path] = size
+        return size
+
+    def index_files(
+        self, index: str, name: str
+    ) -> list[tuple[str, str, Optional[int]]]:
+        key = (index, name)
+        if key in self.index_pages:
+            return self.index_pages[key]
+        url = f'{index.rstrip("/")}/{name}/'
+        # PEP 691 JSON has sizes per PEP 700, HTML needs a HEAD per file
+        accept = f'{SIMPLE_JSON}, text/html;q=0.1'
+        req = urllib.request.Request(url, headers={'Accept': accept})
+        files: list[tuple[str, str, Optional[int]]] = []
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                content_type = resp.headers.get_content_type()
+                body = resp.read().decode('utf-8')
+            if content_type == SIMPLE_JSON:
+                for f in json.loads(body)['files']:
+                    u = urllib.parse.urljoin(url, f['url'])
+                    files.append((f['filename'], u, f.get('size')))
+            else:
+                for href, text in ANCHOR_REGEX.findall(body):
+                    u = urllib.parse.urljoin(url, html.unescape(href))
+                    files.append((html.unescape(text).strip(), u, None))
+        except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+            log.warning(f'Failed to get files of {name} from {index}: {e}')
+        self.index_pages[key] = files
+        return files
+
+    def wheel_size(
+        self, name: str, version: str, index: Optional[str], python_version: str
+    ) -> Optional[int]:
+        # Download size of the wheel uv would pick for x86_64 Linux
+        if self.args.offline or index is None:
+            return None
+        cp = f'cp{python_version.replace(".", "")}'
+        for filename, url, size in self.index_files(index, name):
+            m = WHEEL_REGEX.match(filename)
+            if m is None or normalize(m.group('name')) != name:
+                continue
+            if urllib.parse.unquote(m.group('version')) != version:
+                continue
+            pythons = m.group('python').split('.')
+            if cp not in pythons and 'py3' not in pythons and m.group('abi') != 'abi3':
+                continue
+            platform = m.group('platform')
+            if platform != 'any' and not ('linux' in platform and 'x86_64' in platform):
+                continue
+            if size is None:
+                if url not in self.tarballs:
+                    self.tarballs[url] = content_length(url)
+                size = self.tarballs[url]
+            return size
+        # Source distribution only or not found
+        return None
+
+    def package_size(self, spec: str, python_version: str) -> Optional[int]:
+        # Download size of name==version or name@URL
+        if self.args.offline:
+            return None
+        if '@' in spec:
+            url = spec.split('@', 1)[1]
+            if not url.startswith('https://'):
+                return None
+            if url not in self.tarballs:
+                self.tarballs[url] = content_length(url)
+            return self.tarballs[url]
+        name, _, version = spec.partition('==')
+        return self.wheel_size(normalize(name), version, PYPI_INDEX, python_version)
+
+    def venv_size(
+        self, requirements: str, python_version: str
+    ) -> tuple[Optional[int], Optional[int], bool]:
+        # Download and disk estimates, and whether they cover all packages
+        if not os.path.exists(requirements):
+            return None, None, False
+        with open(requirements, 'r') as f:
+            req = f.read()
+        versions = parse_requirements(req)
+        indexes = requirement_indexes(req)
+        download = 0
+        disk = 0
+        pending = []
+        for name, v in versions.items():
+            name = normalize(name)
+            size = self.packages.get((name, str(v).split('+')[0]))
+            if size is None:
+                size = self.packages.get((name, str(v)))
+            if size is not None:
+                # Installed elsewhere, wheel is likely in uv cache already
+                disk += size
+                continue
+            pending.append((name, str(v)))
+
+        def wheel_size(p: tuple[str, str]) -> Optional[int]:
+            index = indexes.get(p[0], indexes.get(''))
+            return self.wheel_size(p[0], p[1], index, python_version)
+
+        with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as pool:
+            sizes = list(pool.map(wheel_size, pending))
+        unknown = 0
+        for (name, _), size in zip(pending, sizes):
+            if size is not None:
+                download += size
+                disk += int(size * WHEEL_RATIO)
+                continue
+            # Another version, use its installed size as an estimate
+            size = self.package_names.get(name)
+            if size is None:
+                unknown += 1
+                continue
+            download += size
+            disk += size
+        if unknown == len(versions):
+            return None, None, False
+        return download, disk, unknown == 0
+
+    def generation(
+        self, mg: MonoGen, gdir: str, rdir: str, jobs: list[Job]
+    ) -> list[Step]:
+        prefix = f'g{mg.id:05d}'
+        gen_done = is_done(gdir)
+        done: dict[str, bool] = {}
+        # Link and venv jobs first, fetches depend on them being done
+        for j in jobs:
+            if j.fn not in FETCHES:
+                done[j.name] = gen_done or target_done(j.target)
+        for j in jobs:
+            if j.fn in FETCHES:
+                # Fetches are no-ops if tarballs are streamed or installed already
+                dependents = [
+                    d.name for d in jobs if j.name in d.deps and d.name in done
+                ]
+                done[j.name] = (
+                    gen_done
+                    or self.args.stream_tarballs
+                    or target_done(j.target)
+                    or all(done[d] for d in dependents)
+                )
+
+        steps = []
+        for j in jobs:
+            download: Optional[int] = 0
+            disk: Optional[int] = 0
+            complete = True
+            if done[j.name]:
+                pass
+            elif j.target is not None and j.target in self.counted:
+                # CUDA & CuDNN fetched and extracted by an earlier generation
+                pass
+            elif j.fn in FETCHES:
+                assert j.target is not None
+                download = self.tarball_size(j.target)
+            elif len(j.deps) > 0:
+                # Extract a fetched or streamed tarball
+                fetch = next(f for f in jobs if f.name == j.deps[0])
+                assert fetch.target is not None
+                size = self.tarball_size(fetch.target)
+                disk = None if size is None else int(size * TARBALL_RATIO)
+                if self.args.stream_tarballs:
+                    download = size
+            else:
+                m = VENV_REGEX.match(j.name)
+                assert m is not None, f'Unknown job {j.name}'
+                requirements = os.path.join(rdir, f'{j.name}.txt')
+                download, disk, complete = self.venv_size(
+                    requirements, m.group('python')
+                )
+            if j.fn in FETCHES or len(j.deps) > 0:
+                assert j.target is not None
+                self.counted.add(j.target)
+            deps = tuple(f'{prefix}/{d}' for d in j.deps)
+            steps.append(
+                Step(f'{prefix}/{j.name}', done[j.name], download, disk, deps, complete)
+            )
+
+        # Barriers after all other jobs
+        deps = tuple(s.name for s in steps)
+        for name in ['ld-cache', 'dedup']:
+            steps.append(Step(f'{prefix}/{name}', gen_done, 0, 0, deps))
+            deps = (f'{prefix}/{name}',)
+        return steps
+
+    def cogs(self, python_versions: list[str]) -> list[Step]:
+        cdir = os.path.join(self.args.prefix, 'cog')
+        # Plan only, do not refresh cached matrix.json
+        matrix = load_matrix(self.args.cache, self.args.offline, readonly=True)
+        gid, _, jobs = cog_generation(self.args, python_versions, matrix)
+        gdir = os.path.join(cdir, gid)
+        gen_done = is_done(gdir)
+        steps = []
+        for j in jobs:
+            if j.fn is not install_cog:
+                # Resolution only, part of the venv estimates
+                continue
+            spec, python_full_version, extra_packages = j.args[4], j.args[6], j.args[7]
+            key = cog_venv_key(spec, python_full_version, extra_packages)
+            download: Optional[int] = 0
+            disk: Optional[int] = 0
+            done = gen_done or target_done(j.target)
+            if not done and find_cog_venv(cdir, gdir, j.name, key) is None:
+                # Same Cog with a different Python or extra packages is a close estimate
+                download = disk = None
+                for src in glob.glob(os.path.join(cdir, 'g*', j.name)):
+                    if is_done(src):
+                        download = disk = disk_usage(src).total
+                        break
+            complete = True
+            if download is None:
+                # Cog and extra packages themselves, without dependencies
+                sizes = [
+                    self.package_size(p, j.args[5]) for p in [spec] + extra_packages
+                ]
+                known = [size for size in sizes if size is not None]
+                if len(known) > 0:
+                    download = sum(known)
+                    disk = int(download * WHEEL_RATIO)
+                    complete = False
+            steps.append(
+                Step(f'cog/{gid}/{j.name}', done, download, disk, (), complete)
+            )
+        return steps
+
+
+def content_length(url: str) -> Optional[int]:
+    req = urllib.request.Request(url, method='HEAD')
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            cl = resp.getheader('Content-Length')
+            return None if cl is None else int(cl)
+    except urllib.error.URLError as e:
+        log.warning(f'Failed to get size of {url}: {e}')
+        return None
+
+
+def fmt_size(size: Optional[int], complete: bool = True) -> str:
+    if size is None:
+        return '?'
+    # Lower bound if some parts are unknown
+    bound = '' if complete else '>='
+    return f'{bound}{size / 1024 / 1024:.1f} MiB'
+
+
+def print_plan(steps: list[Step]) -> None:
+    print('\t'.join(['STATUS', 'STEP', 'DOWNLOAD', 'DISK', 'DEPS']))
+    for s in steps:
+        status = 'done' if s.done else 'todo'
+        dl = '-' if s.done else fmt_size(s.download, s.complete)
+        du = '-' if s.done else fmt_size(s.disk, s.complete)
+        print('\t'.join([status, s.name, dl, du, ','.join(s.deps)]))
+
+    todo = [s for s in steps if not s.done]
+    estimated = [s for s in todo if s.download is not None and s.disk is not None]
+    unknown = len(todo) - len(estimated)
+    partial = len([s for s in estimated if not s.complete])
+    # Lower bounds if any step is unknown or partial, unknown if all are
+    download: Optional[int] = None
+    disk: Optional[int] = None
+    if len(estimated) > 0 or len(todo) == 0:
+        download = sum(s.download or 0 for s in estimated)
+        disk = sum(s.disk or 0 for s in estimated)
+    complete = unknown + partial == 0
+    print(
+        f'Total: {len(todo)} of {len(steps)} steps to run, '
+        f'download {fmt_size(download, complete)}, '
+        f'disk {fmt_size(disk, complete)}, '
+        f'{unknown} steps without and {partial} with partial estimate'
+    )
@@ -0,0 +1,231 @@
+import argparse
+import logging
+import os
+import os.path
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from monobase.cog import hash_str
+from monobase.usage import add_usage_arguments, most_used, usage_dir
+from monobase.util import setup_logging
+from monobase.uv import cuda_suffix
+
+log = logging.getLogger(__name__)
+
+# Read size for --mode read
+READ_SIZE = 1024 * 1024
+LD_CACHE_REGEX = re.compile(
+    r'^cuda(?P<cuda>[^-]+)-cudnn(?P<cudnn>[^-]+)-python(?P<python>.+)$'
+)
+
+parser = argparse.ArgumentParser(
+    description='Prewarm page cache with shared objects of monobase venvs'
+)
+parser.add_argument(
+    '--prefix',
+    metavar='PATH',
+    default='/srv/r8/monobase',
+    help='prefix for monobase',
+)
+parser.add_argument(
+    '--gen-id',
+    metavar='N',
+    type=int,
+    help='monobase generation, default=latest',
+)
+parser.add_argument('--python', metavar='VERSION', help='Python major.minor')
+parser.add_argument(
+    '--cog',
+    metavar='VERSION',
+    default=os.environ.get('R8_COG_VERSION'),
+    help='Cog version, same as R8_COG_VERSION, default=$R8_COG_VERSION or default Cog',
+)
+parser.add_argument('--torch', metavar='VERSION', help='Torch version')
+parser.add_argument('--cuda', metavar='VERSION', help='CUDA major.minor')
+parser.add_argument('--cudnn', metavar='VERSION', help='CuDNN major')
+parser.add_argument(
+    '--top',
+    metavar='N',
+    type=int,
+    help='prewarm N most used venvs & CUDA from access log instead, see monobase.usage',
+)
+add_usage_arguments(parser)
+parser.add_argument(
+    '--mode',
+    choices=['fadvise', 'read'],
+    default='fadvise',
+    help='fadvise: posix_fadvise(WILLNEED) and let the kernel read ahead, '
+    'read: read every file and wait, default=fadvise',
+)
+parser.add_argument(
+    '--jobs',
+    metavar='N',
+    type=int,
+    default=16,
+    help='concurrent files, default=16',
+)
+
+
+def is_shared_object(name: str) -> bool:
+    return name.endswith('.so') or '.so.' in name
+
+
+def lib_files(d: str) -> list[str]:
+    # Top level only, like LD_LIBRARY_PATH
+    try:
+        return [
+            e.path
+            for e in os.scandir(d)
+            if is_shared_object(e.name) and e.is_file(follow_symlinks=True)
+        ]
+    except FileNotFoundError:
+        log.warning(f'Library directory {d} not found')
+        return []
+
+
+def site_packages_files(d: str) -> list[str]:
+    # Extension modules and bundled libraries, e.g. torch/lib, nvidia/*/lib
+    files = []
+    for root, _, names in os.walk(d):
+        for n in names:
+            if is_shared_object(n):
+                files.append(os.path.join(root, n))
+    if len(files) == 0:
+        log.warning(f'No shared objects found in {d}')
+    return files
+
+
+def site_packages(vdir: str, python: str) -> str:
+    return os.path.join(vdir, 'lib', f'python{python}', 'site-packages')
+
+
+def cuda_files(gdir: str, cuda: str, cudnn: str) -> list[str]:
+    # Same as CUDA_HOME & CUDNN_HOME in activate.sh
+    cuda_major = cuda.split('.')[0]
+    return lib_files(os.path.join(gdir, f'cuda{cuda}', 'lib64')) + lib_files(
+        os.path.join(gdir, f'cudnn{cudnn}-cuda{cuda_major}', 'lib')
+    )
+
+
+def cog_venv_name(cog_version: Optional[str]) -> str:
+    # Same as cog_name in activate.sh
+    if cog_version is None or cog_version == '':
+        return 'default'
+    elif cog_version.startswith('https://') or cog_version.startswith('file://'):
+        pkg = 'coglet' if 'coglet' in cog_version else 'cog'
+        return f'{pkg}{hash_str(cog_version)[:8]}'
+    elif cog_version == 'coglet':
+        return 'cogletlatest'
+    elif cog_version.startswith('coglet'):
+        return cog_version.replace('coglet==', 'coglet')
+    else:
+        return f'cog{cog_version}'
+
+
+def activation_files(args: argparse.Namespace, gdir: str) -> list[str]:
+    # Files on LD_LIBRARY_PATH and PYTHONPATH after activate.sh
+    assert args.python is not None, '--python is required'
+    files = []
+    cuda_version = 'cpu'
+    if args.cuda is not None and args.cudnn is not None:
+        cuda_version = args.cuda
+        files += cuda_files(gdir, args.cuda, args.cudnn)
+        cache = f'cuda{args.cuda}-cudnn{args.cudnn}-python{args.python}'
+        files.append(os.path.join(gdir, 'ld.so.cache.d', cache))
+
+    cog_venv = f'{cog_venv_name(args.cog)}-python{args.python}'
+    cog = os.path.join(args.prefix, 'cog', 'latest', cog_venv)
+    if os.path.isdir(cog):
+        files += site_packages_files(site_packages(os.path.realpath(cog), args.python))
+    else:
+        # Installed on the fly by activate.sh, nothing to prewarm
+        log.warning(f'Cog {cog} not found')
+
+    if args.torch is not None:
+        venv = f'python{args.python}-torch{args.torch}-{cuda_suffix(cuda_version)}'
+        files += site_packages_files(
+            site_packages(os.path.join(gdir, venv), args.python)
+        )
+    return files
+
+
+def most_used_files(args: argparse.Namespace) -> list[str]:
+    files = []
+    udir = usage_dir(args)
+    for a in most_used(args.prefix, udir, 'cog', args.top) + most_used(
+        args.prefix, udir, 'venv', args.top
+    ):
+        lib = os.path.join(args.prefix, a.path, 'lib')
+        if not os.path.isdir(lib):
+            # Pruned since last access
+            continue
+        for p in sorted(os.listdir(lib)):
+            files += site_packages_files(os.path.join(lib, p, 'site-packages'))
+    for a in most_used(args.prefix, udir, 'ld_cache', args.top):
+        cache = os.path.join(args.prefix, a.path)
+        m = LD_CACHE_REGEX.match(os.path.basename(cache))
+        if m is None:
+            continue
+        # <gdir>/ld.so.cache.d/<cache>
+        gdir = os.path.dirname(os.path.dirname(cache))
+        files += cuda_files(gdir, m.group('cuda'), m.group('cudnn'))
+        files.append(cache)
+    return files
+
+
+def prewarm_file(path: str, mode: str) -> int:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return 0
+    try:
+        size = os.fstat(fd).st_size
+        if mode == 'fadvise':
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            b = bytearray(READ_SIZE)
+            while os.readv(fd, [b]) > 0:
+                pass
+        return size
+    finally:
+        os.close(fd)
+
+
+def prewarm(args: argparse.Namespace) -> None:
+    if args.top is not None:
+        files = most_used_files(args)
+    else:
+        if args.gen_id is None:
+            gdir = os.path.realpath(os.path.join(args.prefix, 'monobase', 'latest'))
+        else:
+            gdir = os.path.join(args.prefix, 'monobase', f'g{args.gen_id:05d}')
+        files = activation_files(args, gdir)
+
+    # Same file via symlinks or hard links, e.g. libcudnn.so.9 -> libcudnn.so.9.1.0
+    inodes = set()
+    unique = []
+    for f in files:
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            log.warning(f'{f} not found')
+            continue
+        if (st.st_dev, st.st_ino) not in inodes:
+            inodes.add((st.st_dev, st.st_ino))
+            unique.append(f)
+
+    log.info(f'Prewarming {len(unique)} files with {args.mode}...')
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        total = sum(pool.map(lambda f: prewarm_file(f, args.mode), unique))
+    duration = time.monotonic() - start
+    log.info(
+        f'Prewarmed {len(unique)} files, {total / 1024 / 1024:.1f} MiB in {duration:.1f}s'
+    )
+
+
+if __name__ == '__main__':
+    setup_logging()
+    prewarm(parser.parse_args())
@@ -1,8 +1,17 @@
 import argparse
+import datetime
+import glob
 import logging
 import os.path
 import shutil
 import subprocess
+from dataclasses import dataclass
+
+from monobase.dedup import object_store
+from monobase.disk import disk_usage, fmt_bytes
+from monobase.telemetry import run
+from monobase.usage import last_access, usage_dir
+from monobase.util import done_attributes, mark_done
 
 log = logging.getLogger(__name__)
 
@@ -49,13 +58,146 @@ def prune_cuda(args: argparse.Namespace) -> None:
             shutil.rmtree(src, ignore_errors=True)
 
 
+def prune_objects(args: argparse.Namespace) -> None:
+    log.info('Pruning unused objects...')
+    pruned = object_store(args.prefix).prune()
+    log.info(f'Pruned {pruned / 1024 / 1024:.1f} MiB of unused objects')
+
+
 def prune_uv_cache() -> None:
     log.info('Pruning uv cache...')
     cmd = ['uv', 'cache', 'prune']
-    subprocess.run(cmd, check=True)
+    run(cmd)
 
 
 def clean_uv_cache() -> None:
     log.info('Cleaning uv cache...')
     cmd = ['uv', 'cache', 'clean']
-    subprocess.run(cmd, check=True)
+    run(cmd)
+
+
+@dataclass(frozen=True)
+class Candidate:
+    # Unit or group name in DiskUsage, e.g. monobase/g00009/python3.12-torch2.6.0-cu124
+    name: str
+    path: str
+    # Lower is evicted first with --gc-policy priority
+    priority: int
+    last_used: float
+
+
+def last_used(prefix: str, d: str, accessed: dict[str, float]) -> float:
+    # Last activation from access log, see monobase.usage
+    # Directory atime is also updated (relatime) when Python lists site-packages
+    # But not on read-only mounts
+    # Fall back to mtime, i.e. install time
+    paths = [d] + glob.glob(os.path.join(d, 'lib', 'python*', 'site-packages'))
+    t = max(os.stat(d).st_mtime, accessed.get(os.path.relpath(d, prefix), 0))
+    for p in paths:
+        t = max(t, os.stat(p).st_atime)
+    return t
+
+
+def gc_candidates(args: argparse.Namespace) -> list[Candidate]:
+    mdir = os.path.join(args.prefix, 'monobase')
+    latest = os.path.realpath(os.path.join(mdir, 'latest'))
+    accessed = last_access(args.prefix, usage_dir(args))
+    candidates = []
+    for g in sorted(os.listdir(mdir)):
+        gdir = os.path.join(mdir, g)
+        # Latest generation is the default for models, never evict it
+        if g == 'latest' or gdir == latest or not os.path.isdir(gdir):
+            continue
+        gid = int(g.removeprefix('g'))
+        if gid < args.min_gen_id or gid > args.max_gen_id:
+            # Inactive generation, evict as a whole
+            venvs = [
+                v.path for v in os.scandir(gdir) if v.is_dir(follow_symlinks=False)
+            ]
+            # Not atime of gdir itself, which the scan above just updated
+            t = max(
+                [os.stat(gdir).st_mtime]
+                + [last_used(args.prefix, v, accessed) for v in venvs]
+            )
+            candidates.append(Candidate(f'monobase/{g}', gdir, 0, t))
+            continue
+        for v in os.scandir(gdir):
+            if v.name.startswith('python') and v.is_dir(follow_symlinks=False):
+                name = f'monobase/{g}/{v.name}'
+                t = last_used(args.prefix, v.path, accessed)
+                candidates.append(Candidate(name, v.path, 2, t))
+    # Re-downloadable, not needed at runtime
+    uv_cache = os.path.join(args.prefix, 'uv', 'cache')
+    if os.path.isdir(uv_cache):
+        t = last_used(args.prefix, uv_cache, accessed)
+        candidates.append(Candidate('uv/cache', uv_cache, 1, t))
+
+    if args.gc_policy == 'lru':
+        return sorted(candidates, key=lambda c: c.last_used)
+    return sorted(candidates, key=lambda c: (c.priority, c.last_used))
+
+
+def mark_evicted(gdir: str, venv: str) -> None:
+    # Keep generation done so that the next build does not reinstall the venv
+    attributes = done_attributes(gdir)
+    kind = attributes.pop('monobase_kind', None)
+    # Partial or interrupted generation, do not mark it done
+    if kind is None:
+        return
+    prefix = f'monobase_{kind}.'
+    kv = {k.removeprefix(prefix): v for k, v in attributes.items()}
+    kv['evicted'] = sorted(set(kv.get('evicted', [])) | {venv})
+    mark_done(gdir, kind=kind, **kv)
+
+
+def evict(c: Candidate) -> None:
+    if c.name == 'uv/cache':
+        clean_uv_cache()
+        return
+    shutil.rmtree(c.path, ignore_errors=True)
+    gdir = os.path.dirname(c.path)
+    if c.name.count('/') == 2:
+        mark_evicted(gdir, os.path.basename(c.path))
+        # Generation without any venv left
+        if not any(v.name.startswith('python') for v in os.scandir(gdir)):
+            log.info(f'Pruning empty generation {gdir}...')
+            shutil.rmtree(gdir, ignore_errors=True)
+
+
+def prune_to_budget(args: argparse.Namespace) -> None:
+    budget = args.disk_budget
+    evicted: set[str] = set()
+    while True:
+        usage = disk_usage(args.prefix)
+        total = usage.total
+        if total <= budget:
+            log.info(f'Disk usage {fmt_bytes(total)} within budget {fmt_bytes(budget)}')
+            return
+        log.info(f'Disk usage {fmt_bytes(total)} over budget {fmt_bytes(budget)}')
+
+        # Unique bytes are freed by evicting a candidate alone
+        # Bytes shared by multiple candidates are freed once all of them are gone
+        # And show up as unique after the next scan
+        unique = usage.by_unit() | usage.by_generation()
+        evicted_before = len(evicted)
+        for c in gc_candidates(args):
+            if total <= budget:
+                break
+            u = unique.get(c.name)
+            if c.name in evicted or u is None or u.unique == 0:
+                continue
+            log.info(
+                f'Evicting {c.name}, {fmt_bytes(u.unique)} unique, '
+                f'last used {datetime.datetime.fromtimestamp(c.last_used)}...'
+            )
+            evict(c)
+            evicted.add(c.name)
+            total -= u.unique
+        if len(evicted) == evicted_before:
+            log.warning(f'Unable to fit {args.prefix} in {fmt_bytes(budget)}')
+            return
+
+        # CUDA & CuDNN trees no longer linked by any generation
+        # And objects no longer linked by anything
+        prune_cuda(args)
+        prune_objects(args)
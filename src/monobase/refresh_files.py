@@ -20,6 +20,12 @@ from http import HTTPStatus
 from pathlib import Path
 from typing import Optional
 
+from monobase.pget import (
+    KNOWN_WEIGHTS_INDEX,
+    content_key,
+    url_key,
+    write_tree_manifest,
+)
 from monobase.util import setup_logging
 
 MONOBASE_PREFIX = os.environ.get('MONOBASE_PREFIX', '/srv/r8/monobase')
@@ -86,6 +92,25 @@ def write_metadata(weights_dir: str, metadata: dict[str, Object]) -> None:
         json.dump(j, f, indent=2)
 
 
+def write_index(weights_dir: str, metadata: dict[str, Object]) -> None:
+    # Lookup by normalized URL and content for pget, see pget.find_known_weights
+    # Only files that are actually present
+    records: dict[str, str] = {}
+    for h, obj in metadata.items():
+        if not os.path.exists(os.path.join(weights_dir, h)):
+            continue
+        records.setdefault(url_key(obj.url), h)
+        if obj.etag is not None:
+            records.setdefault(content_key(obj.size, obj.etag), h)
+    p = os.path.join(weights_dir, KNOWN_WEIGHTS_INDEX)
+    with open(f'{p}.tmp', 'w') as f:
+        for k in sorted(records.keys()):
+            f.write(f'{k} {records[k]}\n')
+    # Replace atomically, pget may have the old one mapped
+    os.replace(f'{p}.tmp', p)
+    log.info('Indexed %d files with %d keys', len(metadata), len(records))
+
+
 def size(p: str) -> int:
     if os.path.isfile(p):
         return os.stat(p).st_size
@@ -152,7 +177,7 @@ def sync(args: argparse.Namespace, endpoint: str) -> None:
     # Delete files that should no longer be here so we keep the directory clean
     old_meta = read_metadata(args.weights_dir)
     for file in os.listdir(args.weights_dir):
-        if file == METADATA_FILE:
+        if file in {METADATA_FILE, KNOWN_WEIGHTS_INDEX}:
             continue
 
         # URL, size, etag must all match for a file to be kept
@@ -185,12 +210,16 @@ def sync(args: argparse.Namespace, endpoint: str) -> None:
                 cmd = [p, obj.url, tmp]
             subprocess.run(cmd, check=True)
             shutil.move(tmp, dst)
+            if os.path.isdir(dst):
+                # So that pget can link the tree without walking it
+                write_tree_manifest(dst)
             downloaded += size(dst)
         except Exception as e:
             log.error('Error downloading %s: %s', obj.url, e)
             # Continue on anyways to get the rest of the files
 
     write_metadata(args.weights_dir, new_meta)
+    write_index(args.weights_dir, new_meta)
 
     end = datetime.now()
     log.info(
@@ -0,0 +1,104 @@
+# Installed as {prefix}/monobase/g{id}/site/sitecustomize.py by monobase.build
+# activate.sh puts it first on PYTHONPATH with MONOBASE_IMPORT_INDEX=1
+#
+# Resolves top level imports from import-index.json of each venv layer instead of
+# probing every site-packages on sys.path, see monobase.imports
+# Standalone and runs under the venv's Python, which may be as old as 3.8
+
+import importlib.machinery
+import importlib.util
+import json
+import os
+import sys
+
+INDEX_FILE = 'import-index.json'
+
+
+def load_index(entry):
+    # {vdir}/import-index.json for {vdir}/lib/pythonX.Y/site-packages
+    # Ignored once site-packages changes, e.g. pip install at runtime
+    if not isinstance(entry, str) or os.path.basename(entry) != 'site-packages':
+        return None
+    try:
+        with open(os.path.join(entry, '..', '..', '..', INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        if os.stat(entry).st_mtime_ns != index['mtime_ns']:
+            return None
+        return index['modules']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class IndexFinder:
+    def __init__(self):
+        self.indexes = {}
+
+    def index(self, entry):
+        if entry not in self.indexes:
+            self.indexes[entry] = load_index(entry)
+        return self.indexes[entry]
+
+    def search(self, fullname, paths, target):
+        # Regular module or package only, namespace packages span multiple entries
+        # and are left to PathFinder
+        spec = importlib.machinery.PathFinder.find_spec(fullname, paths, target)
+        if spec is not None and spec.loader is not None:
+            return spec
+        return None
+
+    def find_spec(self, fullname, path=None, target=None):
+        # Submodules are found via __path__ of their parent
+        if path is not None:
+            return None
+        # Same order as sys.path, e.g. script directory before venv layers
+        pending = []
+        for entry in sys.path:
+            index = self.index(entry)
+            if index is None:
+                pending.append(entry)
+                continue
+            kind = index.get(fullname)
+            if kind is None:
+                continue
+            if len(pending) > 0:
+                spec = self.search(fullname, pending, target)
+                if spec is not None:
+                    return spec
+                pending = []
+            if kind == 'ns':
+                return None
+            spec = self.search(fullname, [entry], target)
+            if spec is not None:
+                return spec
+        if len(pending) > 0:
+            return self.search(fullname, pending, target)
+        # Not found or stale index, PathFinder searches everything
+        return None
+
+
+def install():
+    # After built-in and frozen importers, right before PathFinder
+    i = len(sys.meta_path)
+    for j, finder in enumerate(sys.meta_path):
+        if finder is importlib.machinery.PathFinder:
+            i = j
+            break
+    sys.meta_path.insert(i, IndexFinder())
+
+
+def chain():
+    # Run the next sitecustomize on sys.path if any, e.g. from a venv layer
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = [
+        p
+        for p in sys.path
+        if isinstance(p, str) and os.path.abspath(p or os.curdir) != here
+    ]
+    spec = importlib.machinery.PathFinder.find_spec('sitecustomize', paths)
+    if spec is not None and spec.loader is not None:
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+
+install()
+chain()
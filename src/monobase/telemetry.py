@@ -0,0 +1,336 @@
+import argparse
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import os.path
+import secrets
+import subprocess
+import threading
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional
+
+log = logging.getLogger(__name__)
+
+TRACE_FILE = 'trace.jsonl'
+OTLP_TRACES_PATH = '/v1/traces'
+
+
+@dataclass
+class Usage:
+    cpu_seconds: float = 0.0
+    peak_rss_bytes: int = 0
+    bytes_written: int = 0
+
+    def add(self, other: 'Usage') -> None:
+        self.cpu_seconds += other.cpu_seconds
+        # Peak of the largest process, not the sum of concurrent ones
+        self.peak_rss_bytes = max(self.peak_rss_bytes, other.peak_rss_bytes)
+        self.bytes_written += other.bytes_written
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    attributes: dict[str, Any] = field(default_factory=dict)
+    # Set by the step itself where known, e.g. tarball downloads
+    bytes_downloaded: int = 0
+    parent: Optional['Span'] = None
+    thread_id: int = 0
+    # Not covered by counters of this span's own thread, i.e. subprocesses waited
+    # for with wait or run within the span and child spans in other threads
+    usage: Usage = field(default_factory=Usage)
+
+
+def add_trace_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--trace-file',
+        metavar='PATH',
+        help=f'append build step spans as JSON lines, default=CACHE/{TRACE_FILE}',
+    )
+    parser.add_argument(
+        '--otlp-endpoint',
+        metavar='URL',
+        default=os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT'),
+        help='also export spans to OTLP/HTTP endpoint, e.g. http://localhost:4318',
+    )
+
+
+def thread_bytes_written() -> int:
+    # This thread only, not available outside Linux
+    try:
+        with open('/proc/thread-self/io', 'r') as f:
+            for line in f:
+                k, v = line.split(':', 1)
+                if k == 'write_bytes':
+                    return int(v)
+    except OSError:
+        pass
+    return 0
+
+
+_usage_lock = threading.Lock()
+
+
+def add_usage(s: Span, usage: Usage) -> None:
+    with _usage_lock:
+        s.usage.add(usage)
+
+
+def wait(proc: subprocess.Popen) -> int:
+    # Popen.wait with wait4 instead of waitpid, for resource usage of the process
+    # e.g. uv, tar, pget, attributed to the current span
+    if proc.returncode is not None:
+        return proc.returncode
+    try:
+        _, sts, ru = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # Already reaped
+        return proc.wait()
+    proc.returncode = os.waitstatus_to_exitcode(sts)
+    s = _current.get()
+    if s is not None:
+        usage = Usage(
+            cpu_seconds=ru.ru_utime + ru.ru_stime,
+            # KiB on Linux
+            peak_rss_bytes=ru.ru_maxrss * 1024,
+            # 512 byte units of write_bytes on Linux
+            bytes_written=ru.ru_oublock * 512,
+        )
+        add_usage(s, usage)
+    return proc.returncode
+
+
+def run(
+    cmd: list[str],
+    env: Optional[dict[str, str]] = None,
+    input: Optional[str] = None,
+    capture_output: bool = False,
+) -> subprocess.CompletedProcess:
+    # subprocess.run(cmd, check=True, text=True) with usage counted by wait
+    # Popen.communicate reaps the process itself, read pipes in threads instead
+    pipe = subprocess.PIPE if capture_output else None
+    proc = subprocess.Popen(
+        cmd,
+        env=env,
+        stdin=None if input is None else subprocess.PIPE,
+        stdout=pipe,
+        stderr=pipe,
+        text=True,
+    )
+    outputs: dict[str, str] = {}
+
+    def read(name: str, f: Any) -> None:
+        outputs[name] = f.read()
+
+    readers = [
+        threading.Thread(target=read, args=(name, f))
+        for name, f in [('stdout', proc.stdout), ('stderr', proc.stderr)]
+        if f is not None
+    ]
+    try:
+        for t in readers:
+            t.start()
+        if proc.stdin is not None:
+            try:
+                proc.stdin.write(input or '')
+            except BrokenPipeError:
+                # Failed early, reported by the return code
+                pass
+            proc.stdin.close()
+        for t in readers:
+            t.join()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    returncode = wait(proc)
+    stdout = outputs.get('stdout')
+    stderr = outputs.get('stderr')
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+
+class Tracer:
+    def __init__(self, path: str, otlp_endpoint: Optional[str]) -> None:
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self.trace_id = secrets.token_hex(16)
+        self.lock = threading.Lock()
+        self.spans: list[dict[str, Any]] = []
+
+    def start(self, name: str, attributes: dict[str, Any]) -> Span:
+        parent = _current.get()
+        parent_id = None if parent is None else parent.span_id
+        return Span(
+            name,
+            self.trace_id,
+            secrets.token_hex(8),
+            parent_id,
+            attributes,
+            parent=parent,
+            thread_id=threading.get_ident(),
+        )
+
+    def end(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            if self.otlp_endpoint is not None:
+                self.spans.append(record)
+            with open(self.path, 'a') as f:
+                f.write(f'{line}\n')
+
+    def export(self) -> None:
+        if self.otlp_endpoint is None or len(self.spans) == 0:
+            return
+        with self.lock:
+            spans = [otlp_span(r) for r in self.spans]
+            self.spans = []
+        body = {
+            'resourceSpans': [
+                {
+                    'resource': {
+                        'attributes': otlp_attributes({'service.name': 'monobase'})
+                    },
+                    'scopeSpans': [{'scope': {'name': 'monobase'}, 'spans': spans}],
+                }
+            ]
+        }
+        url = f'{self.otlp_endpoint.rstrip("/")}{OTLP_TRACES_PATH}'
+        req = urllib.request.Request(
+            url,
+            data=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST',
+        )
+        try:
+            urllib.request.urlopen(req, timeout=10).close()
+            log.info(f'Exported {len(spans)} spans to {url}')
+        except OSError as e:
+            # Telemetry must never fail the build
+            log.warning(f'Failed to export spans to {url}: {e}')
+
+
+def otlp_attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+    kvs = []
+    for k, v in attributes.items():
+        if isinstance(v, bool):
+            value: dict[str, Any] = {'boolValue': v}
+        elif isinstance(v, int):
+            value = {'intValue': str(v)}
+        elif isinstance(v, float):
+            value = {'doubleValue': v}
+        else:
+            value = {'stringValue': str(v)}
+        kvs.append({'key': k, 'value': value})
+    return kvs
+
+
+def otlp_span(r: dict[str, Any]) -> dict[str, Any]:
+    metrics = {
+        f'monobase.{k}': r[k]
+        for k in [
+            'wall_seconds',
+            'cpu_seconds',
+            'peak_rss_bytes',
+            'bytes_downloaded',
+            'bytes_written',
+        ]
+    }
+    span = {
+        'traceId': r['trace_id'],
+        'spanId': r['span_id'],
+        'name': r['name'],
+        # SPAN_KIND_INTERNAL
+        'kind': 1,
+        'startTimeUnixNano': str(r['start_time_ns']),
+        'endTimeUnixNano': str(r['end_time_ns']),
+        'attributes': otlp_attributes(r['attributes'] | metrics),
+        # STATUS_CODE_OK or STATUS_CODE_ERROR
+        'status': {'code': 1 if r['error'] is None else 2},
+    }
+    if r['parent_id'] is not None:
+        span['parentSpanId'] = r['parent_id']
+    return span
+
+
+_tracer: Optional[Tracer] = None
+# Innermost span, run_jobs copies it into job threads
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    'span', default=None
+)
+
+
+def setup_tracing(args: argparse.Namespace) -> None:
+    global _tracer
+    path = args.trace_file
+    if path is None:
+        path = os.path.join(args.cache, TRACE_FILE)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    _tracer = Tracer(path, args.otlp_endpoint)
+    log.info(f'Tracing build steps in {path}')
+
+
+def export_spans() -> None:
+    if _tracer is not None:
+        _tracer.export()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    # Usage of the span's thread, its subprocesses and child spans in other threads
+    # Concurrent spans, e.g. jobs, do not count each other
+    tracer = _tracer
+    if tracer is None:
+        yield Span(name, '', '', None, attributes)
+        return
+
+    s = tracer.start(name, attributes)
+    token = _current.set(s)
+    start_time_ns = time.time_ns()
+    start = time.monotonic()
+    cpu = time.thread_time()
+    written = thread_bytes_written()
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        own = Usage(
+            cpu_seconds=time.thread_time() - cpu,
+            bytes_written=thread_bytes_written() - written,
+        )
+        with _usage_lock:
+            total = Usage()
+            total.add(own)
+            total.add(s.usage)
+        if s.parent is not None:
+            # Same thread counters of the parent already include this span's own
+            add_usage(s.parent, s.usage if s.parent.thread_id == s.thread_id else total)
+        record = {
+            'trace_id': s.trace_id,
+            'span_id': s.span_id,
+            'parent_id': s.parent_id,
+            'name': name,
+            'attributes': s.attributes,
+            'start_time_ns': start_time_ns,
+            'end_time_ns': time.time_ns(),
+            'wall_seconds': time.monotonic() - start,
+            'cpu_seconds': total.cpu_seconds,
+            # Largest subprocess, memory of this process is shared by all spans
+            'peak_rss_bytes': total.peak_rss_bytes,
+            'bytes_downloaded': s.bytes_downloaded,
+            'bytes_written': total.bytes_written,
+            'error': error,
+        }
+        _current.reset(token)
+        tracer.end(record)
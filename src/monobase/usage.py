@@ -0,0 +1,170 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import os.path
+from dataclasses import asdict, dataclass
+
+from monobase.util import setup_logging
+
+log = logging.getLogger(__name__)
+
+# Appended by activate.sh on every activation, one line each
+# <epoch> <cog venv> <monobase venv or -> <ld.so.cache or ->
+# {prefix}/usage by default, or MONOBASE_USAGE_DIR, e.g. a writable host mount in
+# model containers where prefix is read-only
+USAGE_DIR = 'usage'
+ACCESS_LOG = 'access.log'
+# Aggregated access log, so that the log itself can be truncated
+SUMMARY_FILE = 'summary.json'
+KINDS = ['cog', 'venv', 'ld_cache']
+
+
+def add_usage_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--usage-dir',
+        metavar='PATH',
+        default=os.environ.get('MONOBASE_USAGE_DIR'),
+        help=f'access log directory, default=$MONOBASE_USAGE_DIR or PREFIX/{USAGE_DIR}',
+    )
+
+
+def usage_dir(args: argparse.Namespace) -> str:
+    if args.usage_dir is not None:
+        return args.usage_dir
+    return os.path.join(args.prefix, USAGE_DIR)
+
+
+parser = argparse.ArgumentParser(description='Aggregate monobase access log')
+parser.add_argument(
+    '--prefix',
+    metavar='PATH',
+    default='/srv/r8/monobase',
+    help='prefix for monobase',
+)
+add_usage_arguments(parser)
+parser.add_argument(
+    '--top',
+    metavar='N',
+    type=int,
+    default=20,
+    help='show N most used paths of each kind, default=20',
+)
+parser.add_argument(
+    '--compact',
+    default=False,
+    action='store_true',
+    help='fold access log into summary and truncate it',
+)
+
+
+@dataclass(frozen=True)
+class Access:
+    kind: str
+    # Relative to prefix if inside it
+    path: str
+    count: int
+    last_access: float
+
+
+def setup_usage_dir(udir: str) -> None:
+    # Model containers might run as any user, like /tmp
+    os.makedirs(udir, exist_ok=True)
+    os.chmod(udir, 0o1777)
+
+
+def relpath(prefix: str, p: str) -> str:
+    prefix = os.path.abspath(prefix)
+    if os.path.isabs(p) and os.path.commonpath([prefix, p]) == prefix:
+        return os.path.relpath(p, prefix)
+    return p
+
+
+def merge(accesses: dict[tuple[str, str], Access], a: Access) -> None:
+    k = (a.kind, a.path)
+    if k in accesses:
+        old = accesses[k]
+        a = Access(
+            a.kind, a.path, old.count + a.count, max(old.last_access, a.last_access)
+        )
+    accesses[k] = a
+
+
+def read_log(prefix: str, path: str, accesses: dict[tuple[str, str], Access]) -> None:
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            # Skip partial lines, e.g. from a full disk
+            if len(parts) != len(KINDS) + 1:
+                continue
+            try:
+                t = float(parts[0])
+            except ValueError:
+                continue
+            for kind, p in zip(KINDS, parts[1:]):
+                if p != '-':
+                    merge(accesses, Access(kind, relpath(prefix, p), 1, t))
+
+
+def read_summary(udir: str) -> dict[tuple[str, str], Access]:
+    accesses: dict[tuple[str, str], Access] = {}
+    path = os.path.join(udir, SUMMARY_FILE)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for a in json.load(f):
+                merge(accesses, Access(**a))
+    return accesses
+
+
+def read_usage(prefix: str, udir: str) -> dict[tuple[str, str], Access]:
+    # (kind, path) -> aggregated accesses
+    accesses = read_summary(udir)
+    read_log(prefix, os.path.join(udir, ACCESS_LOG), accesses)
+    return accesses
+
+
+def last_access(prefix: str, udir: str) -> dict[str, float]:
+    # Path relative to prefix -> last access, of any kind
+    return {a.path: a.last_access for a in read_usage(prefix, udir).values()}
+
+
+def most_used(prefix: str, udir: str, kind: str, n: int) -> list[Access]:
+    accesses = [a for a in read_usage(prefix, udir).values() if a.kind == kind]
+    return sorted(accesses, key=lambda a: (-a.count, -a.last_access))[:n]
+
+
+def compact_access_log(prefix: str, udir: str) -> None:
+    path = os.path.join(udir, ACCESS_LOG)
+    if not os.path.exists(path):
+        return
+    # Writers reopen the log on every activation, new lines go to a new file
+    rotated = f'{path}.compacting'
+    os.replace(path, rotated)
+    accesses = read_summary(udir)
+    read_log(prefix, rotated, accesses)
+    summary = os.path.join(udir, SUMMARY_FILE)
+    with open(f'{summary}.tmp', 'w') as f:
+        json.dump([asdict(a) for a in accesses.values()], f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(f'{summary}.tmp', summary)
+    os.remove(rotated)
+    log.info(f'Compacted access log into {summary}')
+
+
+def usage(args: argparse.Namespace) -> None:
+    udir = usage_dir(args)
+    if args.compact:
+        compact_access_log(args.prefix, udir)
+    print('\t'.join(['KIND', 'COUNT', 'LAST_ACCESS', 'PATH']))
+    for kind in KINDS:
+        for a in most_used(args.prefix, udir, kind, args.top):
+            t = datetime.datetime.fromtimestamp(a.last_access, datetime.UTC)
+            print('\t'.join([kind, str(a.count), t.isoformat(), a.path]))
+
+
+if __name__ == '__main__':
+    setup_logging()
+    usage(parser.parse_args())
@@ -4,6 +4,8 @@ import os.path
 import subprocess
 from typing import Optional
 
+from monobase.bytecode import compile_bytecode
+from monobase.imports import write_import_index
 from monobase.util import (
     Version,
     mark_done,
@@ -27,6 +29,12 @@ parser.add_argument(
     metavar='FILE',
     help='Python requirements.txt for user layer',
 )
+parser.add_argument(
+    '--venv',
+    metavar='PATH',
+    default='/root/.venv',
+    help='user venv, must not be inside prefix which might be mounted read-only',
+)
 parser.add_argument(
     '--override',
     metavar='FILE',
@@ -43,8 +51,9 @@ def freeze(uv: str, vdir: str) -> str:
 
 
 def build_user_venv(args: argparse.Namespace) -> None:
-    # User venv must not be inside args.prefix which might be mounted read-only
-    udir = '/root/.venv'
+    udir = args.venv
+    # Resolved requirements are saved next to the user venv, e.g. /root
+    rdir = os.path.dirname(os.path.abspath(udir))
     if require_done_or_rm(udir):
         log.info(f'User venv in {udir} is complete')
         return
@@ -61,7 +70,7 @@ def build_user_venv(args: argparse.Namespace) -> None:
     vdir = os.path.realpath(os.path.join(cdir, f'default-python{python_version}'))
     log.info(f'Freezing Cog venv {vdir}...')
     cog_req = freeze(uv, vdir)
-    with open('/root/requirements-cog.txt', 'w') as f:
+    with open(os.path.join(rdir, 'requirements-cog.txt'), 'w') as f:
         f.write(cog_req)
     cog_versions = parse_requirements(cog_req)
 
@@ -77,7 +86,7 @@ def build_user_venv(args: argparse.Namespace) -> None:
         vdir = os.path.join(gdir, venv)
         log.info(f'Freezing monobase venv {vdir}...')
         mono_req = freeze(uv, vdir)
-        with open('/root/requirements-mono.txt', 'w') as f:
+        with open(os.path.join(rdir, 'requirements-mono.txt'), 'w') as f:
             f.write(mono_req)
         mono_versions = parse_requirements(mono_req)
 
@@ -162,7 +171,7 @@ def build_user_venv(args: argparse.Namespace) -> None:
                 f'probable incompatible versions for {k}: cog=={cvs}, mono=={mvs}, user=={uvs}'
             )
 
-    user_req_path = '/root/requirements-user.txt'
+    user_req_path = os.path.join(rdir, 'requirements-user.txt')
     with open(user_req_path, 'w') as f:
         for k, uvs in sorted(user_versions.items()):
             mvs = mono_versions.get(k)
@@ -182,8 +191,14 @@ def build_user_venv(args: argparse.Namespace) -> None:
                 print(f'{k}=={uvs}', file=f)
     cmd = [uv, 'pip', 'install', '--no-deps', '--requirement', user_req_path]
     cmd += index_args(torch_version, cuda_version, True)
+    # Compiled below instead, in parallel
+    env['UV_COMPILE_BYTECODE'] = '0'
     subprocess.run(cmd, check=True, env=env)
 
+    # Prefix may be read-only in model containers, compile in place
+    compile_bytecode(udir, python_version)
+    write_import_index(udir, python_version)
+
     mark_done(
         udir,
         kind='user',
@@ -8,8 +8,12 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Any, Iterable, Optional
+
+from monobase.telemetry import wait
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 IN_KUBERNETES = os.environ.get('KUBERNETES_SERVICE_HOST') is not None
@@ -72,7 +76,7 @@ def add_arguments(parser: argparse.ArgumentParser) -> None:
     )
 
 
-def _is_done(d: str) -> bool:
+def is_done(d: str) -> bool:
     try:
         with open(os.path.join(d, DONE_FILE_BASENAME)) as done_file:
             done_state = json.load(done_file)
@@ -81,13 +85,21 @@ def _is_done(d: str) -> bool:
         return False
 
 
+def done_attributes(d: str) -> dict[str, Any]:
+    try:
+        with open(os.path.join(d, DONE_FILE_BASENAME)) as done_file:
+            return json.load(done_file).get('attributes', {})
+    except Exception:
+        return {}
+
+
 def require_done_or_rm(d: str) -> bool:
     """
     This function checks for the presence of a 'done file', and, if one is not found, or
     if the directory tree "shape" sha1sum does not match, removes the tree at `d` so that
     the code requiring the done file can re-run.
     """
-    if _is_done(d):
+    if is_done(d):
         return True
 
     if os.path.exists(d):
@@ -115,6 +127,15 @@ def mark_done(d: str, *, kind: str, **attributes) -> None:
         f.write('\n')
 
 
+def symlink_atomic(src: str, dst: str) -> None:
+    # Readers never see dst missing
+    tmp = f'{dst}.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(src, tmp)
+    os.replace(tmp, dst)
+
+
 def desc_version(it: Iterable[str]) -> list[str]:
     return sorted(it, key=Version.parse, reverse=True)
 
@@ -147,8 +168,34 @@ def parse_requirements(req: str) -> dict[str, str | Version]:
     return versions
 
 
-def du(d: str) -> None:
-    subprocess.run(['du', '-ch', '-d', '1', d], check=True)
+def run_prefixed(
+    cmd: list[str], prefix: str, env: Optional[dict[str, str]] = None
+) -> None:
+    # Prefix every line of output so that concurrent jobs are distinguishable
+    proc = subprocess.Popen(
+        cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    assert proc.stdout is not None
+    for line in proc.stdout:
+        print(f'[{prefix}] {line}', end='', flush=True)
+    returncode = wait(proc)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+_cpu_pool_lock = threading.Lock()
+_cpu_pool: Optional[ThreadPoolExecutor] = None
+
+
+def cpu_pool() -> ThreadPoolExecutor:
+    # One pool for CPU bound work of all concurrent jobs, e.g. hashing & compiling
+    # So that run_jobs with N workers does not run N * cpu_count at once
+    # Tasks must not wait for other tasks in the pool
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _cpu_pool
 
 
 def setup_logging() -> None:
@@ -4,8 +4,11 @@ import os.path
 import subprocess
 from typing import Optional
 
+from monobase.bytecode import compile_bytecode
+from monobase.dedup import dedup
+from monobase.telemetry import run, span
 from monobase.torch import get_torch_spec, torch_deps
-from monobase.util import Version, mark_done, require_done_or_rm
+from monobase.util import Version, mark_done, require_done_or_rm, run_prefixed
 
 log = logging.getLogger(__name__)
 
@@ -98,22 +101,16 @@ def update_venv(
     cuda_version: str,
     pip_pkgs: list[str],
 ) -> bool:
-    p = Version.parse(python_version)
     t = Version.parse(torch_version)
-    spec = get_torch_spec(t)
-    if spec is None:
-        return False
-    if p < spec.python_min or p > spec.python_max:
-        return False
-    if cuda_version not in spec.cudas:
+    venv = venv_name(python_version, torch_version, cuda_version)
+    if venv is None:
         return False
 
-    venv = f'python{python_version}-torch{torch_version}-{cuda_suffix(cuda_version)}'
     vdir = os.path.join(tmp, venv)
 
     log.info(f'Creating venv {venv}...')
     cmd = ['uv', 'venv', '--python', python_full_version, vdir]
-    subprocess.run(cmd, check=True)
+    run(cmd)
 
     log.info(f'Running pip compile in {venv}...')
     # Emit extra info for debugging
@@ -129,14 +126,7 @@ def update_venv(
     env = os.environ.copy()
     env['VIRTUAL_ENV'] = vdir
     try:
-        proc = subprocess.run(
-            cmd,
-            check=True,
-            env=env,
-            input='\n'.join(pkgs),
-            capture_output=True,
-            text=True,
-        )
+        proc = run(cmd, env=env, input='\n'.join(pkgs), capture_output=True)
 
         requirements = os.path.join(rdir, f'{venv}.txt')
         with open(requirements, 'w') as f:
@@ -148,6 +138,22 @@ def update_venv(
     return True
 
 
+def venv_name(
+    python_version: str, torch_version: str, cuda_version: str
+) -> Optional[str]:
+    # None if the combination is not supported by Torch
+    p = Version.parse(python_version)
+    t = Version.parse(torch_version)
+    spec = get_torch_spec(t)
+    if spec is None:
+        return None
+    if p < spec.python_min or p > spec.python_max:
+        return None
+    if cuda_version not in spec.cudas:
+        return None
+    return f'python{python_version}-torch{torch_version}-{cuda_suffix(cuda_version)}'
+
+
 def install_venv(
     args: argparse.Namespace,
     rdir: str,
@@ -157,17 +163,11 @@ def install_venv(
     torch_version: str,
     cuda_version: str,
 ) -> None:
-    p = Version.parse(python_version)
     t = Version.parse(torch_version)
-    spec = get_torch_spec(t)
-    if spec is None:
-        return
-    if p < spec.python_min or p > spec.python_max:
-        return
-    if cuda_version not in spec.cudas:
+    venv = venv_name(python_version, torch_version, cuda_version)
+    if venv is None:
         return
 
-    venv = f'python{python_version}-torch{torch_version}-{cuda_suffix(cuda_version)}'
     vdir = os.path.join(gdir, venv)
     if require_done_or_rm(vdir):
         log.info(f'Venv {venv} in {vdir} is complete')
@@ -176,7 +176,8 @@ def install_venv(
     log.info(f'Creating venv {venv}...')
     uv = os.path.join(args.prefix, 'bin', 'uv')
     cmd = [uv, 'venv', '--python', python_full_version, vdir]
-    subprocess.run(cmd, check=True)
+    with span('venv.create', venv=venv):
+        run_prefixed(cmd, venv)
 
     log.info(f'Installing Torch {t} in {venv}...')
 
@@ -185,7 +186,13 @@ def install_venv(
     cmd += index_args(torch_version, cuda_version, False)
     env = os.environ.copy()
     env['VIRTUAL_ENV'] = vdir
-    subprocess.run(cmd, check=True, env=env)
+    # Compiled below instead, in parallel and shared across venvs
+    env['UV_COMPILE_BYTECODE'] = '0'
+    with span('venv.install', venv=venv):
+        run_prefixed(cmd, venv, env=env)
+
+    compile_bytecode(vdir, python_version, prefix=args.prefix)
+    dedup(args.prefix, vdir)
 
     mark_done(
         vdir,
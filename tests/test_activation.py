@@ -0,0 +1,58 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from monobase.activation import write_env_dir
+
+ENVS = {
+    'python3.12': {
+        'MONOBASE_GEN_ID': '2',
+        'VIRTUAL_ENV': '$MONOBASE_PREFIX/monobase/g00002/python3.12-torch2.6.0-cpu',
+    },
+    'python3.12-cuda12.4-cudnn9': {
+        'LD_CACHE_PATH': '$MONOBASE_PREFIX/monobase/g00002/ld.so.cache.d/cu124',
+    },
+}
+
+
+@pytest.mark.skipif(shutil.which('sh') is None, reason='sh not found')
+def test_write_env_dir_sourced(tmp_path: Path) -> None:
+    edir = tmp_path / 'env.d'
+    write_env_dir(str(edir), ENVS)
+    # Prefix mounted elsewhere, with characters the shell must not split on
+    prefix = '/srv/r8 mount/monobase'
+    script = f'. "{edir}/python3.12" && printf "%s\\n" "$VIRTUAL_ENV"'
+    proc = subprocess.run(
+        ['sh', '-c', script],
+        env={'MONOBASE_PREFIX': prefix},
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert proc.stdout == f'{prefix}/monobase/g00002/python3.12-torch2.6.0-cpu\n'
+
+
+@pytest.mark.parametrize(
+    'value', ['$(id)', '`id`', 'a"b', 'a b', "a'b", 'a;b', '$MONOBASE_PREFIX$HOME']
+)
+def test_write_env_dir_unsafe(tmp_path: Path, value: str) -> None:
+    with pytest.raises(AssertionError):
+        write_env_dir(str(tmp_path), {'python3.12': {'VIRTUAL_ENV': value}})
+    assert os.listdir(tmp_path) == []
+
+
+def test_write_env_dir_updates(tmp_path: Path) -> None:
+    edir = tmp_path / 'env.d'
+    write_env_dir(str(edir), ENVS)
+    unchanged = edir / 'python3.12'
+    os.utime(unchanged, (0, 0))
+
+    envs = {'python3.12': ENVS['python3.12'], 'python3.13': {'MONOBASE_GEN_ID': '2'}}
+    write_env_dir(str(edir), envs)
+    # Unchanged files not rewritten, stale combinations removed
+    assert sorted(os.listdir(edir)) == ['python3.12', 'python3.13']
+    assert os.stat(unchanged).st_mtime == 0
+    assert (edir / 'python3.13').read_text().endswith('MONOBASE_GEN_ID="2"\n')
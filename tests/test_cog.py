@@ -0,0 +1,193 @@
+import argparse
+import http.client
+import json
+import os
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Callable, Optional
+
+import pytest
+
+from monobase import cog
+from monobase.cog import MATRIX_TTL, cog_generation_id, install_cogs, load_matrix
+from monobase.util import mark_done
+
+OLD = {'latest_coglet': {'version': '0.1.0'}}
+NEW = {'latest_coglet': {'version': '0.2.0'}}
+
+
+class Response:
+    def __init__(self, content: bytes, etag: Optional[str]) -> None:
+        self.content = content
+        self.etag = etag
+
+    def read(self) -> bytes:
+        return self.content
+
+    def getheader(self, name: str) -> Optional[str]:
+        assert name == 'ETag'
+        return self.etag
+
+
+def not_modified(req: urllib.request.Request) -> Response:
+    raise urllib.error.HTTPError(
+        req.full_url, 304, 'Not Modified', http.client.HTTPMessage(), None
+    )
+
+
+class Server:
+    def __init__(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        self.requests: list[urllib.request.Request] = []
+        self.handler: Callable[[urllib.request.Request], Response] = lambda req: (
+            Response(json.dumps(NEW).encode('utf-8'), '"new"')
+        )
+        monkeypatch.setattr(urllib.request, 'urlopen', self.urlopen)
+
+    def urlopen(self, req: urllib.request.Request, timeout: float) -> Response:
+        self.requests.append(req)
+        return self.handler(req)
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> Server:
+    return Server(monkeypatch)
+
+
+def write_cache(cache: Path, age: float, etag: Optional[str] = '"old"') -> Path:
+    path = cache / 'matrix.json'
+    path.write_text(json.dumps(OLD))
+    t = os.stat(path).st_mtime - age
+    os.utime(path, (t, t))
+    if etag is not None:
+        (cache / 'matrix.json.etag').write_text(etag)
+    return path
+
+
+def test_fetch_without_cache(tmp_path: Path, server: Server) -> None:
+    cache = tmp_path / 'cache'
+    assert load_matrix(str(cache), False) == NEW
+    assert server.requests[0].get_header('If-none-match') is None
+    assert json.loads((cache / 'matrix.json').read_text()) == NEW
+    assert (cache / 'matrix.json.etag').read_text() == '"new"'
+    assert sorted(os.listdir(cache)) == ['matrix.json', 'matrix.json.etag']
+
+
+def test_fresh_cache(tmp_path: Path, server: Server) -> None:
+    write_cache(tmp_path, 0)
+    assert load_matrix(str(tmp_path), False) == OLD
+    assert server.requests == []
+
+
+def test_offline(tmp_path: Path, server: Server) -> None:
+    with pytest.raises(AssertionError):
+        load_matrix(str(tmp_path), True)
+    write_cache(tmp_path, 2 * MATRIX_TTL)
+    assert load_matrix(str(tmp_path), True) == OLD
+    assert server.requests == []
+
+
+def test_stale_cache_not_modified(tmp_path: Path, server: Server) -> None:
+    path = write_cache(tmp_path, 2 * MATRIX_TTL)
+    server.handler = not_modified
+    assert load_matrix(str(tmp_path), False) == OLD
+    assert server.requests[0].get_header('If-none-match') == '"old"'
+    # Revalidated for another TTL
+    assert load_matrix(str(tmp_path), False) == OLD
+    assert len(server.requests) == 1
+    assert json.loads(path.read_text()) == OLD
+
+
+def test_stale_cache_modified(tmp_path: Path, server: Server) -> None:
+    write_cache(tmp_path, 2 * MATRIX_TTL)
+    assert load_matrix(str(tmp_path), False) == NEW
+    assert (tmp_path / 'matrix.json.etag').read_text() == '"new"'
+
+    # No ETag, do not revalidate with the previous one
+    write_cache(tmp_path, 2 * MATRIX_TTL, etag=None)
+    server.handler = lambda req: Response(json.dumps(NEW).encode('utf-8'), None)
+    assert load_matrix(str(tmp_path), False) == NEW
+    assert not (tmp_path / 'matrix.json.etag').exists()
+
+
+@pytest.mark.parametrize(
+    'error',
+    [
+        urllib.error.URLError('Name or service not known'),
+        urllib.error.HTTPError(
+            cog.matrx_json_url, 503, 'Unavailable', http.client.HTTPMessage(), None
+        ),
+        TimeoutError('The read operation timed out'),
+        http.client.IncompleteRead(b'{'),
+    ],
+)
+def test_stale_cache_on_error(tmp_path: Path, server: Server, error: Exception) -> None:
+    class Failing(Response):
+        def read(self) -> bytes:
+            raise error
+
+    server.handler = lambda req: Failing(b'', None)
+    with pytest.raises(type(error)):
+        load_matrix(str(tmp_path / 'missing'), False)
+
+    path = write_cache(tmp_path, 2 * MATRIX_TTL)
+    assert load_matrix(str(tmp_path), False) == OLD
+    assert json.loads(path.read_text()) == OLD
+    assert (tmp_path / 'matrix.json.etag').read_text() == '"old"'
+
+
+def test_readonly(tmp_path: Path, server: Server) -> None:
+    # Stale cache as is, without revalidating
+    path = write_cache(tmp_path, 2 * MATRIX_TTL)
+    mtime = os.stat(path).st_mtime
+    assert load_matrix(str(tmp_path), False, readonly=True) == OLD
+    assert server.requests == []
+    assert os.stat(path).st_mtime == mtime
+
+    # Fetched but not cached
+    cache = tmp_path / 'cache'
+    assert load_matrix(str(cache), False, readonly=True) == NEW
+    assert len(server.requests) == 1
+    assert not cache.exists()
+
+
+def cog_args(tmp_path: Path, cog_versions: list[str]) -> argparse.Namespace:
+    return argparse.Namespace(
+        prefix=str(tmp_path / 'prefix'),
+        cache=str(tmp_path / 'cache'),
+        offline=False,
+        cog_versions=cog_versions,
+        default_cog_version=cog_versions[0],
+    )
+
+
+@pytest.mark.parametrize('cog_versions', [['0.14.0', 'coglet==0.1.0'], ['coglet']])
+def test_install_cogs_complete(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, cog_versions: list[str]
+) -> None:
+    args = cog_args(tmp_path, cog_versions)
+    matrix = OLD if 'coglet' in cog_versions else None
+    gid = cog_generation_id(args, ['3.12'], matrix)
+    gdir = tmp_path / 'prefix' / 'cog' / gid
+    gdir.mkdir(parents=True)
+    mark_done(str(gdir), kind='cog', id=gid)
+
+    loaded = []
+    # cog_spec logs and skips failed coglet release lookups
+    fetched = []
+
+    def load_matrix(cache: str, offline: bool) -> dict:
+        loaded.append(cache)
+        return OLD
+
+    def urlopen(url: str) -> Response:
+        fetched.append(url)
+        raise urllib.error.URLError('Unexpected coglet release lookup')
+
+    monkeypatch.setattr(cog, 'load_matrix', load_matrix)
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+    install_cogs(args, ['3.12'])
+    assert fetched == []
+    assert os.path.isdir(gdir / 'env.d')
+    # matrix.json only for the latest coglet version in the generation ID
+    assert len(loaded) == (0 if matrix is None else 1)
@@ -0,0 +1,119 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from monobase import dedup
+from monobase.dedup import LINK_SUFFIX, ObjectStore, hash_file, index_key
+
+SIZE = 4096
+
+
+@pytest.fixture(autouse=True)
+def min_size(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(dedup, 'MIN_SIZE', SIZE)
+
+
+def write(p: Path, content: bytes) -> Path:
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(content)
+    return p
+
+
+def test_add_tree_links_duplicates(tmp_path: Path) -> None:
+    tree = tmp_path / 'tree'
+    a = write(tree / 'a', b'a' * SIZE)
+    b = write(tree / 'sub' / 'b', b'a' * SIZE)
+    c = write(tree / 'c', b'c' * SIZE)
+    store = ObjectStore(str(tmp_path / 'prefix'))
+
+    assert store.add_tree(str(tree)) == SIZE
+    assert a.stat().st_ino == b.stat().st_ino
+    assert a.stat().st_ino != c.stat().st_ino
+    obj = store.object_path(hash_file(str(a)))
+    assert os.stat(obj).st_ino == a.stat().st_ino
+    assert os.stat(obj).st_nlink == 3
+    assert a.read_bytes() == b'a' * SIZE
+
+
+def test_add_tree_skips_small_files_and_symlinks(tmp_path: Path) -> None:
+    tree = tmp_path / 'tree'
+    small = write(tree / 'small', b's' * (SIZE - 1))
+    write(tree / 'small2', b's' * (SIZE - 1))
+    (tree / 'link').symlink_to(small)
+    store = ObjectStore(str(tmp_path / 'prefix'))
+
+    assert store.add_tree(str(tree)) == 0
+    assert store.index == {}
+    assert small.stat().st_nlink == 1
+
+
+def test_add_tree_removes_interrupted_links(tmp_path: Path) -> None:
+    tree = tmp_path / 'tree'
+    write(tree / 'a', b'a' * SIZE)
+    leftover = write(tree / f'a{LINK_SUFFIX}', b'a' * SIZE)
+    ObjectStore(str(tmp_path / 'prefix')).add_tree(str(tree))
+    assert not leftover.exists()
+
+
+def test_index_persists_and_skips_hashing(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    tree = tmp_path / 'tree'
+    a = write(tree / 'a', b'a' * SIZE)
+    write(tree / 'b', b'b' * SIZE)
+    prefix = str(tmp_path / 'prefix')
+    ObjectStore(prefix).add_tree(str(tree))
+
+    hashed = []
+
+    def counting_hash_file(path: str) -> str:
+        hashed.append(path)
+        return hash_file(path)
+
+    monkeypatch.setattr(dedup, 'hash_file', counting_hash_file)
+    store = ObjectStore(prefix)
+    assert store.add_tree(str(tree)) == 0
+    assert hashed == []
+
+    # Replaced in place, e.g. reinstalled, is hashed again
+    a.unlink()
+    write(a, b'A' * SIZE)
+    store.add_tree(str(tree))
+    assert hashed == [str(a)]
+    assert store.index[index_key(a.stat())] == hash_file(str(a))
+
+
+def test_prune_removes_unused_objects_and_stale_keys(tmp_path: Path) -> None:
+    tree = tmp_path / 'tree'
+    a = write(tree / 'a', b'a' * SIZE)
+    b = write(tree / 'b', b'b' * SIZE)
+    store = ObjectStore(str(tmp_path / 'prefix'))
+    store.add_tree(str(tree))
+    digest_a = hash_file(str(a))
+    digest_b = hash_file(str(b))
+    key_a = index_key(a.stat())
+
+    b.unlink()
+    assert store.prune() == SIZE
+    assert os.path.exists(store.object_path(digest_a))
+    assert not os.path.exists(store.object_path(digest_b))
+    assert store.index == {key_a: digest_a}
+    # Saved for the next build
+    assert ObjectStore(str(tmp_path / 'prefix')).index == {key_a: digest_a}
+
+
+def test_link_failure_skips_file(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    tree = tmp_path / 'tree'
+    a = write(tree / 'a', b'a' * SIZE)
+    store = ObjectStore(str(tmp_path / 'prefix'))
+
+    def cross_device(src: str, dst: str) -> None:
+        raise OSError(18, 'Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'link', cross_device)
+    assert store.add_tree(str(tree)) == 0
+    assert a.read_bytes() == b'a' * SIZE
+    assert not os.path.exists(store.object_path(hash_file(str(a))))
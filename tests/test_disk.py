@@ -0,0 +1,82 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from monobase.disk import disk_usage, parse_size
+
+SIZE = 64 * 1024
+
+
+def write(p: Path, content: bytes = b'x' * SIZE) -> Path:
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(content)
+    return p
+
+
+def blocks(p: Path) -> int:
+    return os.stat(p).st_blocks * 512
+
+
+@pytest.fixture
+def prefix(tmp_path: Path) -> Path:
+    root = tmp_path / 'prefix'
+    g1 = root / 'monobase' / 'g00001'
+    shared = write(root / 'objects' / 'sha256' / 'ab' / 'ab')
+    for v in ['python3.12-torch2.6.0-cu124', 'python3.12-torch2.6.0-cpu']:
+        write(g1 / v / 'own')
+        os.link(shared, g1 / v / 'shared')
+    # Linked from g00002 too
+    cross = write(g1 / 'python3.12-torch2.6.0-cpu' / 'cross')
+    g2 = root / 'monobase' / 'g00002' / 'python3.12-torch2.7.0-cpu'
+    write(g2 / 'own')
+    os.link(cross, g2 / 'cross')
+    # Linked from outside of prefix
+    os.link(write(root / 'uv' / 'cache' / 'wheel'), tmp_path / 'outside')
+    return root
+
+
+def test_disk_usage_by_unit(prefix: Path) -> None:
+    du = disk_usage(str(prefix))
+    f = blocks(prefix / 'objects' / 'sha256' / 'ab' / 'ab')
+    units = du.by_unit()
+    cu124 = units['monobase/g00001/python3.12-torch2.6.0-cu124']
+    cpu = units['monobase/g00001/python3.12-torch2.6.0-cpu']
+    # Own file and directory, shared file is also in the other venv
+    assert cu124.unique == f + blocks(
+        prefix / 'monobase/g00001/python3.12-torch2.6.0-cu124'
+    )
+    assert cu124.shared == f
+    assert cpu.shared == 2 * f
+    assert units['uv/cache'].unique == blocks(prefix / 'uv' / 'cache')
+    assert units['uv/cache'].shared == f
+
+
+def test_disk_usage_by_generation(prefix: Path) -> None:
+    du = disk_usage(str(prefix))
+    f = blocks(prefix / 'objects' / 'sha256' / 'ab' / 'ab')
+    gens = du.by_generation()
+    # Objects only hold hard links, the generation alone owns the shared file
+    assert gens['monobase/g00001'].shared == f
+    assert gens['monobase/g00002'].shared == f
+    assert gens['objects'].shared == f
+
+
+@pytest.mark.skipif(shutil.which('du') is None, reason='du not found')
+def test_disk_usage_total_matches_du(prefix: Path) -> None:
+    proc = subprocess.run(
+        ['du', '-s', '--block-size=1', str(prefix)],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert disk_usage(str(prefix)).total == int(proc.stdout.split()[0])
+
+
+def test_parse_size() -> None:
+    assert parse_size('1024') == 1024
+    assert parse_size('500G') == 500 * 1024**3
+    assert parse_size('1.5TiB') == int(1.5 * 1024**4)
+    assert parse_size('2mb') == 2 * 1024**2
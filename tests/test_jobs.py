@@ -0,0 +1,107 @@
+import contextvars
+import threading
+import time
+
+import pytest
+
+from monobase.jobs import Job, run_jobs
+
+
+def test_run_jobs_dependency_order() -> None:
+    order = []
+
+    def step(name: str) -> None:
+        order.append(name)
+
+    jobs = [
+        Job('c', step, ('c',), deps=('b',)),
+        Job('b', step, ('b',), deps=('a',)),
+        Job('a', step, ('a',)),
+    ]
+    run_jobs(jobs, 4, keep_going=False)
+    assert order == ['a', 'b', 'c']
+
+
+def test_run_jobs_list_order_with_one_worker() -> None:
+    order = []
+    jobs = [Job(n, order.append, (n,)) for n in ['x', 'y', 'z']]
+    run_jobs(jobs, 1, keep_going=False)
+    assert order == ['x', 'y', 'z']
+
+
+def test_run_jobs_max_workers() -> None:
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def step() -> None:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    run_jobs([Job(f'j{i}', step) for i in range(6)], 2, keep_going=False)
+    assert peak == 2
+
+
+def test_run_jobs_fail_fast() -> None:
+    ran = []
+
+    def fail() -> None:
+        raise ValueError('boom')
+
+    jobs = [
+        Job('a', fail),
+        Job('b', ran.append, ('b',), deps=('a',)),
+        Job('c', ran.append, ('c',)),
+    ]
+    with pytest.raises(RuntimeError, match='3 job\\(s\\) failed: a, b, c'):
+        run_jobs(jobs, 1, keep_going=False)
+    assert ran == []
+
+
+def test_run_jobs_keep_going() -> None:
+    ran = []
+
+    def fail() -> None:
+        raise ValueError('boom')
+
+    jobs = [
+        Job('a', fail),
+        Job('b', ran.append, ('b',), deps=('a',)),
+        Job('c', ran.append, ('c',)),
+        Job('d', ran.append, ('d',), deps=('c',)),
+    ]
+    with pytest.raises(RuntimeError, match='2 job\\(s\\) failed: a, b'):
+        run_jobs(jobs, 1, keep_going=True)
+    assert ran == ['c', 'd']
+
+
+def test_run_jobs_cycle() -> None:
+    jobs = [
+        Job('a', print, deps=('b',)),
+        Job('b', print, deps=('a',)),
+    ]
+    with pytest.raises(RuntimeError, match='Unsatisfiable'):
+        run_jobs(jobs, 2, keep_going=False)
+
+
+def test_run_jobs_unknown_dependency() -> None:
+    with pytest.raises(AssertionError, match='unknown job'):
+        run_jobs([Job('a', print, deps=('b',))], 1, keep_going=False)
+
+
+def test_run_jobs_duplicate_names() -> None:
+    with pytest.raises(AssertionError, match='Duplicate'):
+        run_jobs([Job('a', print), Job('a', print)], 1, keep_going=False)
+
+
+def test_run_jobs_copies_context() -> None:
+    var: contextvars.ContextVar[str] = contextvars.ContextVar('var', default='')
+    seen = []
+    var.set('caller')
+    run_jobs([Job('a', lambda: seen.append(var.get()))], 2, keep_going=False)
+    assert seen == ['caller']
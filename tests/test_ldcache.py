@@ -0,0 +1,84 @@
+import glob
+import re
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from monobase.ldcache import elf_needed, verify_ld_cache
+
+
+def find_library(name: str) -> Optional[str]:
+    for d in ['/usr/lib/x86_64-linux-gnu', '/lib/x86_64-linux-gnu', '/usr/lib64']:
+        paths = glob.glob(f'{d}/{name}')
+        if len(paths) > 0:
+            return paths[0]
+    return None
+
+
+@pytest.mark.skipif(shutil.which('readelf') is None, reason='readelf not found')
+@pytest.mark.parametrize('name', ['libssl.so.*', 'libz.so.1', 'libm.so.6'])
+def test_elf_needed_matches_readelf(name: str) -> None:
+    path = find_library(name)
+    if path is None:
+        pytest.skip(f'{name} not found')
+    proc = subprocess.run(
+        ['readelf', '-d', path], check=True, capture_output=True, text=True
+    )
+    expected = re.findall(r'\(NEEDED\)\s+Shared library: \[([^\]]+)\]', proc.stdout)
+    assert elf_needed(path) == expected
+
+
+def test_elf_needed_not_elf(tmp_path: Path) -> None:
+    # e.g. linker scripts such as libc.so
+    script = tmp_path / 'libfoo.so'
+    script.write_text('GROUP ( /lib/libfoo.so.1 )\n')
+    assert elf_needed(str(script)) == []
+    empty = tmp_path / 'empty.so'
+    empty.write_bytes(b'')
+    assert elf_needed(str(empty)) == []
+
+
+def build_library(d: Path, soname: str, needed: list[str]) -> None:
+    src = d / f'{soname}.c'
+    src.write_text(
+        f'int {soname.split(".")[0].replace("-", "_")}(void) {{ return 0; }}\n'
+    )
+    cmd = ['cc', '-shared', '-fPIC', f'-Wl,-soname,{soname}', '-o', str(d / soname)]
+    # Nothing references the needed libraries, keep them anyway
+    cmd += [str(src), f'-L{d}', '-Wl,--no-as-needed'] + [f'-l:{n}' for n in needed]
+    subprocess.run(cmd, check=True)
+    src.unlink()
+
+
+@pytest.mark.skipif(shutil.which('ldconfig') is None, reason='ldconfig not found')
+@pytest.mark.skipif(shutil.which('cc') is None, reason='cc not found')
+def test_verify_ld_cache(tmp_path: Path) -> None:
+    # Sonames that are nowhere else on the system
+    lib = tmp_path / 'lib'
+    lib.mkdir()
+    build_library(lib, 'libmonobase-b.so.1', [])
+    build_library(lib, 'libmonobase-a.so.1', ['libmonobase-b.so.1'])
+    assert elf_needed(str(lib / 'libmonobase-a.so.1'))[0] == 'libmonobase-b.so.1'
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+
+    complete = str(tmp_path / 'complete')
+    subprocess.run(['ldconfig', '-C', complete, str(lib)], check=True)
+    assert verify_ld_cache(complete, [str(lib)]) == []
+
+    # Only resolved via LD_LIBRARY_PATH without a cache entry
+    incomplete = str(tmp_path / 'incomplete')
+    subprocess.run(['ldconfig', '-C', incomplete, str(empty)], check=True)
+    assert verify_ld_cache(incomplete, [str(lib)]) == ['libmonobase-b.so.1']
+
+    # Also libraries outside of dirs, e.g. torch in venvs
+    other = tmp_path / 'other'
+    other.mkdir()
+    build_library(other, 'libmonobase-c.so.1', [])
+    shutil.move(str(lib / 'libmonobase-a.so.1'), other)
+    files = [str(other / 'libmonobase-a.so.1')]
+    assert verify_ld_cache(incomplete, [str(lib)], files) == ['libmonobase-b.so.1']
+    assert verify_ld_cache(complete, [str(lib)], files) == []
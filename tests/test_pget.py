@@ -0,0 +1,169 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from monobase import pget
+from monobase.pget import (
+    KNOWN_WEIGHTS_INDEX,
+    TREE_MANIFEST,
+    KnownWeightsIndex,
+    content_key,
+    find_known_weights,
+    link_tree,
+    scan_tree,
+    url_key,
+    write_tree_manifest,
+)
+from monobase.refresh_files import Object, write_index
+
+S3_URL = 'https://bucket.s3.us-east-1.amazonaws.com/weights/model.bin'
+
+
+def name(url: str) -> str:
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def known_weights(d: Path, objs: list[Object]) -> dict[str, Object]:
+    metadata = {name(o.url): o for o in objs}
+    for h in metadata:
+        (d / h).write_bytes(b'weights')
+    write_index(str(d), metadata)
+    return metadata
+
+
+@pytest.fixture(autouse=True)
+def clear_index_cache() -> None:
+    # Index is loaded once per weights directory and process
+    pget.known_weights_index.cache_clear()
+
+
+def test_index_lookup(tmp_path: Path) -> None:
+    objs = [Object(f'https://example.com/{i}', i, f'"etag-{i}"') for i in range(100)]
+    metadata = known_weights(tmp_path, objs)
+
+    index = KnownWeightsIndex(str(tmp_path / KNOWN_WEIGHTS_INDEX))
+    for h, o in metadata.items():
+        assert index.lookup(url_key(o.url)) == h
+        assert index.lookup(content_key(o.size, o.etag)) == h
+    assert index.lookup(url_key('https://example.com/missing')) is None
+    assert index.lookup('0' * 64) is None
+    assert index.lookup('f' * 64) is None
+
+
+def test_index_missing_or_empty(tmp_path: Path) -> None:
+    assert KnownWeightsIndex(str(tmp_path / 'missing')).lookup('0' * 64) is None
+    (tmp_path / KNOWN_WEIGHTS_INDEX).write_bytes(b'')
+    index = KnownWeightsIndex(str(tmp_path / KNOWN_WEIGHTS_INDEX))
+    assert index.mm is None
+    assert index.lookup('0' * 64) is None
+
+
+def test_index_skips_missing_files(tmp_path: Path) -> None:
+    o = Object('https://example.com/a', 1, '"a"')
+    write_index(str(tmp_path), {name(o.url): o})
+    index = KnownWeightsIndex(str(tmp_path / KNOWN_WEIGHTS_INDEX))
+    assert index.lookup(url_key(o.url)) is None
+
+
+def test_find_exact_url(tmp_path: Path) -> None:
+    url = 'https://example.com/a'
+    (tmp_path / name(url)).write_bytes(b'weights')
+    assert find_known_weights(str(tmp_path), url) == (str(tmp_path / name(url)), None)
+
+
+def test_find_presigned_url(tmp_path: Path) -> None:
+    known_weights(tmp_path, [Object(f'{S3_URL}?X-Amz-Signature=old', 7, '"e"')])
+    fpath, entry = find_known_weights(str(tmp_path), f'{S3_URL}?X-Amz-Signature=new')
+    assert fpath == str(tmp_path / name(f'{S3_URL}?X-Amz-Signature=old'))
+    assert entry is None
+
+
+def test_find_by_content(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    known_weights(tmp_path, [Object('https://example.com/a', 7, '"e"')])
+    probed = []
+
+    def probe_fingerprint(url: str) -> dict[str, Any]:
+        probed.append(url)
+        etag = '"e"' if url.endswith('/a') else '"other"'
+        return {'length': 7, 'etag': etag, 'modified': None}
+
+    monkeypatch.setattr(pget, 'probe_fingerprint', probe_fingerprint)
+    fpath, entry = find_known_weights(str(tmp_path), 'https://mirror.com/a')
+    assert fpath == str(tmp_path / name('https://example.com/a'))
+    assert probed == ['https://mirror.com/a']
+    # Returned so that lazy loading does not probe again
+    assert entry is not None and entry['length'] == 7
+
+    fpath, entry = find_known_weights(str(tmp_path), 'https://mirror.com/b')
+    assert fpath is None
+    assert entry is not None
+
+
+def test_find_without_probe(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def probe_fingerprint(url: str) -> dict[str, Any]:
+        raise AssertionError(f'Unexpected HEAD {url}')
+
+    monkeypatch.setattr(pget, 'probe_fingerprint', probe_fingerprint)
+    # No index, nothing to look up by content
+    assert find_known_weights(str(tmp_path), 'https://example.com/a') == (None, None)
+    # Not HTTP
+    known_weights(tmp_path, [Object('https://example.com/a', 7, '"e"')])
+    assert find_known_weights(str(tmp_path), 's3://bucket/a') == (None, None)
+
+
+def weights_tree(src: Path) -> None:
+    snapshot = src / 'snapshots' / 'abc'
+    snapshot.mkdir(parents=True)
+    (snapshot / 'config.json').write_text('{}')
+    (snapshot / 'model.bin').write_bytes(b'weights')
+    (src / 'refs').mkdir()
+    (src / 'refs' / 'main').write_text('abc')
+    (src / 'latest').symlink_to('snapshots/abc')
+
+
+def test_scan_tree(tmp_path: Path) -> None:
+    weights_tree(tmp_path)
+    write_tree_manifest(str(tmp_path))
+    tree = scan_tree(str(tmp_path))
+    assert sorted(tree['dirs']) == ['refs', 'snapshots', 'snapshots/abc']
+    # Symlinks are linked as is, manifest itself is skipped
+    assert sorted(tree['links']) == [
+        'latest',
+        'snapshots/abc/config.json',
+        'snapshots/abc/model.bin',
+    ]
+    assert tree['copies'] == ['refs/main']
+
+
+@pytest.mark.parametrize('manifest', [True, False])
+def test_link_tree(tmp_path: Path, manifest: bool) -> None:
+    src = tmp_path / 'src'
+    weights_tree(src)
+    if manifest:
+        write_tree_manifest(str(src))
+    dst = tmp_path / 'dst'
+    link_tree(str(src), str(dst))
+
+    model = dst / 'snapshots' / 'abc' / 'model.bin'
+    assert os.readlink(model) == str(src / 'snapshots' / 'abc' / 'model.bin')
+    assert model.read_bytes() == b'weights'
+    assert os.readlink(dst / 'latest') == str(src / 'latest')
+    assert not (dst / 'snapshots').is_symlink()
+    assert not (dst / TREE_MANIFEST).exists()
+    # Git refs are copied, HF code may rewrite them
+    ref = dst / 'refs' / 'main'
+    assert not ref.is_symlink()
+    ref.write_text('def')
+    assert (src / 'refs' / 'main').read_text() == 'abc'
+
+
+def test_link_tree_existing(tmp_path: Path) -> None:
+    src = tmp_path / 'src'
+    weights_tree(src)
+    dst = tmp_path / 'dst'
+    link_tree(str(src), str(dst))
+    with pytest.raises(FileExistsError):
+        link_tree(str(src), str(dst))
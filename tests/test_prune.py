@@ -0,0 +1,107 @@
+import argparse
+import os
+from pathlib import Path
+
+from monobase.prune import gc_candidates, mark_evicted
+from monobase.util import done_attributes, is_done, mark_done
+
+NOW = 1_700_000_000
+
+
+def touch(p: Path, t: float) -> None:
+    os.utime(p, (t, t))
+
+
+def venv(gdir: Path, name: str, t: float) -> Path:
+    sp = gdir / name / 'lib' / 'python3.12' / 'site-packages'
+    sp.mkdir(parents=True)
+    touch(sp, t)
+    touch(gdir / name, t)
+    return gdir / name
+
+
+def make_prefix(tmp_path: Path) -> Path:
+    prefix = tmp_path / 'prefix'
+    mdir = prefix / 'monobase'
+    # g00001 inactive, g00002 active, g00003 latest
+    venv(mdir / 'g00001', 'python3.12-torch2.5.1-cu124', NOW - 100)
+    venv(mdir / 'g00002', 'python3.12-torch2.6.0-cu124', NOW - 300)
+    venv(mdir / 'g00002', 'python3.12-torch2.6.0-cpu', NOW - 200)
+    venv(mdir / 'g00003', 'python3.12-torch2.7.0-cu124', NOW - 400)
+    for g in ['g00001', 'g00002', 'g00003']:
+        touch(mdir / g, NOW - 1000)
+    (mdir / 'latest').symlink_to('g00003')
+    uv_cache = prefix / 'uv' / 'cache'
+    uv_cache.mkdir(parents=True)
+    touch(uv_cache, NOW - 50)
+    return prefix
+
+
+def args(prefix: Path, policy: str) -> argparse.Namespace:
+    return argparse.Namespace(
+        prefix=str(prefix),
+        min_gen_id=2,
+        max_gen_id=3,
+        gc_policy=policy,
+        usage_dir=None,
+    )
+
+
+def names(prefix: Path, policy: str) -> list[str]:
+    return [c.name for c in gc_candidates(args(prefix, policy))]
+
+
+def test_gc_candidates_priority(tmp_path: Path) -> None:
+    prefix = make_prefix(tmp_path)
+    assert names(prefix, 'priority') == [
+        'monobase/g00001',
+        'uv/cache',
+        'monobase/g00002/python3.12-torch2.6.0-cu124',
+        'monobase/g00002/python3.12-torch2.6.0-cpu',
+    ]
+
+
+def test_gc_candidates_lru(tmp_path: Path) -> None:
+    prefix = make_prefix(tmp_path)
+    assert names(prefix, 'lru') == [
+        'monobase/g00002/python3.12-torch2.6.0-cu124',
+        'monobase/g00002/python3.12-torch2.6.0-cpu',
+        'monobase/g00001',
+        'uv/cache',
+    ]
+
+
+def test_gc_candidates_access_log(tmp_path: Path) -> None:
+    prefix = make_prefix(tmp_path)
+    udir = prefix / 'usage'
+    udir.mkdir()
+    # Activated recently, on a read-only mount that does not update atime
+    cu124 = prefix / 'monobase' / 'g00002' / 'python3.12-torch2.6.0-cu124'
+    (udir / 'access.log').write_text(f'{NOW - 10} /srv/cog {cu124} -\n')
+    assert names(prefix, 'lru') == [
+        'monobase/g00002/python3.12-torch2.6.0-cpu',
+        'monobase/g00001',
+        'uv/cache',
+        'monobase/g00002/python3.12-torch2.6.0-cu124',
+    ]
+
+
+def test_mark_evicted(tmp_path: Path) -> None:
+    mark_done(str(tmp_path), kind='generation', id=2)
+    mark_evicted(str(tmp_path), 'python3.12-torch2.6.0-cpu')
+    mark_evicted(str(tmp_path), 'python3.12-torch2.6.0-cu124')
+    mark_evicted(str(tmp_path), 'python3.12-torch2.6.0-cpu')
+    assert done_attributes(str(tmp_path)) == {
+        'monobase_kind': 'generation',
+        'monobase_generation.id': 2,
+        'monobase_generation.evicted': [
+            'python3.12-torch2.6.0-cpu',
+            'python3.12-torch2.6.0-cu124',
+        ],
+    }
+
+
+def test_mark_evicted_without_done(tmp_path: Path) -> None:
+    # Partial or interrupted generation stays not done
+    mark_evicted(str(tmp_path), 'python3.12-torch2.6.0-cpu')
+    assert not is_done(str(tmp_path))